@@ -1,15 +1,16 @@
-from flask import Flask, request, jsonify, render_template_string
-import networkx as nx
+from flask import Flask, Response, request, jsonify, render_template_string, stream_with_context
 import folium
-from geopy.distance import geodesic
-from geopy.geocoders import GoogleV3
-from geopy.exc import GeocoderTimedOut, GeocoderQuotaExceeded
-import pandas as pd
-import osmnx as ox
-import time
 import numpy as np
+import json
 import os
+import gc
 from dotenv import load_dotenv  # Add this import
+from geocoding import GEOCODER, geocode_addresses, make_geocoder
+from risk_layer import RiskSource
+from route_engine import (MATRIX_MAX_POINTS, MAX_RISK_WEIGHT, ROUTE_BATCH_MAX_PAIRS, ROUTE_SEARCHES,
+                          SIMPLIFY_TOLERANCES_M, NetworkRegistry, calculate_route_improved, check_risk_weight,
+                          pareto_routes, route_batch, route_geojson, route_polylines, route_shape, route_summary,
+                          travel_matrix, zoom_tolerance)
 
 # Load environment variables from .env file
 load_dotenv()  # Add this line
@@ -25,6 +26,8 @@ HTML_TEMPLATE = """
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Safe Route Planner - Leeds & Birmingham</title>
     <script src="https://cdn.jsdelivr.net/npm/axios/dist/axios.min.js"></script>
+    <link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css">
+    <script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
     <style>
         * {
             margin: 0;
@@ -234,6 +237,23 @@ HTML_TEMPLATE = """
             margin: 0 auto 20px;
         }
         
+        .route-legend {
+            background: rgba(255, 255, 255, 0.95);
+            border: 2px solid #333;
+            border-radius: 8px;
+            box-shadow: 0 4px 8px rgba(0,0,0,0.3);
+            padding: 10px 15px;
+            font-size: 13px;
+        }
+        
+        .route-legend .swatch {
+            display: inline-block;
+            width: 20px;
+            height: 4px;
+            margin-right: 8px;
+            vertical-align: middle;
+        }
+        
         @keyframes spin {
             0% { transform: rotate(0deg); }
             100% { transform: rotate(360deg); }
@@ -356,7 +376,8 @@ HTML_TEMPLATE = """
             axios.post('/get_route', {
                 start: start,
                 end: end,
-                risk_weight: 0.5  // Default balanced approach
+                risk_weight: 0.5,  // Default balanced approach
+                format: 'polyline'  // Routes are drawn here, not rendered on the server
             })
             .then(response => {
                 document.getElementById('loading').style.display = 'none';
@@ -371,7 +392,7 @@ HTML_TEMPLATE = """
                     (result.risk_reduction * 100).toFixed(1) + '%';
                 
                 document.getElementById('results').style.display = 'block';
-                document.getElementById('map').innerHTML = response.data.map_html;
+                drawRoutes(result, response.data.polylines);
             })
             .catch(error => {
                 document.getElementById('loading').style.display = 'none';
@@ -380,6 +401,94 @@ HTML_TEMPLATE = """
             });
         }
         
+        // Decode a Google encoded polyline into [lat, lng] pairs
+        function decodePolyline(encoded) {
+            const coords = [];
+            let index = 0, lat = 0, lng = 0;
+            while (index < encoded.length) {
+                for (const axis of [0, 1]) {
+                    let shift = 0, value = 0, byte;
+                    do {
+                        byte = encoded.charCodeAt(index++) - 63;
+                        value |= (byte & 0x1f) << shift;
+                        shift += 5;
+                    } while (byte >= 0x20);
+                    const delta = (value & 1) ? ~(value >> 1) : (value >> 1);
+                    if (axis === 0) lat += delta; else lng += delta;
+                }
+                coords.push([lat / 1e5, lng / 1e5]);
+            }
+            return coords;
+        }
+        
+        let map = null;
+        let routeLayer = null;
+        let lineLayer = null;
+        let routeLevels = null;
+        
+        // Draw the routes at the coarsest simplification still under a pixel at this zoom
+        function showRouteLevel() {
+            const lat = map.getCenter().lat * Math.PI / 180;
+            const metersPerPixel = 40075016.686 * Math.cos(lat) / (256 * Math.pow(2, map.getZoom()));
+            let level = 0;
+            routeLevels.polylines.tolerances.forEach((tolerance, i) => {
+                if (tolerance <= metersPerPixel) level = i;
+            });
+            const result = routeLevels.result;
+            lineLayer.clearLayers();
+            L.polyline(decodePolyline(routeLevels.polylines.fastest[level]), {color: 'red', weight: 4, opacity: 0.8})
+                .bindPopup(`Fastest Route: ${(result.fastest_time / 60).toFixed(1)} min, Risk: ${result.fastest_risk.toFixed(1)}`)
+                .addTo(lineLayer);
+            L.polyline(decodePolyline(routeLevels.polylines.safest[level]), {color: 'green', weight: 4, opacity: 0.8})
+                .bindPopup(`Safest Route: ${(result.safest_time / 60).toFixed(1)} min, Risk: ${result.safest_risk.toFixed(1)}`)
+                .addTo(lineLayer);
+        }
+        
+        function drawRoutes(result, polylines) {
+            if (!map) {
+                map = L.map('map');
+                L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png', {
+                    attribution: '&copy; OpenStreetMap contributors'
+                }).addTo(map);
+                routeLayer = L.layerGroup().addTo(map);
+                lineLayer = L.layerGroup().addTo(map);
+                map.on('zoomend', showRouteLevel);
+                
+                const legend = L.control({position: 'topright'});
+                legend.onAdd = function() {
+                    const div = L.DomUtil.create('div', 'route-legend');
+                    div.innerHTML =
+                        '<div><span class="swatch" style="background: red;"></span>Fastest Route</div>' +
+                        '<div><span class="swatch" style="background: green;"></span>Safest Route</div>' +
+                        '<div style="font-size: 11px; color: #666; margin-top: 6px;">Circles mark high-risk areas</div>';
+                    return div;
+                };
+                legend.addTo(map);
+            }
+            // The map was created or hidden while its panel was not displayed
+            map.invalidateSize();
+            routeLayer.clearLayers();
+            routeLevels = {result: result, polylines: polylines};
+            
+            for (const point of result.fastest_risk_points) {
+                L.circleMarker([point.lat, point.lng], {radius: 6, color: 'darkred', fillColor: 'red', fillOpacity: 0.7})
+                    .bindPopup(`High Risk Area (Fastest): ${point.risk.toFixed(2)}`).addTo(routeLayer);
+            }
+            for (const point of result.safest_risk_points) {
+                L.circleMarker([point.lat, point.lng], {radius: 6, color: 'darkgreen', fillColor: 'orange', fillOpacity: 0.7})
+                    .bindPopup(`High Risk Area (Safest): ${point.risk.toFixed(2)}`).addTo(routeLayer);
+            }
+            
+            L.marker(result.start_point).bindPopup('Start Location').addTo(routeLayer);
+            L.marker(result.end_point).bindPopup('Destination').addTo(routeLayer);
+            
+            // Frame both routes (the coarsest level is enough for that), then draw them
+            const last = polylines.tolerances.length - 1;
+            const bounds = L.latLngBounds(decodePolyline(polylines.fastest[last]).concat(decodePolyline(polylines.safest[last])));
+            map.fitBounds(bounds, {padding: [20, 20]});
+            showRouteLevel();
+        }
+        
         function showError(message) {
             document.getElementById('error').textContent = message;
             document.getElementById('error').style.display = 'block';
@@ -399,334 +508,47 @@ HTML_TEMPLATE = """
 </html>
 """
 
-# Initialize Google Geocoder
+# Initialize the geocoder (see GEOCODER in geocoding.py); Google needs an API key
 api_key = os.getenv('GOOGLE_MAPS_API_KEY')
 
 # Debug: Check if API key is loaded
-if not api_key:
+if api_key:
+    print(f"API key loaded successfully: {api_key[:10]}...")  # Only show first 10 characters for security
+elif 'google' in GEOCODER:
     print("ERROR: GOOGLE_MAPS_API_KEY not found in environment variables!")
     print("Current working directory:", os.getcwd())
     print("Files in current directory:", os.listdir('.'))
     print("Environment variables containing 'GOOGLE':", {k: v for k, v in os.environ.items() if 'GOOGLE' in k})
-    raise ValueError("GOOGLE_MAPS_API_KEY not found. Please check your .env file.")
-else:
-    print(f"API key loaded successfully: {api_key[:10]}...")  # Only show first 10 characters for security
 
-geolocator = GoogleV3(api_key=api_key, timeout=10)
+geolocator = make_geocoder(api_key=api_key)
 
 # Load precomputed data at startup
 def load_cached_data():
     data = {}
     
-    # Load risk grids
-    data['risk_grid'] = pd.read_pickle('data/risk_grid.pkl')
-    
-    # Load networks
-    data['leeds_network'] = ox.load_graphml('data/leeds_network.graphml')
-    data['birmingham_network'] = ox.load_graphml('data/birmingham_network.graphml')
+    # Risk data: the geohash risk grid plus any refreshed edge scores (see RISK_SOURCE)
+    data['risk'] = RiskSource()
     
-    # Load edges with risk scores
-    data['leeds_edges'] = pd.read_pickle('data/leeds_edges.pkl')
-    data['birmingham_edges'] = pd.read_pickle('data/birmingham_edges.pkl')
+    # City networks load on first use; PREWARM_CITIES are loaded now so that
+    # preforked workers share them
+    data['networks'] = NetworkRegistry(risk_source=data['risk'])
+    data['networks'].prewarm()
     
     return data
 
 cached_data = load_cached_data()
 
-def get_lat_lng(address):
-    """
-    Get latitude and longitude from address using Google Geocoding API
-    """
-    try:
-        # Add some context to help with geocoding accuracy
-        if not any(city in address.lower() for city in ['leeds', 'birmingham']):
-            # If no city is specified, we'll try both and see which gives better results
-            leeds_address = f"{address}, Leeds, UK"
-            birmingham_address = f"{address}, Birmingham, UK"
-            
-            # Try Leeds first
-            try:
-                leeds_location = geolocator.geocode(leeds_address)
-                if leeds_location:
-                    lat, lng = leeds_location.latitude, leeds_location.longitude
-                    in_area, city = is_in_supported_area(lat, lng)
-                    if in_area and city == 'leeds':
-                        return lat, lng
-            except:
-                pass
-            
-            # Try Birmingham
-            try:
-                birmingham_location = geolocator.geocode(birmingham_address)
-                if birmingham_location:
-                    lat, lng = birmingham_location.latitude, birmingham_location.longitude
-                    in_area, city = is_in_supported_area(lat, lng)
-                    if in_area and city == 'birmingham':
-                        return lat, lng
-            except:
-                pass
-        else:
-            # Direct geocoding if city is already specified
-            location = geolocator.geocode(f"{address}, UK")
-            if location:
-                return location.latitude, location.longitude
-        
-        return None, None
-        
-    except (GeocoderTimedOut, GeocoderQuotaExceeded) as e:
-        print(f"Geocoding error for address '{address}': {e}")
-        return None, None
-    except Exception as e:
-        print(f"Unexpected geocoding error for address '{address}': {e}")
-        return None, None
+# Keep the loaded data out of the garbage collector's scans, so workers forked
+# from a preloading master (see gunicorn.conf.py) don't copy its pages
+gc.freeze()
 
 def is_in_supported_area(lat, lng):
-    # Define bounding boxes for Leeds and Birmingham
-    leeds_bbox = (53.6989675, -1.8004214, 53.9458715, -1.2903516)  # min_lat, min_lon, max_lat, max_lon
-    birmingham_bbox = (52.381053, -2.0336486, 52.6087058, -1.7288417)
-    
-    in_leeds = (leeds_bbox[0] <= lat <= leeds_bbox[2] and 
-                leeds_bbox[1] <= lng <= leeds_bbox[3])
-    in_birmingham = (birmingham_bbox[0] <= lat <= birmingham_bbox[2] and 
-                     birmingham_bbox[1] <= lng <= birmingham_bbox[3])
-    
-    return in_leeds or in_birmingham, 'leeds' if in_leeds else 'birmingham'
+    # Indexed lookup over the city outlines in data/cities.json
+    city = cached_data['networks'].locate(lat, lng)
+    return city is not None, city
 
-def calculate_route_improved(network, origin, destination, risk_weight=0.5):
-    """
-    Improved route calculation with network connectivity handling
-    """
-    # Find nearest nodes
-    orig_node = ox.distance.nearest_nodes(network, origin[1], origin[0])
-    dest_node = ox.distance.nearest_nodes(network, destination[1], destination[0])
-    
-    print(f"Origin node: {orig_node}, Destination node: {dest_node}")
-    print(f"Risk weight: {risk_weight}")
-    
-    # Check if nodes are in the same connected component
-    if not nx.has_path(network, orig_node, dest_node):
-        print("No direct path found. Attempting to find alternative nodes...")
-        
-        # Get all nodes within a reasonable distance from origin and destination
-        orig_candidates = ox.distance.nearest_nodes(network, 
-                                                   [origin[1]] * 5, 
-                                                   [origin[0]] * 5, 
-                                                   return_dist=True)
-        dest_candidates = ox.distance.nearest_nodes(network, 
-                                                   [destination[1]] * 5, 
-                                                   [destination[0]] * 5, 
-                                                   return_dist=True)
-        
-        # Find the largest connected component
-        largest_cc = max(nx.connected_components(network.to_undirected()), key=len)
-        print(f"Largest connected component has {len(largest_cc)} nodes")
-        
-        # Find nearest nodes that are in the largest connected component
-        orig_node = None
-        dest_node = None
-        
-        # Search for origin node in connected component
-        for candidate in orig_candidates[0] if isinstance(orig_candidates[0], list) else [orig_candidates[0]]:
-            if candidate in largest_cc:
-                orig_node = candidate
-                break
-        
-        # Search for destination node in connected component
-        for candidate in dest_candidates[0] if isinstance(dest_candidates[0], list) else [dest_candidates[0]]:
-            if candidate in largest_cc:
-                dest_node = candidate
-                break
-        
-        if orig_node is None or dest_node is None:
-            # Fallback: find any nodes in the largest connected component near the points
-            import numpy as np
-            
-            # Get nodes in largest component with their coordinates
-            cc_nodes = list(largest_cc)
-            cc_coords = [(network.nodes[node]['y'], network.nodes[node]['x']) for node in cc_nodes]
-            
-            # Find closest nodes in connected component
-            if orig_node is None:
-                distances = [geodesic((origin[0], origin[1]), coord).meters for coord in cc_coords]
-                min_idx = np.argmin(distances)
-                orig_node = cc_nodes[min_idx]
-                print(f"Using alternative origin node: {orig_node} (distance: {distances[min_idx]:.0f}m)")
-            
-            if dest_node is None:
-                distances = [geodesic((destination[0], destination[1]), coord).meters for coord in cc_coords]
-                min_idx = np.argmin(distances)
-                dest_node = cc_nodes[min_idx]
-                print(f"Using alternative destination node: {dest_node} (distance: {distances[min_idx]:.0f}m)")
-    
-    # Verify we now have a valid path
-    if not nx.has_path(network, orig_node, dest_node):
-        raise ValueError("Cannot find any connected path between the locations. The road network may be incomplete in this area.")
-    
-    def safe_numeric_conversion(value, default=0):
-        """Safely convert value to float, handling strings and other types"""
-        if value is None:
-            return default
-        if isinstance(value, (int, float)):
-            return float(value)
-        if isinstance(value, str):
-            try:
-                return float(value)
-            except ValueError:
-                return default
-        if isinstance(value, list) and value:
-            try:
-                return float(value[0])
-            except (ValueError, TypeError):
-                return default
-        return default
-    
-    # Calculate fastest route (baseline) - using length only
-    try:
-        fastest_route = nx.shortest_path(network, orig_node, dest_node, weight='length')
-        
-        # Calculate actual travel time for fastest route
-        fastest_time = 0
-        fastest_total_risk = 0
-        
-        for i in range(len(fastest_route) - 1):
-            u, v = fastest_route[i], fastest_route[i + 1]
-            edge_data = network.get_edge_data(u, v)
-            
-            if edge_data:
-                # Get the first edge (there might be multiple edges between nodes)
-                edge = list(edge_data.values())[0]
-                
-                # Get base travel time if available, otherwise calculate from length
-                if 'base_travel_time' in edge:
-                    base_time = safe_numeric_conversion(edge['base_travel_time'])
-                    fastest_time += base_time
-                else:
-                    length = safe_numeric_conversion(edge.get('length', 0))
-                    # Assume 50 km/h average speed if no speed limit
-                    speed_ms = 50 * 1000 / 3600  # 50 km/h in m/s
-                    fastest_time += length / speed_ms if speed_ms > 0 else 0
-                
-                # Get risk score
-                risk = safe_numeric_conversion(edge.get('normalized_risk', 0))
-                fastest_total_risk += risk
-                
-        print(f"Fastest route: {len(fastest_route)} nodes, {fastest_time:.1f}s, risk: {fastest_total_risk:.2f}")
-        
-    except Exception as e:
-        print(f"Error calculating fastest route: {e}")
-        raise ValueError(f"Cannot find route between the specified locations: {e}")
-    
-    # Create custom weight function that balances time and risk
-    def risk_aware_weight(u, v, d):
-        """
-        Custom weight function combining time and risk
-        """
-        # Get base travel time
-        if 'base_travel_time' in d:
-            base_time = safe_numeric_conversion(d['base_travel_time'])
-        else:
-            # Calculate from length and speed
-            length = safe_numeric_conversion(d.get('length', 0))
-            max_speed = d.get('maxspeed', 50)
-            
-            # Handle speed properly
-            max_speed = safe_numeric_conversion(max_speed, 50)
-            
-            # Convert speed to m/s
-            speed_ms = max_speed * 1000 / 3600
-            base_time = length / speed_ms if speed_ms > 0 else length / 13.89  # fallback to 50km/h
-        
-        # Get risk score
-        risk_score = safe_numeric_conversion(d.get('normalized_risk', 0))
-        
-        # Risk penalty: higher risk_weight means more penalty for risky edges
-        # Scale risk penalty: risk_score ranges 0-5, so we scale it
-        risk_penalty = 1 + (risk_weight * risk_score * 0.5)  # 0-150% penalty based on risk
-        
-        total_weight = base_time * risk_penalty
-        
-        return total_weight
-    
-    # Calculate safest route using risk-aware weights
-    try:
-        safest_route = nx.shortest_path(network, orig_node, dest_node, weight=risk_aware_weight)
-        
-        # Calculate actual travel time and risk for safest route
-        safest_time = 0
-        safest_total_risk = 0
-        
-        for i in range(len(safest_route) - 1):
-            u, v = safest_route[i], safest_route[i + 1]
-            edge_data = network.get_edge_data(u, v)
-            
-            if edge_data:
-                edge = list(edge_data.values())[0]
-                
-                # Get base travel time
-                if 'base_travel_time' in edge:
-                    base_time = safe_numeric_conversion(edge['base_travel_time'])
-                    safest_time += base_time
-                else:
-                    length = safe_numeric_conversion(edge.get('length', 0))
-                    speed_ms = 50 * 1000 / 3600  # 50 km/h in m/s
-                    safest_time += length / speed_ms if speed_ms > 0 else 0
-                
-                # Get risk score
-                risk = safe_numeric_conversion(edge.get('normalized_risk', 0))
-                safest_total_risk += risk
-                
-        print(f"Safest route: {len(safest_route)} nodes, {safest_time:.1f}s, risk: {safest_total_risk:.2f}")
-        
-    except Exception as e:
-        print(f"Error calculating safest route: {e}")
-        # Fallback to fastest route if safest fails
-        safest_route = fastest_route
-        safest_time = fastest_time
-        safest_total_risk = fastest_total_risk
-    
-    # Calculate risk reduction
-    risk_reduction = 0
-    if fastest_total_risk > 0:
-        risk_reduction = max(0, (fastest_total_risk - safest_total_risk) / fastest_total_risk)
-    
-    # Calculate high-risk points for visualization
-    def get_high_risk_points(route, threshold=2.0):
-        risk_points = []
-        for i in range(len(route) - 1):
-            u, v = route[i], route[i + 1]
-            edge_data = network.get_edge_data(u, v)
-            
-            if edge_data:
-                edge = list(edge_data.values())[0]
-                risk_val = safe_numeric_conversion(edge.get('normalized_risk', 0))
-                
-                if risk_val > threshold:
-                    node_data = network.nodes[u]
-                    risk_points.append({
-                        'lat': node_data['y'],
-                        'lng': node_data['x'],
-                        'risk': risk_val
-                    })
-        return risk_points
-    
-    fastest_risk_points = get_high_risk_points(fastest_route)
-    safest_risk_points = get_high_risk_points(safest_route)
-    
-    print(f"Risk reduction: {risk_reduction*100:.1f}%")
-    print(f"Time difference: {(safest_time - fastest_time)/60:.1f} minutes")
-    
-    return {
-        'fastest_route': fastest_route,
-        'safest_route': safest_route,
-        'fastest_time': fastest_time,
-        'safest_time': safest_time,
-        'fastest_risk': fastest_total_risk,
-        'safest_risk': safest_total_risk,
-        'fastest_risk_points': fastest_risk_points,
-        'safest_risk_points': safest_risk_points,
-        'time_difference': safest_time - fastest_time,
-        'risk_reduction': risk_reduction
-    }
+def supported_cities():
+    return ', '.join(city.title() for city in cached_data['networks'].cities)
 
 def generate_route_map(network, result, start_lat, start_lng, end_lat, end_lng):
     # Create base map centered between start and end
@@ -735,8 +557,11 @@ def generate_route_map(network, result, start_lat, start_lng, end_lat, end_lng):
     
     m = folium.Map(location=[center_lat, center_lng], zoom_start=12)
     
+    # Routes follow the road shapes, simplified to street-level detail
+    detail = SIMPLIFY_TOLERANCES_M[1]
+    
     # Add fastest route in red
-    fastest_coords = [(network.nodes[node]['y'], network.nodes[node]['x']) for node in result['fastest_route']]
+    fastest_coords = route_shape(network, result, 'fastest', detail)
     folium.PolyLine(
         fastest_coords, 
         color='red', 
@@ -746,7 +571,7 @@ def generate_route_map(network, result, start_lat, start_lng, end_lat, end_lng):
     ).add_to(m)
     
     # Add safest route in green
-    safest_coords = [(network.nodes[node]['y'], network.nodes[node]['x']) for node in result['safest_route']]
+    safest_coords = route_shape(network, result, 'safest', detail)
     folium.PolyLine(
         safest_coords, 
         color='green', 
@@ -852,72 +677,297 @@ def generate_route_map(network, result, start_lat, start_lng, end_lat, end_lng):
     
     return m._repr_html_()
 
+def resolve_addresses(start_address, end_address):
+    """
+    Geocode both addresses and pick the network of the city they are in.
+    Returns (network, city, (start_lat, start_lng), (end_lat, end_lng)) or
+    raises ValueError with a message for the client.
+    """
+    # Geocode both addresses at once; the geocoder rate-limits its own calls
+    print(f"Geocoding start address: {start_address}")
+    print(f"Geocoding end address: {end_address}")
+    (start_lat, start_lng), (end_lat, end_lng) = geocode_addresses(
+        geolocator, cached_data['networks'], start_address, end_address)
+    
+    if not start_lat or not start_lng:
+        raise ValueError(f'Could not find location for start address: {start_address}')
+    
+    if not end_lat or not end_lng:
+        raise ValueError(f'Could not find location for end address: {end_address}')
+    
+    # Check if in supported area
+    start_in_area, start_city = is_in_supported_area(start_lat, start_lng)
+    end_in_area, end_city = is_in_supported_area(end_lat, end_lng)
+    
+    if not start_in_area:
+        raise ValueError(f'Start address is not in a supported city ({supported_cities()}) (found coordinates: {start_lat:.4f}, {start_lng:.4f})')
+    
+    if not end_in_area:
+        raise ValueError(f'End address is not in a supported city ({supported_cities()}) (found coordinates: {end_lat:.4f}, {end_lng:.4f})')
+    
+    if start_city != end_city:
+        raise ValueError(f'Both addresses must be in the same city. Start is in {start_city.title()}, end is in {end_city.title()}')
+    
+    print(f"Calculating route in {start_city.title()} from ({start_lat:.4f}, {start_lng:.4f}) to ({end_lat:.4f}, {end_lng:.4f})")
+    
+    # Get appropriate network, with the latest risk data
+    cached_data['networks'].watch_risk()
+    network = cached_data['networks'].get(start_city)
+    
+    return network, start_city, (start_lat, start_lng), (end_lat, end_lng)
+
+RISK_WEIGHT_ERROR = f'risk_weight must be a number from 0 to {MAX_RISK_WEIGHT:g}'
+
+def parse_risk_weight(data):
+    """risk_weight of a request body (default 0.5), or None if it isn't a number from 0 to MAX_RISK_WEIGHT"""
+    try:
+        return check_risk_weight(data.get('risk_weight', 0.5))
+    except (TypeError, ValueError):
+        return None
+
 @app.route('/')
 def index():
     return render_template_string(HTML_TEMPLATE)
 
+# Response formats of /get_route: 'html' renders a folium map on the server;
+# 'polyline' and 'geojson' return just the geometry and stats for the client to draw
+RESPONSE_FORMATS = ('html', 'polyline', 'geojson')
+
 @app.route('/get_route', methods=['POST'])
 def get_route():
     try:
         data = request.json
         start_address = data.get('start', '').strip()
         end_address = data.get('end', '').strip()
-        risk_weight = data.get('risk_weight', 0.5)  # Default to balanced approach
+        risk_weight = parse_risk_weight(data)  # Default to balanced approach
+        search = data.get('search')  # Optional: 'dijkstra', 'astar', 'bidirectional' or 'hierarchy'
+        response_format = data.get('format', 'html')
+        zoom = data.get('zoom')  # Optional, for 'geojson': map zoom to simplify the routes for
         
         if not start_address or not end_address:
             return jsonify({'error': 'Please provide both start and end addresses'}), 400
         
-        # Geocode addresses with rate limiting
-        print(f"Geocoding start address: {start_address}")
-        start_lat, start_lng = get_lat_lng(start_address)
+        if risk_weight is None:
+            return jsonify({'error': RISK_WEIGHT_ERROR}), 400
         
-        if not start_lat or not start_lng:
-            return jsonify({'error': f'Could not find location for start address: {start_address}'}), 400
+        if search is not None and search not in ROUTE_SEARCHES:
+            return jsonify({'error': f'Unknown search mode: {search}'}), 400
         
-        # Small delay to respect API limits
-        time.sleep(0.1)
+        if response_format not in RESPONSE_FORMATS:
+            return jsonify({'error': f'Unknown response format: {response_format}'}), 400
         
-        print(f"Geocoding end address: {end_address}")
-        end_lat, end_lng = get_lat_lng(end_address)
+        if zoom is not None:
+            try:
+                zoom = float(zoom)
+            except (TypeError, ValueError):
+                zoom = float('nan')
+            if not np.isfinite(zoom):
+                return jsonify({'error': 'zoom must be a number'}), 400
         
-        if not end_lat or not end_lng:
-            return jsonify({'error': f'Could not find location for end address: {end_address}'}), 400
+        try:
+            network, start_city, (start_lat, start_lng), (end_lat, end_lng) = resolve_addresses(start_address, end_address)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        # Check if in supported area
-        start_in_area, start_city = is_in_supported_area(start_lat, start_lng)
-        end_in_area, end_city = is_in_supported_area(end_lat, end_lng)
+        # Calculate routes using improved method
+        result = calculate_route_improved(network, (start_lat, start_lng), (end_lat, end_lng), risk_weight, search)
+        
+        # Compact formats leave drawing to the client
+        if response_format == 'polyline':
+            return jsonify({
+                'result': route_summary(result),
+                'polylines': route_polylines(network, result),
+                'city': start_city.title()
+            })
+        if response_format == 'geojson':
+            return jsonify({
+                'result': route_summary(result),
+                'geojson': route_geojson(network, result, zoom_tolerance(zoom, start_lat) if zoom is not None else 0.0),
+                'city': start_city.title()
+            })
         
-        if not start_in_area:
-            return jsonify({'error': f'Start address is not in Leeds or Birmingham (found coordinates: {start_lat:.4f}, {start_lng:.4f})'}), 400
+        # Generate map
+        map_html = generate_route_map(network, result, start_lat, start_lng, end_lat, end_lng)
         
-        if not end_in_area:
-            return jsonify({'error': f'End address is not in Leeds or Birmingham (found coordinates: {end_lat:.4f}, {end_lng:.4f})'}), 400
+        return jsonify({
+            'result': result,
+            'map_html': map_html,
+            'city': start_city.title()
+        })
+        
+    except Exception as e:
+        print(f"Error in get_route: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': f'An unexpected error occurred: {str(e)}'}), 500
+
+@app.route('/routes/batch', methods=['POST'])
+def routes_batch():
+    """
+    Routes for many coordinate pairs in one call, without geocoding or maps:
+    {"pairs": [[[lat, lng], [lat, lng]], ...], "risk_weight": 0.5}. Streams one
+    JSON object per line as each pair is done, tagged with its index in pairs.
+    """
+    data = request.json or {}
+    search = data.get('search')
+    try:
+        pairs = np.asarray(data.get('pairs', []), dtype=float).reshape(-1, 2, 2)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Please provide pairs as a list of [[lat, lng], [lat, lng]]'}), 400
+    
+    # Checked here: once streaming starts, errors can only go in the stream
+    risk_weight = parse_risk_weight(data)
+    if risk_weight is None:
+        return jsonify({'error': RISK_WEIGHT_ERROR}), 400
+    
+    if not len(pairs):
+        return jsonify({'error': 'Please provide at least one pair'}), 400
+    
+    if len(pairs) > ROUTE_BATCH_MAX_PAIRS:
+        return jsonify({'error': f'At most {ROUTE_BATCH_MAX_PAIRS} pairs per batch'}), 400
+    
+    if search is not None and search not in ROUTE_SEARCHES:
+        return jsonify({'error': f'Unknown search mode: {search}'}), 400
+    
+    cached_data['networks'].watch_risk()
+    
+    def generate():
+        try:
+            for item in route_batch(cached_data['networks'], pairs, risk_weight, search):
+                yield json.dumps(item) + '\n'
+        except Exception as e:
+            # Headers are already sent, so the failure goes in the stream
+            print(f"Error in routes_batch: {e}")
+            yield json.dumps({'error': f'An unexpected error occurred: {str(e)}'}) + '\n'
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/routes/matrix', methods=['POST'])
+def routes_matrix():
+    """
+    Travel time and risk from every origin to every destination in one city:
+    {"origins": [[lat, lng], ...], "destinations": [[lat, lng], ...], "risk_weight": 0.5}.
+    destinations defaults to origins. Each matrix is a list of rows, one per
+    origin, with null where there is no route.
+    """
+    data = request.json or {}
+    search = data.get('search')
+    try:
+        origins = np.asarray(data.get('origins', []), dtype=float).reshape(-1, 2)
+        destinations = np.asarray(data.get('destinations', origins), dtype=float).reshape(-1, 2)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Please provide origins and destinations as lists of [lat, lng] pairs'}), 400
+    
+    risk_weight = parse_risk_weight(data)
+    if risk_weight is None:
+        return jsonify({'error': RISK_WEIGHT_ERROR}), 400
+    
+    if not len(origins) or not len(destinations):
+        return jsonify({'error': 'Please provide at least one origin and one destination'}), 400
+    
+    if max(len(origins), len(destinations)) > MATRIX_MAX_POINTS:
+        return jsonify({'error': f'At most {MATRIX_MAX_POINTS} origins and {MATRIX_MAX_POINTS} destinations per matrix'}), 400
+    
+    if search is not None and search not in ROUTE_SEARCHES:
+        return jsonify({'error': f'Unknown search mode: {search}'}), 400
+    
+    points = np.concatenate([origins, destinations])
+    cities = set(cached_data['networks'].locate_many(points[:, 0], points[:, 1]))
+    if None in cities:
+        return jsonify({'error': 'Every point must be in a supported city'}), 400
+    if len(cities) > 1:
+        return jsonify({'error': f'All points must be in the same city, not {" and ".join(sorted(city.title() for city in cities))}'}), 400
+    city = cities.pop()
+    
+    cached_data['networks'].watch_risk()
+    
+    try:
+        matrices = travel_matrix(cached_data['networks'].get(city), origins, destinations, risk_weight, search)
+    except Exception as e:
+        print(f"Error in routes_matrix: {e}")
+        return jsonify({'error': f'An unexpected error occurred: {str(e)}'}), 500
+    
+    # JSON has no infinity, so missing routes become null
+    result = {name: np.where(np.isfinite(matrix), matrix, None).tolist() for name, matrix in matrices.items()}
+    result.update({'city': city.title(), 'risk_weight': risk_weight})
+    return jsonify(result)
+
+@app.route('/risk', methods=['POST'])
+def get_risk():
+    """Crash risk at a batch of points: {"points": [[lat, lng], ...]}"""
+    try:
+        points = request.json.get('points', [])
+        coords = np.asarray(points, dtype=float).reshape(-1, 2)
+    except (AttributeError, TypeError, ValueError):
+        return jsonify({'error': 'Please provide points as a list of [lat, lng] pairs'}), 400
+    
+    grid = cached_data['risk'].grid
+    crash_risk = grid.lookup(coords[:, 0], coords[:, 1])
+    return jsonify({
+        'crash_risk': crash_risk.tolist(),
+        'normalized_risk': grid.normalize(crash_risk).tolist()
+    })
+
+def refresh_risk_if_changed(force=False):
+    """Swap in new risk scores now if the risk files on disk were replaced"""
+    if cached_data['risk'].poll(force):
+        return cached_data['networks'].refresh_risk()
+    return None
+
+@app.route('/admin/refresh_risk', methods=['POST'])
+def refresh_risk():
+    """
+    Pick up replaced risk files now instead of at the next poll. Only this
+    worker refreshes immediately; the others follow within RISK_POLL_SECONDS.
+    """
+    admin_token = os.getenv('ADMIN_TOKEN')
+    if not admin_token or request.headers.get('X-Admin-Token') != admin_token:
+        return jsonify({'error': 'Not authorised'}), 403
+    
+    changed = refresh_risk_if_changed(force=True)
+    return jsonify({
+        'refreshed': changed is not None,
+        'edges_changed': changed or {},
+        'risk_version': cached_data['networks'].risk_version
+    })
+
+@app.route('/get_pareto_routes', methods=['POST'])
+def get_pareto_routes():
+    """
+    All time/risk trade-off routes between two addresses, so the client can pick
+    a point on the frontier without another request per slider position.
+    """
+    try:
+        data = request.json
+        start_address = data.get('start', '').strip()
+        end_address = data.get('end', '').strip()
+        search = data.get('search')
         
-        if start_city != end_city:
-            return jsonify({'error': f'Both addresses must be in the same city. Start is in {start_city.title()}, end is in {end_city.title()}'}), 400
+        if not start_address or not end_address:
+            return jsonify({'error': 'Please provide both start and end addresses'}), 400
         
-        print(f"Calculating route in {start_city.title()} from ({start_lat:.4f}, {start_lng:.4f}) to ({end_lat:.4f}, {end_lng:.4f})")
+        if search is not None and search not in ROUTE_SEARCHES:
+            return jsonify({'error': f'Unknown search mode: {search}'}), 400
         
-        # Get appropriate network
-        if start_city == 'leeds':
-            network = cached_data['leeds_network']
-        else:
-            network = cached_data['birmingham_network']
+        try:
+            network, start_city, start, end = resolve_addresses(start_address, end_address)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        # Calculate routes using improved method
-        result = calculate_route_improved(network, (start_lat, start_lng), (end_lat, end_lng), risk_weight)
+        result = pareto_routes(network, start, end, search=search)
         
-        # Generate map
-        map_html = generate_route_map(network, result, start_lat, start_lng, end_lat, end_lng)
+        # Shapes of every route so switching between them needs no round trip
+        for route in result['routes']:
+            route['coords'] = network.route_geometry(route, result['start_point'], result['end_point'],
+                                                     SIMPLIFY_TOLERANCES_M[1])
         
         return jsonify({
             'result': result,
-            'map_html': map_html,
             'city': start_city.title()
         })
         
     except Exception as e:
-        print(f"Error in get_route: {e}")
+        print(f"Error in get_pareto_routes: {e}")
         import traceback
         traceback.print_exc()
         return jsonify({'error': f'An unexpected error occurred: {str(e)}'}), 500
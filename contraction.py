@@ -0,0 +1,731 @@
+import heapq
+import math
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+# Settled-node budget for witness searches while contracting. A search that
+# gives up early only costs an unnecessary shortcut, never a wrong answer.
+WITNESS_LIMIT = 60
+
+# Cells at or below this many nodes are not dissected further when ordering
+# a customizable hierarchy
+LEAF_SIZE = 4
+# Customised metrics kept per customizable hierarchy (one per risk_weight in use)
+METRIC_CACHE_SIZE = 8
+
+
+class ContractionHierarchy:
+    """
+    Contraction Hierarchy for one fixed edge metric of a RouteNetwork.
+
+    Every node has a rank; arcs are the original edges plus the shortcuts
+    added while contracting nodes in rank order. A shortcut u->w via v is
+    stored with the two arcs it replaces (first, second) so paths can be
+    unpacked back to original edges. Queries run two upward Dijkstra searches
+    and meet at the highest-ranked node of the shortest path.
+    """
+
+    def __init__(self, rank, arc_src, arc_dst, arc_weight, arc_edge, arc_first, arc_second,
+                 fingerprint=''):
+        self.rank = np.asarray(rank, dtype=np.int64)
+        self.arc_src = np.asarray(arc_src, dtype=np.int64)
+        self.arc_dst = np.asarray(arc_dst, dtype=np.int64)
+        self.arc_weight = np.asarray(arc_weight, dtype=np.float64)
+        self.arc_edge = np.asarray(arc_edge, dtype=np.int64)
+        self.arc_first = np.asarray(arc_first, dtype=np.int64)
+        self.arc_second = np.asarray(arc_second, dtype=np.int64)
+        self.fingerprint = str(fingerprint)
+        self._lists = None
+
+    @property
+    def num_shortcuts(self):
+        return int((self.arc_edge < 0).sum())
+
+    def save(self, path):
+        np.savez_compressed(
+            path, rank=self.rank, arc_src=self.arc_src, arc_dst=self.arc_dst,
+            arc_weight=self.arc_weight, arc_edge=self.arc_edge,
+            arc_first=self.arc_first, arc_second=self.arc_second,
+            fingerprint=np.array(self.fingerprint),
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['rank'], data['arc_src'], data['arc_dst'], data['arc_weight'],
+                       data['arc_edge'], data['arc_first'], data['arc_second'],
+                       fingerprint=data['fingerprint'].item())
+
+    def _query_lists(self):
+        """Upward and downward search graphs as Python lists, built on first query"""
+        if self._lists is None:
+            n = len(self.rank)
+            upward = self.rank[self.arc_src] < self.rank[self.arc_dst]
+            # Arcs a metric leaves unusable (e.g. a one-way street's reverse) are skipped
+            usable = np.isfinite(self.arc_weight)
+
+            def grouped(arcs, tails, heads):
+                # CSR over tails: arcs leaving each node in the search direction
+                order = np.argsort(tails[arcs], kind='stable')
+                arcs = arcs[order]
+                counts = np.bincount(tails[arcs], minlength=n)
+                offsets = np.concatenate(([0], np.cumsum(counts)))
+                return (offsets.tolist(), heads[arcs].tolist(),
+                        self.arc_weight[arcs].tolist(), arcs.tolist())
+
+            # Forward search climbs arcs u->v with rank[u] < rank[v]; the backward
+            # search climbs arcs u->v with rank[u] > rank[v] from v towards u
+            self._lists = (
+                grouped(np.flatnonzero(upward & usable), self.arc_src, self.arc_dst),
+                grouped(np.flatnonzero(~upward & usable), self.arc_dst, self.arc_src),
+            )
+        return self._lists
+
+    def search(self, starts, ends):
+        """
+        Shortest path between seed sets, in the format of RouteNetwork searches.
+        starts and ends are (node, cost, edge, fraction, position) tuples as
+        produced by RouteNetwork._snap_ends.
+        """
+        forward, backward = self._query_lists()
+
+        def seed(items):
+            dist, parent, heap = {}, {}, []
+            for node, cost, edge, fraction, _ in items:
+                if cost < dist.get(node, math.inf):
+                    dist[node] = cost
+                    parent[node] = (-1, edge, fraction)
+                    heapq.heappush(heap, (cost, node))
+            return dist, parent, heap
+
+        dist_f, parent_f, heap_f = seed(starts)
+        dist_b, parent_b, heap_b = seed(ends)
+        # Each side stalls on the other side's graph: arcs coming down into a node
+        sides = ((forward, backward, dist_f, parent_f, heap_f, dist_b),
+                 (backward, forward, dist_b, parent_b, heap_b, dist_f))
+
+        best_cost, meet, settled = math.inf, -1, 0
+        for node in dist_f.keys() & dist_b.keys():
+            if dist_f[node] + dist_b[node] < best_cost:
+                best_cost, meet = dist_f[node] + dist_b[node], node
+
+        # Both searches only climb, so each runs until its queue passes the best meeting
+        while True:
+            active = [side for side in sides if side[4] and side[4][0][0] < best_cost]
+            if not active:
+                break
+            graph, stall_graph, dist, parent, heap, other = min(active, key=lambda side: side[4][0][0])
+            offsets, heads, weights, arcs = graph
+
+            d, node = heapq.heappop(heap)
+            if d > dist[node]:
+                continue
+            settled += 1
+            if node in other and d + other[node] < best_cost:
+                best_cost, meet = d + other[node], node
+
+            # Stall-on-demand: a higher node already reaches this one more cheaply,
+            # so nothing found by climbing from here can be on a shortest path
+            stall_offsets, stall_heads, stall_weights, _ = stall_graph
+            if any(dist.get(stall_heads[i], math.inf) + stall_weights[i] < d
+                   for i in range(stall_offsets[node], stall_offsets[node + 1])):
+                continue
+
+            for i in range(offsets[node], offsets[node + 1]):
+                nxt = heads[i]
+                nd = d + weights[i]
+                if nd < dist.get(nxt, math.inf):
+                    dist[nxt] = nd
+                    parent[nxt] = (node, arcs[i], None)
+                    heapq.heappush(heap, (nd, nxt))
+
+        if meet < 0:
+            return None
+
+        # Arc chains on both sides of the meeting node, in travel order
+        up_arcs, node = [], meet
+        while parent_f[node][0] >= 0:
+            node, arc, _ = parent_f[node]
+            up_arcs.append(arc)
+        _, start_edge, start_fraction = parent_f[node]
+        up_arcs.reverse()
+
+        down_arcs, node = [], meet
+        while parent_b[node][0] >= 0:
+            node, arc, _ = parent_b[node]
+            down_arcs.append(arc)
+        _, end_edge, end_fraction = parent_b[node]
+
+        arcs = self.unpack(up_arcs + down_arcs)
+        path = [int(self.arc_src[arcs[0]])] + self.arc_dst[arcs].tolist() if arcs else [meet]
+        return {
+            'path': path,
+            'edges': self.arc_edge[arcs].tolist(),
+            'legs': [(start_edge, start_fraction), (end_edge, end_fraction)],
+            'cost': best_cost,
+            'settled': settled,
+        }
+
+    def unpack(self, arcs):
+        """Expand a chain of hierarchy arcs into the original-edge arcs it stands for"""
+        unpacked = []
+        stack = list(reversed(arcs))
+        while stack:
+            arc = stack.pop()
+            if self.arc_edge[arc] >= 0:
+                unpacked.append(arc)
+            else:
+                stack.append(self.arc_second[arc])
+                stack.append(self.arc_first[arc])
+        return unpacked
+
+    def arc_sums(self, values):
+        """Sum of a per-edge value over the original edges behind each arc (NaN for unusable arcs)"""
+        sums = np.full(len(self.arc_edge), np.nan)
+        original = self.arc_edge >= 0
+        sums[original] = np.asarray(values, dtype=np.float64)[self.arc_edge[original]]
+        # Shortcuts add up their two halves, level by level of nesting
+        pending = np.flatnonzero(~original & (self.arc_first >= 0))
+        while len(pending):
+            parts = sums[self.arc_first[pending]] + sums[self.arc_second[pending]]
+            ready = ~np.isnan(parts)
+            if not ready.any():
+                break
+            sums[pending[ready]] = parts[ready]
+            pending = pending[~ready]
+        return sums
+
+    def _upward_space(self, seeds, graph, stall_graph, arc_values):
+        """
+        Nodes an upward search from seeds settles without stalling, with their
+        distances and value sums. seeds are (node, cost, sums) tuples.
+        """
+        offsets, heads, weights, arcs = graph
+        stall_offsets, stall_heads, stall_weights, _ = stall_graph
+        dist, sums, heap = {}, {}, []
+        for node, cost, leg in seeds:
+            if cost < dist.get(node, math.inf):
+                dist[node] = cost
+                sums[node] = leg
+                heapq.heappush(heap, (cost, node))
+
+        settled = []
+        while heap:
+            d, node = heapq.heappop(heap)
+            if d > dist[node]:
+                continue
+            if any(dist.get(stall_heads[i], math.inf) + stall_weights[i] < d
+                   for i in range(stall_offsets[node], stall_offsets[node + 1])):
+                continue
+            settled.append(node)
+            for i in range(offsets[node], offsets[node + 1]):
+                nxt = heads[i]
+                nd = d + weights[i]
+                if nd < dist.get(nxt, math.inf):
+                    dist[nxt] = nd
+                    sums[nxt] = tuple(total + values[arcs[i]] for total, values in zip(sums[node], arc_values))
+                    heapq.heappush(heap, (nd, nxt))
+        return settled, [dist[node] for node in settled], [sums[node] for node in settled]
+
+    def many_to_many(self, sources, targets, values):
+        """
+        Bucket-based many-to-many search: costs, and sums of each per-edge
+        vector in values, of the shortest paths from every seed set in sources
+        to every seed set in targets. Seed sets are lists of (node, cost, sums)
+        tuples, sums being what a partial first or last edge adds. One
+        backward upward search per target leaves (target, cost, sums) in a
+        bucket at each node it settles; one forward upward search per source
+        then scans the buckets of the nodes it settles, so every pair meets at
+        the top of its shortest path. Returns ((sources, targets) cost array,
+        inf where unreachable, [sums array per value]).
+        """
+        forward, backward = self._query_lists()
+        arc_values = [self.arc_sums(value).tolist() for value in values]
+        k = len(values)
+
+        bucket_node, bucket_target, bucket_cost, bucket_sums = [], [], [], []
+        for j, seeds in enumerate(targets):
+            nodes, costs, sums = self._upward_space(seeds, backward, forward, arc_values)
+            bucket_node.extend(nodes)
+            bucket_target.extend([j] * len(nodes))
+            bucket_cost.extend(costs)
+            bucket_sums.extend(sums)
+        order = np.argsort(np.asarray(bucket_node, dtype=np.int64), kind='stable')
+        bucket_node = np.asarray(bucket_node, dtype=np.int64)[order]
+        bucket_target = np.asarray(bucket_target, dtype=np.int64)[order]
+        bucket_cost = np.asarray(bucket_cost, dtype=np.float64)[order]
+        bucket_sums = np.asarray(bucket_sums, dtype=np.float64).reshape(-1, k)[order]
+
+        cost = np.full((len(sources), len(targets)), np.inf)
+        sums = np.zeros((len(sources), len(targets), k))
+        for i, seeds in enumerate(sources):
+            nodes, costs, node_sums = self._upward_space(seeds, forward, backward, arc_values)
+            nodes = np.asarray(nodes, dtype=np.int64)
+            low = np.searchsorted(bucket_node, nodes, side='left')
+            counts = np.searchsorted(bucket_node, nodes, side='right') - low
+            if not counts.sum():
+                continue
+            # Every (settled node, bucket entry) meeting, then the cheapest per target
+            which = np.repeat(np.arange(len(nodes)), counts)
+            at = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + low[which]
+            meet = np.asarray(costs)[which] + bucket_cost[at]
+            target = bucket_target[at]
+            order = np.lexsort((meet, target))
+            first = order[np.unique(target[order], return_index=True)[1]]
+            cost[i, target[first]] = meet[first]
+            sums[i, target[first]] = np.asarray(node_sums).reshape(-1, k)[which[first]] + bucket_sums[at[first]]
+        return cost, [sums[:, :, v] for v in range(k)]
+
+
+class CustomizableHierarchy:
+    """
+    Metric-independent Contraction Hierarchy (CCH) of a RouteNetwork.
+
+    The node order comes from nested dissection of the road map alone, and
+    arcs are the undirected fill-in of contracting in that order, so the same
+    topology serves every weight vector. customize() turns a weight vector
+    into a ContractionHierarchy in a few vectorised passes over the lower
+    triangles of each arc; metric() caches that per weight vector, i.e. per
+    risk_weight in use.
+
+    Arc i joins arc_low[i] to arc_high[i] (rank[arc_low] < rank[arc_high]).
+    Triangle t is a node v below both ends of arc tri_top[t] = (u, w), reached
+    through arcs tri_low[t] = (v, u) and tri_high[t] = (v, w). Triangles are
+    grouped by the elimination level of v so that each group only reads arcs
+    finished by earlier groups.
+    """
+
+    def __init__(self, rank, arc_low, arc_high, edge_arc, edge_upward,
+                 tri_low, tri_high, tri_top, level_offsets, fingerprint=''):
+        self.rank = np.asarray(rank, dtype=np.int64)
+        self.arc_low = np.asarray(arc_low, dtype=np.int64)
+        self.arc_high = np.asarray(arc_high, dtype=np.int64)
+        self.edge_arc = np.asarray(edge_arc, dtype=np.int64)
+        self.edge_upward = np.asarray(edge_upward, dtype=bool)
+        self.tri_low = np.asarray(tri_low, dtype=np.int64)
+        self.tri_high = np.asarray(tri_high, dtype=np.int64)
+        self.tri_top = np.asarray(tri_top, dtype=np.int64)
+        self.level_offsets = np.asarray(level_offsets, dtype=np.int64)
+        self.fingerprint = str(fingerprint)
+        self._metrics = OrderedDict()
+        # metric() is called from request threads
+        self._metrics_lock = threading.Lock()
+
+    @property
+    def num_arcs(self):
+        return len(self.arc_low)
+
+    @property
+    def num_triangles(self):
+        return len(self.tri_top)
+
+    def save(self, path):
+        np.savez_compressed(
+            path, rank=self.rank, arc_low=self.arc_low, arc_high=self.arc_high,
+            edge_arc=self.edge_arc, edge_upward=self.edge_upward,
+            tri_low=self.tri_low, tri_high=self.tri_high, tri_top=self.tri_top,
+            level_offsets=self.level_offsets, fingerprint=np.array(self.fingerprint),
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['rank'], data['arc_low'], data['arc_high'], data['edge_arc'],
+                       data['edge_upward'], data['tri_low'], data['tri_high'], data['tri_top'],
+                       data['level_offsets'], fingerprint=data['fingerprint'].item())
+
+    def metric(self, weights):
+        """Customised hierarchy for a weight vector, cached by identity like RouteNetwork weight lists"""
+        key = id(weights)
+        with self._metrics_lock:
+            cached = self._metrics.get(key)
+            if cached is not None and cached[0] is weights:
+                self._metrics.move_to_end(key)
+                return cached[1]
+        # Customising takes a while, so other metrics aren't held up meanwhile
+        cached = (weights, self.customize(weights))
+        with self._metrics_lock:
+            self._metrics[key] = cached
+            self._metrics.move_to_end(key)
+            while len(self._metrics) > METRIC_CACHE_SIZE:
+                self._metrics.popitem(last=False)
+        return cached[1]
+
+    def customize(self, weights):
+        """Apply a per-edge weight vector to the topology, returning a queryable ContractionHierarchy"""
+        weights = np.asarray(weights, dtype=np.float64)
+        m = self.num_arcs
+
+        # Original edges: the cheapest of any parallel edges in each direction of an arc
+        up, down = np.full(m, np.inf), np.full(m, np.inf)
+        up_edge, down_edge = np.full(m, -1, dtype=np.int64), np.full(m, -1, dtype=np.int64)
+        for upward, cost, edge_of in ((True, up, up_edge), (False, down, down_edge)):
+            edges = np.flatnonzero((self.edge_arc >= 0) & (self.edge_upward == upward))
+            edges = edges[np.lexsort((weights[edges], self.edge_arc[edges]))]
+            arcs, first = np.unique(self.edge_arc[edges], return_index=True)
+            cost[arcs] = weights[edges[first]]
+            edge_of[arcs] = edges[first]
+
+        # Lower-triangle relaxation, one elimination level at a time. Going up
+        # u -> w via v is u -> v (down along arc v-u) then v -> w (up along v-w).
+        up_via, down_via = np.full(m, -1, dtype=np.int64), np.full(m, -1, dtype=np.int64)
+        for level in range(len(self.level_offsets) - 1):
+            start, stop = self.level_offsets[level], self.level_offsets[level + 1]
+            low, high, top = self.tri_low[start:stop], self.tri_high[start:stop], self.tri_top[start:stop]
+            ids = np.arange(start, stop)
+            for cost, via, candidate in ((up, up_via, down[low] + up[high]),
+                                         (down, down_via, down[high] + up[low])):
+                before = cost[top]
+                np.minimum.at(cost, top, candidate)
+                better = (candidate < before) & (candidate == cost[top])
+                via[top[better]] = ids[better]
+
+        # Directed arcs: 2 * i climbs arc i, 2 * i + 1 descends it
+        arc_src = np.empty(2 * m, dtype=np.int64)
+        arc_dst = np.empty(2 * m, dtype=np.int64)
+        arc_src[0::2], arc_dst[0::2] = self.arc_low, self.arc_high
+        arc_src[1::2], arc_dst[1::2] = self.arc_high, self.arc_low
+        arc_weight = np.empty(2 * m)
+        arc_weight[0::2], arc_weight[1::2] = up, down
+        arc_edge = np.empty(2 * m, dtype=np.int64)
+        arc_edge[0::2] = np.where(up_via >= 0, -1, up_edge)
+        arc_edge[1::2] = np.where(down_via >= 0, -1, down_edge)
+
+        arc_first = np.full(2 * m, -1, dtype=np.int64)
+        arc_second = np.full(2 * m, -1, dtype=np.int64)
+        shortcut = np.flatnonzero(up_via >= 0)
+        t = up_via[shortcut]
+        arc_first[2 * shortcut] = 2 * self.tri_low[t] + 1
+        arc_second[2 * shortcut] = 2 * self.tri_high[t]
+        shortcut = np.flatnonzero(down_via >= 0)
+        t = down_via[shortcut]
+        arc_first[2 * shortcut + 1] = 2 * self.tri_high[t] + 1
+        arc_second[2 * shortcut + 1] = 2 * self.tri_low[t]
+
+        return ContractionHierarchy(self.rank, arc_src, arc_dst, arc_weight, arc_edge,
+                                    arc_first, arc_second, fingerprint=self.fingerprint)
+
+
+def dissection_order(network, leaf_size=LEAF_SIZE):
+    """
+    Nested dissection by recursive coordinate bisection: split each cell at the
+    median of its longer axis, take the smaller boundary of the cut as the
+    separator, order both halves first and the separator last.
+    """
+    n = network.num_nodes
+    x = network.lng * math.cos(math.radians(float(np.mean(network.lat)))) if n else network.lng
+    y = network.lat
+    loops = network.sources == network.targets
+    side = np.zeros(n, dtype=np.int8)
+    order = []
+
+    def dissect(nodes, src, dst):
+        if len(nodes) <= leaf_size:
+            order.extend(nodes.tolist())
+            return
+        xs, ys = x[nodes], y[nodes]
+        coord = xs if np.ptp(xs) >= np.ptp(ys) else ys
+        by_coord = np.argsort(coord, kind='stable')
+        left, right = nodes[by_coord[:len(nodes) // 2]], nodes[by_coord[len(nodes) // 2:]]
+        side[left], side[right] = 0, 1
+
+        cut = side[src] != side[dst]
+        left_boundary = np.unique(np.where(side[src[cut]] == 0, src[cut], dst[cut]))
+        right_boundary = np.unique(np.where(side[src[cut]] == 1, src[cut], dst[cut]))
+        separator = left_boundary if len(left_boundary) <= len(right_boundary) else right_boundary
+        side[separator] = 2
+
+        parts = []
+        for part, label in ((left, 0), (right, 1)):
+            inside = (side[src] == label) & (side[dst] == label)
+            parts.append((part[side[part] == label], src[inside], dst[inside]))
+        for part in parts:
+            dissect(*part)
+        order.extend(separator.tolist())
+
+    dissect(np.arange(n), network.sources[~loops], network.targets[~loops])
+    rank = np.empty(n, dtype=np.int64)
+    rank[np.asarray(order, dtype=np.int64)] = np.arange(n)
+    return rank
+
+
+def build_customizable(network, leaf_size=LEAF_SIZE, verbose=True):
+    """
+    Metric-independent preprocessing for a CustomizableHierarchy. Like
+    build_hierarchy this is an offline step, but it only depends on the road
+    layout, so it survives risk and speed updates.
+    """
+    started = time.time()
+    n = network.num_nodes
+    rank = dissection_order(network, leaf_size)
+
+    # Undirected contraction in rank order: the upper neighbours of each
+    # contracted node become a clique, which it is enough to attach to the
+    # lowest of them (the rest of the clique follows when that one goes)
+    upper = [set() for _ in range(n)]
+    rank_list = rank.tolist()
+    for u, v in zip(network.sources.tolist(), network.targets.tolist()):
+        if u != v:
+            if rank_list[u] < rank_list[v]:
+                upper[u].add(v)
+            else:
+                upper[v].add(u)
+    by_rank = np.argsort(rank).tolist()
+    for v in by_rank:
+        if len(upper[v]) > 1:
+            lowest = min(upper[v], key=rank_list.__getitem__)
+            upper[lowest] |= upper[v] - {lowest}
+
+    arc_low, arc_high, arc_of = [], [], [dict() for _ in range(n)]
+    for v in by_rank:
+        for u in sorted(upper[v], key=rank_list.__getitem__):
+            arc_of[v][u] = len(arc_low)
+            arc_low.append(v)
+            arc_high.append(u)
+
+    # Lower triangles, tagged with the elimination level of their bottom node
+    level = [0] * n
+    tri_low, tri_high, tri_top, tri_level = [], [], [], []
+    for v in by_rank:
+        above = list(arc_of[v].items())
+        for i, (u, low) in enumerate(above):
+            level[u] = max(level[u], level[v] + 1)
+            tops = arc_of[u]
+            for w, high in above[i + 1:]:
+                tri_low.append(low)
+                tri_high.append(high)
+                tri_top.append(tops[w])
+                tri_level.append(level[v])
+
+    tri_level = np.asarray(tri_level, dtype=np.int64)
+    by_level = np.argsort(tri_level, kind='stable')
+    counts = np.bincount(tri_level, minlength=1)
+    level_offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    # Which arc, and which direction of it, each original edge belongs to
+    edge_arc = np.full(network.num_edges, -1, dtype=np.int64)
+    edge_upward = np.zeros(network.num_edges, dtype=bool)
+    for e, (u, v) in enumerate(zip(network.sources.tolist(), network.targets.tolist())):
+        if u != v:
+            if rank_list[u] < rank_list[v]:
+                edge_arc[e], edge_upward[e] = arc_of[u][v], True
+            else:
+                edge_arc[e] = arc_of[v][u]
+
+    hierarchy = CustomizableHierarchy(
+        rank, arc_low, arc_high, edge_arc, edge_upward,
+        np.asarray(tri_low, dtype=np.int64)[by_level], np.asarray(tri_high, dtype=np.int64)[by_level],
+        np.asarray(tri_top, dtype=np.int64)[by_level], level_offsets,
+        fingerprint=network.fingerprint(),
+    )
+    if verbose:
+        print(f"Customizable hierarchy: {n} nodes, {hierarchy.num_arcs} arcs, "
+              f"{hierarchy.num_triangles} triangles in {time.time() - started:.1f}s")
+    return hierarchy
+
+
+def build_hierarchy(network, weights, witness_limit=WITNESS_LIMIT, verbose=True):
+    """
+    Contract every node of a RouteNetwork under a fixed per-edge weight vector.
+    This is an offline step: it takes seconds for a small town and minutes for
+    a city, and the result should be saved and loaded at startup.
+    """
+    n = network.num_nodes
+    weights = np.asarray(weights, dtype=np.float64)
+
+    arc_src, arc_dst, arc_weight, arc_edge, arc_first, arc_second = [], [], [], [], [], []
+    # Number of original edges each arc stands for
+    arc_originals = []
+    out_adj = [dict() for _ in range(n)]
+    in_adj = [dict() for _ in range(n)]
+
+    def add_arc(u, w, cost, edge, first, second):
+        arc_src.append(u)
+        arc_dst.append(w)
+        arc_weight.append(cost)
+        arc_edge.append(edge)
+        arc_first.append(first)
+        arc_second.append(second)
+        arc_originals.append(1 if edge >= 0 else arc_originals[first] + arc_originals[second])
+        arc = len(arc_src) - 1
+        out_adj[u][w] = arc
+        in_adj[w][u] = arc
+        return arc
+
+    # Original edges, keeping only the cheapest of any parallel edges
+    sources = network.sources.tolist()
+    targets = network.targets.tolist()
+    costs = weights.tolist()
+    for e in np.argsort(weights, kind='stable').tolist():
+        u, v = sources[e], targets[e]
+        if u != v and v not in out_adj[u]:
+            add_arc(u, v, costs[e], e, -1, -1)
+
+    contracted = [False] * n
+    deleted_neighbours = [0] * n
+
+    def witness_distances(source, avoid, max_cost, targets):
+        """
+        Bounded Dijkstra over the remaining graph, skipping the node being
+        contracted. Nodes beyond max_cost can't be witnesses and are never queued.
+        """
+        dist = {source: 0.0}
+        heap = [(0.0, source)]
+        settled = 0
+        remaining = len(targets)
+        while heap and settled < witness_limit and remaining:
+            d, node = heapq.heappop(heap)
+            if d > dist[node]:
+                continue
+            if d > max_cost:
+                break
+            settled += 1
+            if node in targets:
+                remaining -= 1
+            for nxt, arc in out_adj[node].items():
+                if nxt == avoid:
+                    continue
+                nd = d + arc_weight[arc]
+                if nd <= max_cost and nd < dist.get(nxt, math.inf):
+                    dist[nxt] = nd
+                    heapq.heappush(heap, (nd, nxt))
+        return dist
+
+    def needed_shortcuts(v):
+        shortcuts = []
+        outs = [(w, arc, arc_weight[arc]) for w, arc in out_adj[v].items()]
+        if not outs:
+            return shortcuts
+        for u, in_arc in in_adj[v].items():
+            in_cost = arc_weight[in_arc]
+            onward = [cost for w, _, cost in outs if w != u]
+            if not onward:
+                continue
+            dist = witness_distances(u, v, in_cost + max(onward), {w for w, _, _ in outs if w != u})
+            for w, out_arc, out_cost in outs:
+                if w == u:
+                    continue
+                cost = in_cost + out_cost
+                if dist.get(w, math.inf) > cost:
+                    shortcuts.append((u, w, cost, in_arc, out_arc))
+        return shortcuts
+
+    def evaluate(v):
+        """Contraction priority of v (lower goes first) and the shortcuts it would need"""
+        shortcuts = needed_shortcuts(v)
+        removed = list(in_adj[v].values()) + list(out_adj[v].values())
+        edge_difference = len(shortcuts) - len(removed)
+        # Original edges the new shortcuts would stand for, against those removed,
+        # keeps long shortcuts from piling up in a dense core
+        original_difference = (sum(arc_originals[first] + arc_originals[second]
+                                   for _, _, _, first, second in shortcuts)
+                               - sum(arc_originals[arc] for arc in removed))
+        difference[v] = 2 * edge_difference + original_difference
+        # Contracted-neighbour and depth terms spread contraction evenly over the map
+        return difference[v] + deleted_neighbours[v] + depth[v], shortcuts
+
+    started = time.time()
+    depth = [0] * n
+    difference = [0] * n
+    current = [evaluate(v)[0] for v in range(n)]
+    heap = [(current[v], v) for v in range(n)]
+    heapq.heapify(heap)
+    rank = np.zeros(n, dtype=np.int64)
+    next_rank = 0
+
+    while heap:
+        queued, v = heapq.heappop(heap)
+        if contracted[v] or queued != current[v]:
+            continue
+        # Lazy update: re-evaluate, and defer if the node is no longer the cheapest
+        current[v], shortcuts = evaluate(v)
+        if heap and current[v] > heap[0][0]:
+            heapq.heappush(heap, (current[v], v))
+            continue
+
+        for u, w, cost, first, second in shortcuts:
+            existing = out_adj[u].get(w)
+            if existing is None or cost < arc_weight[existing]:
+                add_arc(u, w, cost, -1, first, second)
+
+        contracted[v] = True
+        rank[v] = next_rank
+        next_rank += 1
+        neighbours = set(in_adj[v]) | set(out_adj[v])
+        for u in in_adj[v]:
+            del out_adj[u][v]
+        for w in out_adj[v]:
+            del in_adj[w][v]
+        # Arcs of v stay in the arc list; only the remaining graph forgets them
+        out_adj[v] = {}
+        in_adj[v] = {}
+
+        # Neighbours only get their cheap terms updated. Re-running their witness
+        # searches after every contraction made the build quadratic; the lazy
+        # update above still re-evaluates each node before it is contracted.
+        for x in neighbours:
+            deleted_neighbours[x] += 1
+            depth[x] = max(depth[x], depth[v] + 1)
+            current[x] = difference[x] + deleted_neighbours[x] + depth[x]
+            heapq.heappush(heap, (current[x], x))
+
+        if verbose and next_rank % 10000 == 0:
+            print(f"Contracted {next_rank}/{n} nodes, {len(arc_src)} arcs ({time.time() - started:.0f}s)")
+
+    hierarchy = ContractionHierarchy(rank, arc_src, arc_dst, arc_weight, arc_edge,
+                                     arc_first, arc_second, fingerprint=network.fingerprint())
+    if verbose:
+        print(f"Contraction finished: {n} nodes, {hierarchy.num_shortcuts} shortcuts "
+              f"in {time.time() - started:.1f}s")
+    return hierarchy
+
+
+def hierarchy_path(city, data_dir='data'):
+    return os.path.join(data_dir, f'{city}_ch.npz')
+
+
+def customizable_path(city, data_dir='data'):
+    return os.path.join(data_dir, f'{city}_cch.npz')
+
+
+def load_customizable(network, path):
+    """Load a saved customizable hierarchy for network, or None if it is missing or stale"""
+    if not os.path.exists(path):
+        print(f"No customizable hierarchy at {path}; risk-weighted routes use Dijkstra")
+        return None
+    hierarchy = CustomizableHierarchy.load(path)
+    if hierarchy.fingerprint != network.fingerprint():
+        print(f"Customizable hierarchy {path} was built for a different network; ignoring it")
+        return None
+    return hierarchy
+
+
+def load_hierarchy(network, path):
+    """Load a saved hierarchy for network, or None if it is missing or stale"""
+    if not os.path.exists(path):
+        print(f"No contraction hierarchy at {path}; fastest routes use Dijkstra")
+        return None
+    hierarchy = ContractionHierarchy.load(path)
+    if hierarchy.fingerprint != network.fingerprint():
+        print(f"Contraction hierarchy {path} was built for a different network; ignoring it")
+        return None
+    return hierarchy
+
+
+if __name__ == '__main__':
+    # Offline build: python contraction.py [city ...]
+    from route_engine import load_network
+
+    cities = sys.argv[1:] or ['leeds', 'birmingham']
+    for city in cities:
+        print(f"Building contraction hierarchy for {city.title()}...")
+        network = load_network(city)
+        build_hierarchy(network, network.length).save(hierarchy_path(city))
+        print(f"Saved {hierarchy_path(city)}")
+        build_customizable(network).save(customizable_path(city))
+        print(f"Saved {customizable_path(city)}")
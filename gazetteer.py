@@ -0,0 +1,235 @@
+import glob
+import os
+import re
+import sys
+
+import numpy as np
+
+from geocoding import Geocoder, Location
+
+# Least trigram similarity (0-1) at which a fuzzy match is accepted
+GAZETTEER_MIN_SCORE = float(os.getenv('GAZETTEER_MIN_SCORE', '0.6'))
+
+# Street-type abbreviations, spelled out so "Park Ln" finds "Park Lane"
+ABBREVIATIONS = {
+    'st': 'street', 'rd': 'road', 'ave': 'avenue', 'ln': 'lane', 'dr': 'drive',
+    'pl': 'place', 'sq': 'square', 'cres': 'crescent', 'ct': 'court', 'gdns': 'gardens',
+}
+# Parts of a query that say nothing about where in the city it is
+COUNTRY_NAMES = {'uk', 'united kingdom', 'england', 'gb'}
+POSTCODE = re.compile(r'^[a-z]{1,2}\d[a-z\d]? ?\d[a-z]{2}$')
+
+GAZETTEER_ARRAYS = ('names', 'lat', 'lng', 'trigrams', 'trigram_offsets', 'trigram_ids', 'trigram_counts')
+
+
+def normalize_name(text):
+    """Lowercase words only, with street-type abbreviations spelled out"""
+    words = re.sub(r"[^\w\s]", ' ', text.lower().replace("'", '')).split()
+    return ' '.join(ABBREVIATIONS.get(word, word) for word in words)
+
+
+def trigrams(name):
+    """Distinct character trigrams of a normalized name, padded at word edges"""
+    padded = f'  {name} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def numbers(name):
+    """Words of a name that contain digits: house numbers, postcode halves"""
+    return sorted(word for word in name.split() if any(char.isdigit() for char in word))
+
+
+def gazetteer_path(city, data_dir='data'):
+    return os.path.join(data_dir, f'{city}_gazetteer.npz')
+
+
+class Gazetteer:
+    """
+    Place names of one city with their coordinates, searchable offline.
+
+    names is sorted, so exact and prefix matches are binary searches. Fuzzy
+    matches go through an inverted trigram index in CSR form: the ids of the
+    names containing trigrams[t] are trigram_ids[trigram_offsets[t]:
+    trigram_offsets[t + 1]], and names score by trigram Jaccard similarity.
+    """
+
+    def __init__(self, names, lat, lng, trigrams, trigram_offsets, trigram_ids, trigram_counts):
+        self.names = names
+        self.lat = lat
+        self.lng = lng
+        self.trigrams = trigrams
+        self.trigram_offsets = trigram_offsets
+        self.trigram_ids = trigram_ids
+        self.trigram_counts = trigram_counts
+
+    @classmethod
+    def from_entries(cls, entries):
+        """Build from (name, lat, lng) tuples; names are normalized, duplicates keep the first"""
+        places = {}
+        for name, lat, lng in entries:
+            name = normalize_name(name)
+            if name and name not in places:
+                places[name] = (lat, lng)
+        names = sorted(places)
+        coords = np.array([places[name] for name in names], dtype=np.float64).reshape(-1, 2)
+
+        postings = {}
+        counts = np.zeros(len(names), dtype=np.int32)
+        for i, name in enumerate(names):
+            grams = trigrams(name)
+            counts[i] = len(grams)
+            for gram in grams:
+                postings.setdefault(gram, []).append(i)
+        vocabulary = sorted(postings)
+        offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(postings[gram]) for gram in vocabulary])
+        ids = np.array([i for gram in vocabulary for i in postings[gram]], dtype=np.int32)
+        return cls(np.array(names, dtype=str), coords[:, 0], coords[:, 1],
+                   np.array(vocabulary, dtype=str), offsets, ids, counts)
+
+    def save(self, path):
+        np.savez(path, **{name: getattr(self, name) for name in GAZETTEER_ARRAYS})
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(*(data[name] for name in GAZETTEER_ARRAYS))
+
+    def __len__(self):
+        return len(self.names)
+
+    def _location(self, i):
+        return Location(float(self.lat[i]), float(self.lng[i]))
+
+    def search(self, name, min_score=GAZETTEER_MIN_SCORE):
+        """
+        Best match for a normalized name as (Location, score): exact matches
+        score 1, then the shortest name it is a prefix of, then the best
+        trigram match. Prefix and trigram matches must have the same numbers
+        as the query, so "12 park lane" never lands on "2 park lane". Returns
+        (None, 0) if nothing scores min_score.
+        """
+        if not name or not len(self.names):
+            return None, 0.0
+        i = int(np.searchsorted(self.names, name))
+        if i < len(self.names) and self.names[i] == name:
+            return self._location(i), 1.0
+
+        wanted = numbers(name)
+
+        # Names that start with the query, e.g. "headingley stadium" for "headingley stad"
+        end = int(np.searchsorted(self.names, name + '\uffff'))
+        if end > i:
+            lengths = np.char.str_len(self.names[i:end])
+            for k in np.argsort(lengths, kind='stable'):
+                score = len(name) / lengths[k]
+                if score < min_score:
+                    break
+                if numbers(str(self.names[i + k])) == wanted:
+                    return self._location(i + k), float(score)
+
+        grams = trigrams(name)
+        vocabulary = np.array(sorted(grams), dtype=str)
+        t = np.searchsorted(self.trigrams, vocabulary)
+        found = t < len(self.trigrams)
+        found[found] = self.trigrams[t[found]] == vocabulary[found]
+        t = t[found]
+        if not len(t):
+            return None, 0.0
+        ids = np.concatenate([self.trigram_ids[self.trigram_offsets[k]:self.trigram_offsets[k + 1]] for k in t])
+        shared = np.bincount(ids, minlength=len(self.names))
+        candidates = np.flatnonzero(shared)
+        scores = shared[candidates] / (len(grams) + self.trigram_counts[candidates] - shared[candidates])
+        for k in np.argsort(-scores, kind='stable'):
+            if scores[k] < min_score:
+                break
+            if numbers(str(self.names[candidates[k]])) == wanted:
+                return self._location(candidates[k]), float(scores[k])
+        return None, 0.0
+
+
+class LocalGeocoder(Geocoder):
+    """
+    Geocoder over the gazetteers of the supported cities, with geopy's
+    geocode(query) interface. Queries are split at commas: a part naming a
+    city narrows the search to that city, country names are ignored, and the
+    rest is tried as a whole and then part by part. Returns None when nothing
+    matches well enough, or the query names a city without a gazetteer, so
+    callers can fall back to a remote service.
+    """
+
+    def __init__(self, gazetteers, cities=(), min_score=GAZETTEER_MIN_SCORE):
+        self.gazetteers = gazetteers
+        self.cities = set(cities) | set(gazetteers)
+        self.min_score = min_score
+
+    @classmethod
+    def load(cls, data_dir='data', cities=(), min_score=GAZETTEER_MIN_SCORE):
+        """Gazetteers of every city that has a data/<city>_gazetteer.npz"""
+        gazetteers = {}
+        for path in sorted(glob.glob(os.path.join(data_dir, '*_gazetteer.npz'))):
+            city = os.path.basename(path)[:-len('_gazetteer.npz')]
+            gazetteers[city] = Gazetteer.load(path)
+            print(f"Loaded {city.title()} gazetteer ({len(gazetteers[city])} places)")
+        return cls(gazetteers, cities, min_score)
+
+    def geocode(self, query):
+        parts = [normalize_name(part) for part in query.split(',')]
+        parts = [part for part in parts if part and part not in COUNTRY_NAMES]
+        cities = [part for part in parts if part in self.cities]
+        parts = [part for part in parts if part not in self.cities]
+        if any(city not in self.gazetteers for city in cities):
+            return None
+        gazetteers = [self.gazetteers[city] for city in cities] or list(self.gazetteers.values())
+        if not parts or not gazetteers:
+            return None
+
+        names = [' '.join(parts)] + (parts if len(parts) > 1 else [])
+        # A trailing postcode ("leeds ls1 4dy") is looked up on its own too
+        postcodes = [' '.join(name.split()[-2:]) for name in names
+                     if len(name.split()) > 2 and POSTCODE.match(' '.join(name.split()[-2:]))]
+        for name in names + postcodes:
+            best, best_score = None, 0.0
+            for gazetteer in gazetteers:
+                location, score = gazetteer.search(name, self.min_score)
+                if score > best_score:
+                    best, best_score = location, score
+            if best is not None:
+                return best
+        return None
+
+
+def osm_entries(outline):
+    """(name, lat, lng) for the named places, addresses and postcodes of OSM inside an outline"""
+    import osmnx as ox
+
+    features = ox.features_from_polygon(outline, tags={'name': True, 'addr:housenumber': True})
+    points = features.geometry.representative_point()
+    columns = {column: features[column] if column in features else None
+               for column in ('name', 'addr:housenumber', 'addr:street', 'addr:postcode')}
+    postcodes = {}
+    for i, point in enumerate(points):
+        value = {column: values.iloc[i] if values is not None else None for column, values in columns.items()}
+        value = {column: v for column, v in value.items() if isinstance(v, str)}
+        if 'name' in value:
+            yield value['name'], point.y, point.x
+        if 'addr:housenumber' in value and 'addr:street' in value:
+            yield f"{value['addr:housenumber']} {value['addr:street']}", point.y, point.x
+        if 'addr:postcode' in value:
+            postcodes.setdefault(value['addr:postcode'], []).append((point.y, point.x))
+    # A postcode sits at the middle of the addresses that have it
+    for postcode, coords in postcodes.items():
+        lat, lng = np.mean(coords, axis=0)
+        yield postcode, lat, lng
+
+
+if __name__ == '__main__':
+    # Build gazetteers from OpenStreetMap: python gazetteer.py [city ...]
+    from route_engine import load_city_outlines
+
+    outlines = load_city_outlines()
+    for city in sys.argv[1:] or sorted(outlines):
+        print(f"Building {city.title()} gazetteer...")
+        gazetteer = Gazetteer.from_entries(osm_entries(outlines[city]))
+        gazetteer.save(gazetteer_path(city))
+        print(f"Saved {gazetteer_path(city)} ({len(gazetteer)} places, {len(gazetteer.trigrams)} trigrams)")
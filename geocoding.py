@@ -0,0 +1,338 @@
+import hashlib
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# Persistent tier of the geocode cache, and the in-memory LRU tier in front of it
+GEOCODE_CACHE_PATH = os.getenv('GEOCODE_CACHE_PATH', 'data/geocode_cache.sqlite')
+GEOCODE_CACHE_SIZE = int(os.getenv('GEOCODE_CACHE_SIZE', '10000'))
+# How long found and not-found answers are trusted, in seconds
+GEOCODE_TTL = float(os.getenv('GEOCODE_TTL', str(30 * 24 * 3600)))
+GEOCODE_NEGATIVE_TTL = float(os.getenv('GEOCODE_NEGATIVE_TTL', str(24 * 3600)))
+# Calls to the geocoding service, per second and in a burst, per process
+GEOCODE_RATE = float(os.getenv('GEOCODE_RATE', '10'))
+GEOCODE_BURST = int(os.getenv('GEOCODE_BURST', '5'))
+# Lookups in flight at once, per process
+GEOCODE_WORKERS = int(os.getenv('GEOCODE_WORKERS', '8'))
+
+# Geocoding providers, asked in turn (see make_geocoder)
+GEOCODER = os.getenv('GEOCODER', 'local,google')
+# For the 'fixture' provider: a JSON file of {"query": [lat, lng]}, and added latency in seconds
+GEOCODER_FIXTURES = os.getenv('GEOCODER_FIXTURES', '')
+GEOCODER_FIXTURE_LATENCY = float(os.getenv('GEOCODER_FIXTURE_LATENCY', '0'))
+
+# Geocoding result; latitude/longitude match geopy's Location so callers needn't care
+Location = namedtuple('Location', ['latitude', 'longitude'])
+
+# Cache lookups that find nothing return MISS; a cached "no such place" is None
+MISS = object()
+
+
+def normalize_query(query):
+    """Cache key for an address query: case, spacing and comma placement don't matter"""
+    query = query.strip().lower()
+    query = re.sub(r'\s+', ' ', query)
+    query = re.sub(r'\s*,[\s,]*', ', ', query)
+    return query.strip(' ,.')
+
+
+class GeocodeCache:
+    """
+    Two-tier geocode cache with per-entry expiry: a bounded in-memory LRU in
+    front of a SQLite table that survives restarts and is shared by every
+    process on the host. Not-found answers are cached too, with a shorter TTL.
+    """
+
+    def __init__(self, path=GEOCODE_CACHE_PATH, max_entries=GEOCODE_CACHE_SIZE,
+                 ttl=GEOCODE_TTL, negative_ttl=GEOCODE_NEGATIVE_TTL):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_pid = None
+
+    def _connection(self):
+        # Connections must not cross a fork, so each process opens its own
+        if self._db is None or self._db_pid != os.getpid():
+            self._db = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS geocode '
+                             '(query TEXT PRIMARY KEY, lat REAL, lng REAL, expires REAL)')
+            self._db.execute('DELETE FROM geocode WHERE expires < ?', (time.time(),))
+            self._db.commit()
+            self._db_pid = os.getpid()
+        return self._db
+
+    def _remember(self, key, value, expires):
+        self._memory[key] = (value, expires)
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, query):
+        """Cached Location (or None for a cached miss), or MISS if unknown or expired"""
+        key = normalize_query(query)
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[1] >= now:
+                    self._memory.move_to_end(key)
+                    return entry[0]
+                del self._memory[key]
+
+            try:
+                row = self._connection().execute(
+                    'SELECT lat, lng, expires FROM geocode WHERE query = ?', (key,)).fetchone()
+            except sqlite3.Error as e:
+                print(f"Geocode cache read failed: {e}")
+                return MISS
+            if row is None or row[2] < now:
+                return MISS
+            value = Location(row[0], row[1]) if row[0] is not None else None
+            self._remember(key, value, row[2])
+            return value
+
+    def put(self, query, location):
+        """Store a geocoding answer; location None records that nothing was found"""
+        key = normalize_query(query)
+        if location is not None:
+            location = Location(location.latitude, location.longitude)
+        expires = time.time() + (self.ttl if location is not None else self.negative_ttl)
+        with self._lock:
+            self._remember(key, location, expires)
+            try:
+                db = self._connection()
+                db.execute('INSERT OR REPLACE INTO geocode VALUES (?, ?, ?, ?)',
+                           (key, location.latitude if location else None,
+                            location.longitude if location else None, expires))
+                db.commit()
+            except sqlite3.Error as e:
+                print(f"Geocode cache write failed: {e}")
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: acquire() takes one token, waiting for one if
+    none are left. Tokens refill at rate per second up to burst.
+    """
+
+    def __init__(self, rate=GEOCODE_RATE, burst=GEOCODE_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def _pool():
+    # Pool threads don't survive a fork, so each process starts its own
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(GEOCODE_WORKERS, thread_name_prefix='geocode')
+            _executor_pid = os.getpid()
+        return _executor
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+class Geocoder(ABC):
+    """
+    Geocoding provider. geocode(query) returns a Location, or None if the
+    place wasn't found, and raises if the lookup itself failed. submit()
+    runs it on a shared thread pool so that several addresses resolve at the
+    same time.
+    """
+
+    @abstractmethod
+    def geocode(self, query):
+        """Location of query, or None if it wasn't found"""
+
+    def submit(self, query):
+        """Geocode in the background; returns a Future of geocode(query)"""
+        return _pool().submit(self.geocode, query)
+
+
+class GoogleGeocoder(Geocoder):
+    """Google Geocoding API, with calls spread out by a shared TokenBucket"""
+
+    def __init__(self, api_key, timeout=10, rate_limiter=None):
+        from geopy.geocoders import GoogleV3
+
+        self.client = GoogleV3(api_key=api_key, timeout=timeout)
+        self.rate_limiter = rate_limiter if rate_limiter is not None else TokenBucket()
+
+    def geocode(self, query):
+        self.rate_limiter.acquire()
+        location = self.client.geocode(query)
+        return Location(location.latitude, location.longitude) if location is not None else None
+
+
+class CachedGeocoder(Geocoder):
+    """
+    Another geocoder behind a GeocodeCache. Errors such as timeouts propagate
+    and are never cached, so a failed lookup is simply retried next time.
+    """
+
+    def __init__(self, geocoder, cache=None):
+        self.geocoder = geocoder
+        self.cache = cache if cache is not None else GeocodeCache()
+
+    def geocode(self, query):
+        cached = self.cache.get(query)
+        if cached is not MISS:
+            return cached
+        location = self.geocoder.geocode(query)
+        self.cache.put(query, location)
+        return location
+
+
+class FallbackGeocoder(Geocoder):
+    """Asks each geocoder in turn and returns the first place found"""
+
+    def __init__(self, geocoders):
+        self.geocoders = list(geocoders)
+
+    def geocode(self, query):
+        for geocoder in self.geocoders:
+            location = geocoder.geocode(query)
+            if location is not None:
+                return location
+        return None
+
+
+class FixtureGeocoder(Geocoder):
+    """
+    Deterministic stand-in for load tests. Queries listed in the fixtures
+    file ({"query": [lat, lng]}) get their coordinates; any other query
+    naming a city as a whole word is placed at a pseudo-random point inside
+    that city's outline, the same point every time. latency (seconds) is
+    added to every call to imitate a remote service.
+    """
+
+    def __init__(self, outlines, fixtures=None, latency=0.0):
+        self.outlines = outlines
+        self.fixtures = {normalize_query(query): Location(*coords) for query, coords in (fixtures or {}).items()}
+        self.latency = latency
+
+    def geocode(self, query):
+        if self.latency:
+            time.sleep(self.latency)
+        key = normalize_query(query)
+        if key in self.fixtures:
+            return self.fixtures[key]
+        city = next((city for city in self.outlines
+                     if re.search(rf'\b{re.escape(city)}\b', key)), None)
+        if city is None:
+            return None
+
+        import shapely
+
+        outline = self.outlines[city]
+        min_lng, min_lat, max_lng, max_lat = outline.bounds
+        seed = int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], 'little')
+        rng = random.Random(seed)
+        for _ in range(100):
+            lat, lng = rng.uniform(min_lat, max_lat), rng.uniform(min_lng, max_lng)
+            if outline.contains(shapely.Point(lng, lat)):
+                return Location(lat, lng)
+        point = outline.representative_point()
+        return Location(point.y, point.x)
+
+
+def make_geocoder(providers=GEOCODER, api_key=None, data_dir='data'):
+    """
+    The geocoder configured by GEOCODER: a comma-separated list of providers
+    asked in turn, from 'local' (offline gazetteers, see gazetteer.py),
+    'google' (Google Geocoding API behind the geocode cache) and 'fixture'
+    (FixtureGeocoder, for load tests without network access)
+    """
+    from route_engine import load_city_outlines
+
+    outlines = load_city_outlines(data_dir)
+    geocoders = []
+    for provider in (name.strip() for name in providers.split(',')):
+        if provider == 'local':
+            from gazetteer import LocalGeocoder
+
+            geocoders.append(LocalGeocoder.load(data_dir, cities=outlines))
+        elif provider == 'google':
+            if not api_key:
+                raise ValueError("GOOGLE_MAPS_API_KEY not found. Please check your .env file.")
+            geocoders.append(CachedGeocoder(GoogleGeocoder(api_key)))
+        elif provider == 'fixture':
+            fixtures = None
+            if GEOCODER_FIXTURES:
+                with open(GEOCODER_FIXTURES) as f:
+                    fixtures = json.load(f)
+            geocoders.append(FixtureGeocoder(outlines, fixtures, GEOCODER_FIXTURE_LATENCY))
+        else:
+            raise ValueError(f"Unknown geocoder '{provider}' (expected local, google or fixture)")
+    print(f"Geocoding with: {', '.join(type(geocoder).__name__ for geocoder in geocoders)}")
+    return geocoders[0] if len(geocoders) == 1 else FallbackGeocoder(geocoders)
+
+
+def geocode_addresses(geocoder, registry, *addresses, report=print):
+    """
+    (lat, lng), or (None, None), for each address. An address that names none
+    of the registry's cities is tried in each of them, and the first result
+    that lies inside its city wins. All lookups, including these per-city
+    candidates, run at the same time. report(message) is told about failed
+    lookups.
+    """
+    cities = registry.cities
+    lookups = []
+    for address in addresses:
+        if not any(city in address.lower() for city in cities):
+            lookups.append([(candidate, geocoder.submit(f"{address}, {candidate.title()}, UK"))
+                            for candidate in cities])
+        else:
+            lookups.append([(None, geocoder.submit(f"{address}, UK"))])
+    return [pick_location(registry, address, candidates, report) for address, candidates in zip(addresses, lookups)]
+
+
+def pick_location(registry, address, candidates, report=print):
+    """First usable result of an address's (city, future) candidate lookups"""
+    from geopy.exc import GeocoderQuotaExceeded, GeocoderTimedOut
+
+    for candidate, future in candidates:
+        try:
+            location = future.result()
+        except (GeocoderTimedOut, GeocoderQuotaExceeded) as e:
+            report(f"Geocoding error for address '{address}': {e}")
+            continue
+        except Exception as e:
+            report(f"Unexpected geocoding error for address '{address}': {e}")
+            continue
+        if not location:
+            continue
+        lat, lng = location.latitude, location.longitude
+        if candidate is None or registry.locate(lat, lng) == candidate:
+            return lat, lng
+    return None, None
@@ -0,0 +1,12 @@
+import os
+
+# Load the networks once in the master and fork the workers from it. The
+# snapshot arrays are memory-mapped read-only and everything built on top of
+# them is shared copy-on-write, so extra workers cost little extra memory.
+# Only prewarmed cities are shared this way, so prewarm every city in
+# cities.json unless PREWARM_CITIES names a subset.
+preload_app = True
+os.environ.setdefault('PREWARM_CITIES', 'all')
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
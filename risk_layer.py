@@ -0,0 +1,220 @@
+import glob
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+# Geohash precision of risk_grid.pkl: 8 characters = 20 bits of longitude and
+# 20 of latitude, i.e. cells of about 23 m x 19 m in the UK
+GEOHASH_BITS = 20
+
+# Spacing of the sample points used to score an edge against the grid, in
+# meters; about half a cell so no cell an edge crosses is skipped
+EDGE_SAMPLE_M = 10.0
+# crash_risk at this percentile of the grid maps to the top of the
+# normalized_risk scale (0-5) used by the routing metric
+RISK_SCALE_PERCENTILE = 99
+NORMALIZED_RISK_MAX = 5.0
+
+# Where edge risk comes from: 'graph' keeps normalized_risk from the GraphML,
+# 'grid' re-scores every edge from the risk grid when a city is loaded
+RISK_SOURCE = os.getenv('RISK_SOURCE', 'graph')
+# How often, at most, the risk files on disk are checked for changes
+RISK_POLL_SECONDS = float(os.getenv('RISK_POLL_SECONDS', '30'))
+
+METERS_PER_DEGREE = 111195.0
+
+
+def geohash_cells(geohashes):
+    """Integer cell keys for geohash strings, decoded by de-interleaving their bits"""
+    keys = np.empty(len(geohashes), dtype=np.int64)
+    for i, geohash in enumerate(geohashes):
+        bits = 0
+        for char in geohash:
+            bits = bits << 5 | GEOHASH_ALPHABET.index(char)
+        x = y = 0
+        # Geohash bits alternate longitude, latitude, starting with longitude
+        for b in range(5 * len(geohash)):
+            bit = bits >> (5 * len(geohash) - 1 - b) & 1
+            if b % 2 == 0:
+                x = x << 1 | bit
+            else:
+                y = y << 1 | bit
+        keys[i] = x << GEOHASH_BITS | y
+    return keys
+
+
+def point_cells(lat, lng):
+    """Integer cell keys of the geohash cells containing each point, vectorised"""
+    scale = 1 << GEOHASH_BITS
+    x = np.floor((np.asarray(lng, dtype=np.float64) + 180.0) / 360.0 * scale).astype(np.int64)
+    y = np.floor((np.asarray(lat, dtype=np.float64) + 90.0) / 180.0 * scale).astype(np.int64)
+    return np.clip(x, 0, scale - 1) << GEOHASH_BITS | np.clip(y, 0, scale - 1)
+
+
+class RiskGrid:
+    """
+    Crash risk per geohash cell, as sorted integer cell keys and values.
+
+    Points map to their cell arithmetically, so lookups never build geohash
+    strings: a batch of points is one vectorised binary search. Cells without
+    recorded crashes have no entry and read as 0.
+    """
+
+    def __init__(self, cells, crash_risk):
+        order = np.argsort(cells, kind='stable')
+        self.cells = np.asarray(cells, dtype=np.int64)[order]
+        self.crash_risk = np.asarray(crash_risk, dtype=np.float64)[order]
+        self.scale = float(np.percentile(self.crash_risk, RISK_SCALE_PERCENTILE)) if len(self.crash_risk) else 1.0
+
+    @classmethod
+    def from_frame(cls, frame):
+        return cls(geohash_cells(frame['geohash'].tolist()), frame['crash_risk'].to_numpy())
+
+    @classmethod
+    def load(cls, path='data/risk_grid.pkl'):
+        return cls.from_frame(pd.read_pickle(path))
+
+    def __len__(self):
+        return len(self.cells)
+
+    def lookup(self, lat, lng):
+        """crash_risk at each point (0 outside recorded cells)"""
+        keys = point_cells(lat, lng)
+        if not len(self.cells):
+            return np.zeros(keys.shape)
+        idx = np.searchsorted(self.cells, keys)
+        idx = np.minimum(idx, len(self.cells) - 1)
+        found = self.cells[idx] == keys
+        return np.where(found, self.crash_risk[idx], 0.0)
+
+    def normalize(self, crash_risk):
+        """Map crash_risk onto the 0-5 normalized_risk scale of the routing metric"""
+        return np.clip(np.asarray(crash_risk) / self.scale * NORMALIZED_RISK_MAX, 0.0, NORMALIZED_RISK_MAX)
+
+    def segment_risk(self, lat, lng, offsets, step_m=EDGE_SAMPLE_M):
+        """
+        Length-weighted mean crash_risk along polylines given as flat coordinate
+        arrays, polyline i owning points offsets[i]:offsets[i + 1]. Every
+        segment is sampled at its midpoints every step_m meters, so the whole
+        batch is a handful of array operations.
+        """
+        lat = np.asarray(lat, dtype=np.float64)
+        lng = np.asarray(lng, dtype=np.float64)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        count = len(offsets) - 1
+        if count <= 0:
+            return np.zeros(0)
+
+        # Segments are consecutive point pairs within one polyline
+        owner = np.repeat(np.arange(count), np.diff(offsets))
+        starts = np.flatnonzero(owner[:-1] == owner[1:]) if len(owner) > 1 else np.zeros(0, dtype=np.int64)
+        lat0, lng0 = lat[starts], lng[starts]
+        dlat, dlng = lat[starts + 1] - lat0, lng[starts + 1] - lng0
+        meters = METERS_PER_DEGREE * np.hypot(dlat, dlng * np.cos(np.radians(lat0)))
+
+        samples = np.maximum(np.ceil(meters / step_m), 1).astype(np.int64)
+        segment = np.repeat(np.arange(len(starts)), samples)
+        # Position of each sample within its segment: (j + 0.5) / n
+        first = np.concatenate(([0], np.cumsum(samples)[:-1]))
+        fraction = (np.arange(len(segment)) - first[segment] + 0.5) / samples[segment]
+        risk = self.lookup(lat0[segment] + fraction * dlat[segment], lng0[segment] + fraction * dlng[segment])
+
+        weight = meters[segment] / samples[segment]
+        polyline = owner[starts][segment]
+        total = np.bincount(polyline, weights=risk * weight, minlength=count)
+        length = np.bincount(polyline, weights=weight, minlength=count)
+
+        # Degenerate polylines (a single point or zero length) take their first point's cell
+        result = self.lookup(lat[offsets[:-1]], lng[offsets[:-1]])
+        has_length = length > 0
+        result[has_length] = total[has_length] / length[has_length]
+        return result
+
+    def edge_risk(self, network, step_m=EDGE_SAMPLE_M):
+        """Normalized risk of every edge of a RouteNetwork, scored along its geometry"""
+        raw = self.segment_risk(network.geom_lat, network.geom_lng, network.geom_offsets, step_m)
+        return self.normalize(raw)
+
+
+def edge_risk_from_frame(network, frame, column='normalized_risk'):
+    """
+    Per-edge risk from an OSMnx-style edges frame keyed by (u, v, key), either
+    as its index or as columns. Edges the frame doesn't mention are NaN.
+    """
+    if {'u', 'v', 'key'}.issubset(frame.columns):
+        rows = zip(frame['u'].tolist(), frame['v'].tolist(), frame['key'].tolist())
+    else:
+        rows = frame.index.tolist()
+    edge_of = {edge: i for i, edge in enumerate(zip(network.node_ids[network.sources].tolist(),
+                                                    network.node_ids[network.targets].tolist(),
+                                                    network.edge_keys.tolist()))}
+    values = pd.to_numeric(frame[column], errors='coerce').to_numpy(dtype=np.float64)
+    risk = np.full(network.num_edges, np.nan)
+    for row, value in zip(rows, values):
+        edge = edge_of.get(tuple(row))
+        if edge is not None:
+            risk[edge] = value
+    return risk
+
+
+class RiskSource:
+    """
+    Where edge risk comes from, and whether it changed on disk.
+
+    In 'grid' mode every edge is scored from risk_grid.pkl. In 'graph' mode
+    the GraphML scores stand until data/<city>_edges.pkl is replaced; from
+    then on its normalized_risk column overrides the edges it lists. poll()
+    notices replaced files, so every worker process picks up new data on its
+    own without a restart.
+    """
+
+    def __init__(self, data_dir='data', mode=RISK_SOURCE, poll_seconds=RISK_POLL_SECONDS):
+        self.data_dir = data_dir
+        self.mode = mode
+        self.poll_seconds = poll_seconds
+        self.grid_path = os.path.join(data_dir, 'risk_grid.pkl')
+        self.grid = RiskGrid.load(self.grid_path)
+        self._mtimes = self._scan()
+        self._checked = time.monotonic()
+        self._updated = set()
+        self._lock = threading.Lock()
+
+    def _scan(self):
+        paths = glob.glob(os.path.join(self.data_dir, '*_edges.pkl')) + [self.grid_path]
+        return {path: os.stat(path).st_mtime_ns for path in paths if os.path.exists(path)}
+
+    def edge_risk(self, city, network):
+        """Current risk for every edge of a city network, or None to keep the network's own"""
+        if self.mode == 'grid':
+            return self.grid.edge_risk(network)
+        if city in self._updated:
+            risk = edge_risk_from_frame(network, pd.read_pickle(os.path.join(self.data_dir, f'{city}_edges.pkl')))
+            return np.where(np.isnan(risk), network.risk, risk)
+        return None
+
+    def poll(self, force=False):
+        """
+        Check the risk files for changes, at most every poll_seconds unless
+        forced. Reloads what changed and returns True if anything did.
+        """
+        now = time.monotonic()
+        if not force and now - self._checked < self.poll_seconds:
+            return False
+        with self._lock:
+            self._checked = now
+            mtimes = self._scan()
+            changed = [path for path, mtime in mtimes.items() if self._mtimes.get(path) != mtime]
+            self._mtimes = mtimes
+            if not changed:
+                return False
+            if self.grid_path in changed:
+                self.grid = RiskGrid.load(self.grid_path)
+            for path in changed:
+                if path.endswith('_edges.pkl'):
+                    self._updated.add(os.path.basename(path)[:-len('_edges.pkl')])
+            print(f"Risk data changed: {', '.join(os.path.basename(path) for path in changed)}")
+            return True
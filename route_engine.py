@@ -0,0 +1,1759 @@
+import copy
+import hashlib
+import heapq
+import json
+import math
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+import networkx as nx
+import shapely
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components, dijkstra
+
+from contraction import customizable_path, hierarchy_path, load_customizable, load_hierarchy
+
+
+def safe_numeric_conversion(value, default=0):
+    """Safely convert value to float, handling strings and other types"""
+    if value is None:
+        return default
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return default
+    if isinstance(value, list) and value:
+        try:
+            return float(value[0])
+        except (ValueError, TypeError):
+            return default
+    return default
+
+
+def clean_nonnegative(values):
+    """
+    Float array with NaN/inf and negatives replaced by 0. Arrays that are
+    already clean are returned as they are, so memory-mapped snapshot arrays
+    stay shared instead of being copied into every process.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if np.isfinite(values).all() and not (values < 0).any():
+        return values
+    return np.nan_to_num(values, nan=0.0, posinf=0.0, neginf=0.0).clip(min=0)
+
+
+def parse_maxspeed(value, default=50):
+    """Parse an OSM maxspeed tag ('30', '30 mph', ['20 mph', '30 mph']) into km/h"""
+    if isinstance(value, list):
+        speeds = [parse_maxspeed(v, None) for v in value]
+        speeds = [v for v in speeds if v is not None]
+        return min(speeds) if speeds else default
+    if isinstance(value, str):
+        text = value.strip().lower()
+        # GraphML stores OSM lists as their string repr
+        if text.startswith('['):
+            return parse_maxspeed([v.strip(" '\"") for v in text[1:-1].split(',')], default)
+        factor = 1.609344 if text.endswith('mph') else 1.0
+        text = text.replace('mph', '').replace('km/h', '').replace('kmh', '').strip()
+        try:
+            speed = float(text) * factor
+        except ValueError:
+            return default
+        return speed if speed > 0 else default
+    speed = safe_numeric_conversion(value, default)
+    return speed if speed is not None and speed > 0 else default
+
+
+# Largest accepted risk_weight. Far below it the time term no longer changes
+# the safest route, and far above it edge weights and cache keys overflow.
+MAX_RISK_WEIGHT = 1e6
+
+
+def check_risk_weight(risk_weight):
+    """
+    risk_weight as a float, or ValueError if it isn't a number from 0 to
+    MAX_RISK_WEIGHT. A negative weight would give negative edge costs, which
+    Dijkstra and A* can't handle.
+    """
+    risk_weight = float(risk_weight)
+    if not 0 <= risk_weight <= MAX_RISK_WEIGHT:
+        raise ValueError(f"risk_weight must be a number from 0 to {MAX_RISK_WEIGHT:g}, got {risk_weight}")
+    return risk_weight
+
+
+# Number of distinct risk_weight metrics kept per network
+WEIGHT_CACHE_SIZE = 16
+
+# Route results kept per network for repeated requests (0 = off), for up to
+# ROUTE_CACHE_TTL seconds. Snapped start and end points within ROUTE_CACHE_SNAP_M
+# meters along the same edge, and risk weights within ROUTE_CACHE_RISK_STEP,
+# share an entry.
+ROUTE_CACHE_SIZE = int(os.getenv('ROUTE_CACHE_SIZE', '1024'))
+ROUTE_CACHE_TTL = float(os.getenv('ROUTE_CACHE_TTL', '3600'))
+ROUTE_CACHE_SNAP_M = float(os.getenv('ROUTE_CACHE_SNAP_M', '20'))
+ROUTE_CACHE_RISK_STEP = float(os.getenv('ROUTE_CACHE_RISK_STEP', '0.01'))
+
+# Search algorithms accepted by RouteNetwork.route_between
+SEARCH_MODES = ('dijkstra', 'astar', 'bidirectional')
+# Searches calculate_route_improved accepts: SEARCH_MODES, or 'hierarchy' for
+# the attached Contraction Hierarchies (see contraction.py) where a city has them
+ROUTE_SEARCHES = SEARCH_MODES + ('hierarchy',)
+DEFAULT_SEARCH = os.getenv('ROUTE_SEARCH', 'dijkstra')
+# Each distinct risk_weight costs a customizable hierarchy a full customisation,
+# so 'hierarchy' searches round the safest route's risk_weight to this step
+CCH_RISK_STEP = float(os.getenv('CCH_RISK_STEP', '0.1'))
+
+EARTH_RADIUS_M = 6371008.8
+
+# Binary network snapshots: one .npy per array below plus meta.json
+SNAPSHOT_VERSION = 1
+SNAPSHOT_ARRAYS = ('node_ids', 'lat', 'lng', 'offsets', 'targets', 'edge_keys',
+                   'length', 'base_travel_time', 'maxspeed', 'normalized_risk',
+                   'geom_offsets', 'geom_lat', 'geom_lng')
+
+# Outline of every supported city, as a GeoJSON FeatureCollection in the data directory
+CITIES_FILE = 'cities.json'
+# Estimated memory the registry may hold in networks before evicting the least
+# recently used city (0 = no limit), and cities to load up front ('all' for
+# every city in cities.json)
+NETWORK_MEMORY_BUDGET_MB = float(os.getenv('NETWORK_MEMORY_BUDGET_MB', '0'))
+PREWARM_CITIES = tuple(city.strip() for city in os.getenv('PREWARM_CITIES', '').split(',') if city.strip())
+
+# Route result fields that describe a route without listing its nodes (see route_summary)
+ROUTE_SUMMARY_KEYS = ('fastest_time', 'safest_time', 'fastest_risk', 'safest_risk',
+                      'fastest_risk_points', 'safest_risk_points', 'time_difference',
+                      'risk_reduction', 'start_point', 'end_point', 'risk_version')
+# Douglas-Peucker tolerances (meters) of the simplified route geometries, most
+# detailed first: about one screen pixel at zoom 17+, 15, 13 and 11 (see zoom_tolerance)
+SIMPLIFY_TOLERANCES_M = (0.0, 2.0, 8.0, 30.0)
+# Decimal places kept by encode_polyline (5 is the Google polyline default, ~1 m)
+POLYLINE_PRECISION = 5
+
+# Most pairs accepted by one batch request, and the number of destinations
+# sharing an origin from which one search tree beats per-pair hierarchy queries
+ROUTE_BATCH_MAX_PAIRS = int(os.getenv('ROUTE_BATCH_MAX_PAIRS', '10000'))
+ROUTE_BATCH_TREE_MIN = 16
+
+# Most origins or destinations in one travel_matrix request, and the most
+# distance cells (rows x nodes) a single batch of matrix searches may hold
+MATRIX_MAX_POINTS = int(os.getenv('MATRIX_MAX_POINTS', '1000'))
+MATRIX_CHUNK_CELLS = 4_000_000
+
+# Most routes returned for one Pareto frontier, and the risk_weight range it spans
+PARETO_MAX_ROUTES = 8
+PARETO_MAX_RISK_WEIGHT = 1.0
+
+
+# A point projected onto the network: position `fraction` (0-1) along `edge`
+EdgeSnap = namedtuple('EdgeSnap', ['edge', 'fraction', 'lat', 'lng', 'distance'])
+
+
+def edge_shape(geometry, lat, lng, u, v):
+    """(lat, lng) points of an edge, from its geometry attribute or the straight u-v line"""
+    if isinstance(geometry, str):
+        geometry = shapely.from_wkt(geometry)
+    if geometry is not None and not geometry.is_empty:
+        coords = np.asarray(geometry.coords, dtype=np.float64)
+        return coords[:, ::-1]
+    return np.array([[lat[u], lng[u]], [lat[v], lng[v]]])
+
+
+class RouteCache:
+    """Bounded LRU of route results that expire after ttl seconds, shared between threads"""
+
+    def __init__(self, max_entries=ROUTE_CACHE_SIZE, ttl=ROUTE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class RouteNetwork:
+    """
+    Compressed sparse row (CSR) copy of a city road network.
+
+    Nodes are renumbered 0..N-1 and the outgoing edges of node i live in
+    targets[offsets[i]:offsets[i + 1]], with the numeric edge attributes held
+    in NumPy arrays aligned to the same edge positions. Searches run over these
+    flat arrays instead of walking the NetworkX dict-of-dicts.
+    """
+
+    def __init__(self, node_ids, lat, lng, offsets, targets, edge_keys,
+                 length, base_travel_time, maxspeed, normalized_risk,
+                 geom_offsets=None, geom_lat=None, geom_lng=None):
+        self.node_ids = np.asarray(node_ids)
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lng = np.asarray(lng, dtype=np.float64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.targets = np.asarray(targets, dtype=np.int32)
+        self.edge_keys = np.asarray(edge_keys, dtype=np.int32)
+        self.length = clean_nonnegative(length)
+        self.base_travel_time = np.asarray(base_travel_time, dtype=np.float64)
+        self.maxspeed = np.asarray(maxspeed, dtype=np.float64)
+        self.normalized_risk = np.asarray(normalized_risk, dtype=np.float64)
+
+        # Clean weight vectors, materialised once so searches never parse attributes
+        self.time = self._edge_travel_time()
+        self.risk = clean_nonnegative(self.normalized_risk)
+        # Generation of the risk data in self.risk, bumped on every refresh
+        self.risk_version = 0
+        self._weight_cache = OrderedDict()
+        # Guards the per-network caches below; requests on several threads share them
+        self._cache_lock = threading.Lock()
+        # Finished route results of this network and risk version
+        self.route_cache = RouteCache()
+
+        # Source node of every edge, handy for vectorised edge lookups
+        self.sources = np.repeat(np.arange(len(self.node_ids), dtype=np.int32),
+                                 np.diff(self.offsets))
+
+        self._compute_components()
+
+        # Edge shapes as one flat coordinate list; edge i owns points
+        # geom_offsets[i]:geom_offsets[i + 1]. Straight edges are just (u, v).
+        if geom_offsets is None:
+            geom_offsets = np.arange(0, 2 * self.num_edges + 1, 2)
+            geom_lat = np.column_stack([self.lat[self.sources], self.lat[self.targets]]).ravel()
+            geom_lng = np.column_stack([self.lng[self.sources], self.lng[self.targets]]).ravel()
+        self.geom_offsets = np.asarray(geom_offsets, dtype=np.int64)
+        self.geom_lat = np.asarray(geom_lat, dtype=np.float64)
+        self.geom_lng = np.asarray(geom_lng, dtype=np.float64)
+
+        self.twins = self._find_twins()
+        self._build_edge_index()
+
+        # Python-list views for the heap-based searches, built on first use
+        self._lists = None
+        self._weight_lists = OrderedDict()
+
+        # Optional Contraction Hierarchy over the length metric (see contraction.py)
+        self.hierarchy = None
+        # Optional customizable hierarchy, customised per weight vector on first use
+        self.customizable = None
+
+    @property
+    def num_nodes(self):
+        return len(self.node_ids)
+
+    @property
+    def num_edges(self):
+        return len(self.targets)
+
+    @classmethod
+    def from_graph(cls, graph):
+        """Compile an OSMnx MultiDiGraph into CSR arrays"""
+        node_ids = list(graph.nodes)
+        node_index = {node: i for i, node in enumerate(node_ids)}
+        lat = [graph.nodes[node]['y'] for node in node_ids]
+        lng = [graph.nodes[node]['x'] for node in node_ids]
+
+        sources, targets, keys = [], [], []
+        length, base_travel_time, maxspeed, risk = [], [], [], []
+        shapes = []
+
+        for u, v, k, d in graph.edges(keys=True, data=True):
+            sources.append(node_index[u])
+            targets.append(node_index[v])
+            keys.append(k)
+            shapes.append(edge_shape(d.get('geometry'), lat, lng, node_index[u], node_index[v]))
+            length.append(safe_numeric_conversion(d.get('length', 0)))
+            # NaN marks edges without a precomputed travel time
+            base_travel_time.append(safe_numeric_conversion(d.get('base_travel_time'), np.nan))
+            maxspeed.append(parse_maxspeed(d.get('maxspeed', 50)))
+            risk.append(safe_numeric_conversion(d.get('normalized_risk', 0)))
+
+        # Group edges by source node; a stable sort keeps parallel edges in key order
+        order = np.argsort(np.asarray(sources, dtype=np.int64), kind='stable')
+        counts = np.bincount(np.asarray(sources, dtype=np.int64), minlength=len(node_ids))
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+
+        def reorder(values):
+            return np.asarray(values)[order]
+
+        shapes = [shapes[i] for i in order]
+        geom_offsets = np.concatenate(([0], np.cumsum([len(shape) for shape in shapes])))
+        geom = np.concatenate(shapes) if shapes else np.empty((0, 2))
+
+        return cls(
+            np.asarray(node_ids), lat, lng, offsets,
+            reorder(targets), reorder(keys),
+            reorder(length), reorder(base_travel_time),
+            reorder(maxspeed), reorder(risk),
+            geom_offsets, geom[:, 0], geom[:, 1],
+        )
+
+    def save(self, path):
+        """
+        Write the network as a snapshot directory of .npy arrays. meta.json is
+        written last, so a half-written snapshot is never picked up.
+        """
+        os.makedirs(path, exist_ok=True)
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        for name in SNAPSHOT_ARRAYS:
+            np.save(os.path.join(path, f'{name}.npy'), getattr(self, name), allow_pickle=False)
+        meta = {
+            'version': SNAPSHOT_VERSION,
+            'fingerprint': self.fingerprint(),
+            'nodes': self.num_nodes,
+            'edges': self.num_edges,
+        }
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        """
+        Read a snapshot written by save(). With mmap_mode='r' the arrays are
+        mapped read-only from disk, so every process loading the same snapshot
+        shares one copy in the page cache.
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta.get('version') != SNAPSHOT_VERSION:
+            raise ValueError(f"Network snapshot {path} has version {meta.get('version')}, "
+                             f"expected {SNAPSHOT_VERSION}; recompile it")
+        # np.asarray drops the np.memmap subclass but keeps the mapped buffer
+        arrays = {name: np.asarray(np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode,
+                                           allow_pickle=False))
+                  for name in SNAPSHOT_ARRAYS}
+        return cls(**arrays)
+
+    @property
+    def nbytes(self):
+        """Estimated memory held in arrays, attached hierarchies included"""
+        total = 0
+        for owner in (self, self.hierarchy, self.customizable):
+            if owner is not None:
+                total += sum(value.nbytes for value in vars(owner).values() if isinstance(value, np.ndarray))
+        return total
+
+    def fingerprint(self):
+        """Digest of topology and length, used to match precomputed data to this network"""
+        digest = hashlib.sha1()
+        for array in (self.offsets, self.targets, self.length):
+            digest.update(np.ascontiguousarray(array).tobytes())
+        return digest.hexdigest()
+
+    def _compute_components(self):
+        """Label every node with its strongly connected component"""
+        # Unweighted adjacency with parallel edges merged; SciPy's component
+        # labelling does not terminate on matrices with duplicate entries
+        topology = csr_matrix((np.ones(self.num_edges, dtype=np.int8), self.targets, self.offsets),
+                              shape=(self.num_nodes, self.num_nodes), copy=True)
+        topology.sum_duplicates()
+
+        _, self.scc_labels = connected_components(topology, directed=True, connection='strong')
+        self.scc_labels = self.scc_labels.astype(np.int32)
+
+        # The largest strongly connected component is the routable core:
+        # every node in it can reach every other one
+        self.main_component = int(np.bincount(self.scc_labels).argmax()) if self.num_nodes else -1
+
+    def _find_twins(self):
+        """For every edge u->v, an edge v->u on the same road (or -1)"""
+        n = self.num_nodes
+        keys = self.sources.astype(np.int64) * n + self.targets
+        reverse = self.targets.astype(np.int64) * n + self.sources
+        order = np.argsort(keys, kind='stable')
+        pos = np.searchsorted(keys[order], reverse).clip(max=max(len(keys) - 1, 0))
+        twins = np.full(self.num_edges, -1, dtype=np.int64)
+        if self.num_edges:
+            found = (keys[order][pos] == reverse) & (self.sources != self.targets)
+            twins[found] = order[pos[found]]
+        return twins
+
+    def _project(self, lat, lng):
+        """Local equirectangular projection in meters, accurate at city scale"""
+        x = np.radians(np.asarray(lng, dtype=np.float64) - self._origin[1]) * self._x_scale
+        y = np.radians(np.asarray(lat, dtype=np.float64) - self._origin[0]) * EARTH_RADIUS_M
+        return x, y
+
+    def _unproject(self, x, y):
+        lng = np.degrees(np.asarray(x) / self._x_scale) + self._origin[1]
+        lat = np.degrees(np.asarray(y) / EARTH_RADIUS_M) + self._origin[0]
+        return lat, lng
+
+    def _build_edge_index(self):
+        """STR-tree over the shapes of edges inside the routable main component"""
+        self._origin = (float(self.lat.mean()), float(self.lng.mean())) if self.num_nodes else (0.0, 0.0)
+        self._x_scale = EARTH_RADIUS_M * np.cos(np.radians(self._origin[0]))
+
+        in_main = self.scc_labels == self.main_component
+        self._snap_edges = np.flatnonzero(in_main[self.sources] & in_main[self.targets])
+
+        x, y = self._project(self.geom_lat, self.geom_lng)
+        point_edge = np.repeat(np.arange(self.num_edges), np.diff(self.geom_offsets))
+        self._edge_lines = shapely.linestrings(np.column_stack([x, y]), indices=point_edge)
+        self._edge_tree = shapely.STRtree(self._edge_lines[self._snap_edges])
+
+    def snap_to_edges(self, lat, lng):
+        """
+        Project one or many points onto their nearest routable edge.
+        Returns arrays (edges, fractions, lat, lng, distances_m).
+        """
+        x, y = self._project(np.atleast_1d(lat), np.atleast_1d(lng))
+        points = shapely.points(np.column_stack([x, y]))
+        (point_idx, tree_idx), distances = self._edge_tree.query_nearest(
+            points, return_distance=True, all_matches=False)
+
+        edges = np.empty(len(points), dtype=np.int64)
+        edges[point_idx] = self._snap_edges[tree_idx]
+        dist = np.empty(len(points))
+        dist[point_idx] = distances
+
+        lines = self._edge_lines[edges]
+        along = shapely.line_locate_point(lines, points)
+        line_length = shapely.length(lines)
+        fractions = np.divide(along, line_length, out=np.zeros_like(along), where=line_length > 0)
+
+        snapped = shapely.line_interpolate_point(lines, along)
+        snap_lat, snap_lng = self._unproject(shapely.get_x(snapped), shapely.get_y(snapped))
+        return edges, fractions.clip(0, 1), snap_lat, snap_lng, dist
+
+    def snap_all(self, lat, lng):
+        """Nearest routable edge positions for many points, in one index query"""
+        edges, fractions, snap_lat, snap_lng, distances = self.snap_to_edges(lat, lng)
+        return [EdgeSnap(*values) for values in zip(edges.tolist(), fractions.tolist(), snap_lat.tolist(),
+                                                      snap_lng.tolist(), distances.tolist())]
+
+    def snap(self, lat, lng):
+        """Nearest routable edge position for a single point"""
+        edges, fractions, snap_lat, snap_lng, distances = self.snap_to_edges(lat, lng)
+        return EdgeSnap(int(edges[0]), float(fractions[0]), float(snap_lat[0]),
+                        float(snap_lng[0]), float(distances[0]))
+
+    def _edge_travel_time(self):
+        """Per-edge travel time in seconds: base_travel_time, else length at maxspeed"""
+        speed_ms = np.where(self.maxspeed > 0, self.maxspeed, 50) * 1000 / 3600
+        base_time = self.base_travel_time
+        valid = np.isfinite(base_time) & (base_time >= 0)
+        return np.where(valid, base_time, self.length / speed_ms)
+
+    def weights(self, risk_weight):
+        """
+        Per-edge weight combining travel time and risk, cached per risk_weight.
+        """
+        risk_weight = check_risk_weight(risk_weight)
+        with self._cache_lock:
+            weights = self._weight_cache.get(risk_weight)
+            if weights is not None:
+                self._weight_cache.move_to_end(risk_weight)
+                return weights
+        weights = self._risk_metric(risk_weight)
+        with self._cache_lock:
+            # Another thread may have got there first; keep one vector per risk_weight
+            weights = self._weight_cache.setdefault(risk_weight, weights)
+            self._weight_cache.move_to_end(risk_weight)
+            while len(self._weight_cache) > WEIGHT_CACHE_SIZE:
+                self._weight_cache.popitem(last=False)
+        return weights
+
+    def with_risk(self, risk, version=None):
+        """
+        Copy of the network with new per-edge risk scores. Topology, geometry,
+        spatial indexes and hierarchies are shared; only metrics derived from
+        risk start afresh. The original is left untouched, so requests already
+        holding it finish on the old scores.
+        """
+        risk = clean_nonnegative(risk)
+        if risk.shape != self.risk.shape:
+            raise ValueError(f"Expected {self.num_edges} edge risk scores, got {risk.shape}")
+        network = copy.copy(self)
+        network.risk = risk
+        network.risk_version = self.risk_version + 1 if version is None else version
+        network._weight_cache = OrderedDict()
+        network._weight_lists = OrderedDict()
+        network.route_cache = RouteCache(self.route_cache.max_entries, self.route_cache.ttl)
+        if self.customizable is not None:
+            network.customizable = copy.copy(self.customizable)
+            network.customizable._metrics = OrderedDict()
+        return network
+
+    def route_key(self, orig_snap, dest_snap, risk_weight, search):
+        """Route cache key: snapped positions and risk_weight rounded to the cache's resolution"""
+        def position(snap):
+            return snap.edge, int(snap.fraction * self.length[snap.edge] // ROUTE_CACHE_SNAP_M)
+        return position(orig_snap), position(dest_snap), round(risk_weight / ROUTE_CACHE_RISK_STEP), search
+
+    def _risk_metric(self, risk_weight):
+        """Uncached per-edge weights for one risk_weight"""
+        risk_weight = check_risk_weight(risk_weight)
+        # Risk penalty: higher risk_weight means more penalty for risky edges
+        # Scale risk penalty: risk_score ranges 0-5, so we scale it
+        risk_penalty = 1 + (risk_weight * self.risk * 0.5)
+        weights = self.time * risk_penalty
+        weights.setflags(write=False)
+        return weights
+
+    def _weighted_matrix(self, weights):
+        # Wrapping the existing arrays is cheap; parallel edges stay as
+        # duplicate entries and Dijkstra simply relaxes each of them
+        return csr_matrix((weights, self.targets, self.offsets),
+                          shape=(self.num_nodes, self.num_nodes))
+
+    @staticmethod
+    def _unwind(predecessors, source, target):
+        """Node indices from source to target along a predecessor array"""
+        path = [target]
+        while path[-1] != source:
+            path.append(predecessors[path[-1]])
+        path.reverse()
+        return path
+
+    def _path_edges(self, path, weights):
+        """Edge ids along a path of node indices, taking the cheapest of any parallel edges"""
+        edges = []
+        for u, v in zip(path, path[1:]):
+            candidates = np.arange(self.offsets[u], self.offsets[u + 1])
+            candidates = candidates[self.targets[candidates] == v]
+            edges.append(int(candidates[np.argmin(weights[candidates])]))
+        return edges
+
+    def _snap_ends(self, snap, weights, leaving):
+        """
+        Ways of leaving (or reaching) a snapped point: the edge it lies on and,
+        for two-way roads, its twin. Returns (node, cost, edge, fraction, position)
+        tuples, where fraction is the share of the edge travelled between point
+        and node and position is where the point lies along that edge.
+        """
+        ends = []
+        for edge, position in ((snap.edge, snap.fraction), (self.twins[snap.edge], 1 - snap.fraction)):
+            if edge < 0:
+                continue
+            if leaving:
+                node, fraction = self.targets[edge], 1 - position
+            else:
+                node, fraction = self.sources[edge], position
+            ends.append((int(node), weights[edge] * fraction, int(edge), fraction, position))
+        return ends
+
+    def route_between(self, orig_snap, dest_snap, weights, search='dijkstra'):
+        """
+        Shortest path between two snapped points, treating each as a temporary
+        virtual node on its edge. The network itself is never modified.
+
+        search picks the algorithm: 'dijkstra' (SciPy, one-to-all), 'astar'
+        (goal-directed) or 'bidirectional'. All three return the same cost.
+        'ch' queries the attached Contraction Hierarchy and is only valid for
+        the length metric it was built on. 'cch' queries the attached
+        customizable hierarchy under any weights.
+
+        Returns a dict with the node ids visited, the edge ids between them, the
+        partial first/last legs as (edge, fraction) pairs, the total cost and the
+        number of settled nodes, or None if unreachable.
+        """
+        if search == 'ch':
+            if self.hierarchy is None or weights is not self.length:
+                raise ValueError("Contraction hierarchy search needs an attached hierarchy and the length metric")
+        elif search == 'cch':
+            if self.customizable is None:
+                raise ValueError("Customizable hierarchy search needs an attached customizable hierarchy")
+        elif search not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode '{search}', expected one of {SEARCH_MODES}")
+
+        starts = self._snap_ends(orig_snap, weights, leaving=True)
+        ends = self._snap_ends(dest_snap, weights, leaving=False)
+
+        best = self._same_edge_route(starts, ends, weights)
+        if search in ('ch', 'cch'):
+            hierarchy = self.hierarchy if search == 'ch' else self.customizable.metric(weights)
+            found = hierarchy.search(starts, ends)
+            if found is not None:
+                found['nodes'] = self.node_ids[found.pop('path')].tolist()
+        elif search == 'astar':
+            found = self._astar_search(starts, ends, weights, (dest_snap.lat, dest_snap.lng))
+        elif search == 'bidirectional':
+            found = self._bidirectional_search(starts, ends, weights)
+        else:
+            found = self._dijkstra_search(starts, ends, weights)
+
+        if found is not None and (best is None or found['cost'] < best['cost']):
+            best = found
+        return best
+
+    @staticmethod
+    def _same_edge_route(starts, ends, weights):
+        """Route for both points on the same road, destination further along it, or None"""
+        best = None
+        for _, _, start_edge, _, start_pos in starts:
+            for _, _, end_edge, _, end_pos in ends:
+                if start_edge == end_edge and end_pos >= start_pos:
+                    cost = weights[start_edge] * (end_pos - start_pos)
+                    if best is None or cost < best['cost']:
+                        best = {'nodes': [], 'edges': [], 'legs': [(start_edge, end_pos - start_pos)],
+                                'cost': cost, 'settled': 0}
+        return best
+
+    def _dijkstra_tree(self, starts, weights):
+        """One-to-all SciPy Dijkstra from each distinct start node: (seeds, distances, predecessors)"""
+        seeds = sorted({start[0] for start in starts})
+        distances, predecessors = dijkstra(self._weighted_matrix(weights), indices=seeds,
+                                           return_predecessors=True)
+        return seeds, np.atleast_2d(distances), np.atleast_2d(predecessors)
+
+    def _tree_route(self, tree, starts, ends, weights):
+        """Best route from a _dijkstra_tree to the given ends, or None"""
+        seeds, distances, predecessors = tree
+        best = None
+        for start_node, start_cost, start_edge, start_fraction, _ in starts:
+            row = seeds.index(start_node)
+            for end_node, end_cost, end_edge, end_fraction, _ in ends:
+                cost = start_cost + distances[row, end_node] + end_cost
+                if np.isfinite(cost) and (best is None or cost < best['cost']):
+                    path = self._unwind(predecessors[row], start_node, end_node)
+                    best = {
+                        'nodes': self.node_ids[path].tolist(),
+                        'edges': self._path_edges(path, weights),
+                        'legs': [(start_edge, start_fraction), (end_edge, end_fraction)],
+                        'cost': cost,
+                    }
+        if best is not None:
+            best['settled'] = int(np.isfinite(distances).sum())
+        return best
+
+    def _dijkstra_search(self, starts, ends, weights):
+        """One-to-all SciPy Dijkstra from each distinct start node"""
+        return self._tree_route(self._dijkstra_tree(starts, weights), starts, ends, weights)
+
+    @staticmethod
+    def _tree_edge_index(tails, heads, weights, num_nodes):
+        """Sorted (tail * num_nodes + head) keys and the cheapest edge for each, to find the edges of a search tree"""
+        order = np.lexsort((weights, heads, tails))
+        keys = tails[order].astype(np.int64) * num_nodes + heads[order]
+        first = np.concatenate(([True], keys[1:] != keys[:-1]))
+        return keys[first], order[first]
+
+    def _path_sums(self, predecessors, targets, tree_edges, values):
+        """
+        Sums of per-edge values from the root of each shortest-path tree (one
+        per row of predecessors) to the nodes in the same row of targets. Only
+        the paths to targets are touched: their chains are climbed for all rows
+        at once, each stopping where it joins a chain already climbed, and the
+        climbed nodes are then summed by pointer jumping, log2(depth) rounds.
+        """
+        rows, n = predecessors.shape
+        pred = predecessors.ravel()
+        # Tree nodes as flat row * n + node indices; roots and unreached nodes have no parent
+        climbed = np.zeros(rows * n, dtype=bool)
+        flat_targets = (np.arange(rows, dtype=np.int64)[:, None] * n + targets).ravel()
+        frontier = np.unique(flat_targets)
+        frontier = frontier[pred[frontier] >= 0]
+        while len(frontier):
+            climbed[frontier] = True
+            parents = frontier - frontier % n + pred[frontier]
+            frontier = np.unique(parents[(pred[parents] >= 0) & ~climbed[parents]])
+
+        nodes = np.flatnonzero(climbed)
+        keys, best = tree_edges
+        column = nodes % n
+        parents = nodes - column + pred[nodes]
+        edges = best[np.searchsorted(keys, pred[nodes].astype(np.int64) * n + column)]
+        # Parents at a root point to an extra last slot that sums to nothing
+        parent = np.where(pred[parents] >= 0, np.searchsorted(nodes, parents), len(nodes))
+        parent = np.append(parent, len(nodes))
+        sums = [np.append(value[edges], 0.0) for value in values]
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            for total in sums:
+                total += total[parent]
+            parent = grandparent
+
+        at = np.minimum(np.searchsorted(nodes, flat_targets), max(len(nodes) - 1, 0))
+        found = climbed[flat_targets]
+        return [np.where(found, total[at], 0.0).reshape(targets.shape) for total in sums]
+
+    def one_to_many(self, orig_snaps, dest_snaps, weights, values, search='dijkstra'):
+        """
+        Shortest paths under weights from every snapped origin to every
+        snapped destination. With search 'ch' or 'cch' the attached hierarchy
+        runs a bucket-based many-to-many search; otherwise there is one SciPy
+        one-to-all search per origin, or per destination if they are fewer.
+        Returns (cost, sums): an (origins, destinations) array of path costs
+        and, for each per-edge vector in values, the same shape of sums along
+        those paths, partial first and last edges included. Unreachable pairs
+        are inf.
+        """
+        def options(snaps, leaving):
+            # Up to two ways of leaving (or reaching) each point, padded with inf cost
+            table = np.zeros((len(snaps), 2, 5))
+            table[:, :, 1] = np.inf
+            table[:, :, 2] = -1 if leaving else -2
+            for i, snap in enumerate(snaps):
+                for j, end in enumerate(self._snap_ends(snap, weights, leaving)):
+                    table[i, j] = end
+            node, cost, edge, fraction, position = np.moveaxis(table, 2, 0)
+            return node.astype(np.int64), cost, edge.astype(np.int64), fraction, position
+
+        def cheapest(cost, sums):
+            # Cheapest (start option, end option) per pair, from (origin, 2, destination, 2) arrays
+            cost = cost.transpose(0, 2, 1, 3).reshape(shape + (4,))
+            best = np.argmin(cost, axis=2)[:, :, None]
+            return (np.take_along_axis(cost, best, axis=2)[:, :, 0],
+                    [np.take_along_axis(total.transpose(0, 2, 1, 3).reshape(shape + (4,)), best, axis=2)[:, :, 0]
+                     for total in sums])
+
+        start_node, start_cost, start_edge, start_fraction, start_pos = options(orig_snaps, True)
+        end_node, end_cost, end_edge, end_fraction, end_pos = options(dest_snaps, False)
+        shape = (len(orig_snaps), len(dest_snaps))
+        if not all(shape):
+            return np.zeros(shape), [np.zeros(shape) for _ in values]
+        start_legs = [value[start_edge] * start_fraction for value in values]
+        end_legs = [value[end_edge] * end_fraction for value in values]
+
+        if search in ('ch', 'cch'):
+            hierarchy = self.hierarchy if search == 'ch' else self.customizable.metric(weights)
+
+            def seeds(node, cost, legs):
+                return [[(int(node[i, j]), cost[i, j], tuple(float(leg[i, j]) for leg in legs))
+                         for j in range(2) if np.isfinite(cost[i, j])] for i in range(len(node))]
+
+            cost, sums = hierarchy.many_to_many(seeds(start_node, start_cost, start_legs),
+                                                seeds(end_node, end_cost, end_legs), values)
+        else:
+            # One search per point of the smaller side, from the destinations on
+            # the reversed graph if they are fewer. Each point is a virtual node
+            # joined to its snap options, so both directions of its road share a search.
+            reverse = len(dest_snaps) < len(orig_snaps)
+            if reverse:
+                tails, heads = self.targets, self.sources
+                (from_node, from_cost, from_legs), (to_node, to_cost, to_legs) = \
+                    (end_node, end_cost, end_legs), (start_node, start_cost, start_legs)
+            else:
+                tails, heads = self.sources, self.targets
+                (from_node, from_cost, from_legs), (to_node, to_cost, to_legs) = \
+                    (start_node, start_cost, start_legs), (end_node, end_cost, end_legs)
+            n, points = self.num_nodes, len(from_node)
+            point, option = np.nonzero(np.isfinite(from_cost))
+            all_tails = np.concatenate([tails, n + point])
+            all_heads = np.concatenate([heads, from_node[point, option]])
+            all_weights = np.concatenate([weights, from_cost[point, option]])
+            all_values = [np.concatenate([value, leg[point, option]]) for value, leg in zip(values, from_legs)]
+            order = np.argsort(all_tails, kind='stable')
+            offsets = np.concatenate(([0], np.cumsum(np.bincount(all_tails, minlength=n + points))))
+            matrix = csr_matrix((all_weights[order], all_heads[order], offsets), shape=(n + points, n + points))
+            tree_edges = self._tree_edge_index(all_tails, all_heads, all_weights, n + points)
+
+            targets = to_node.ravel()
+            cost = np.full((points, len(to_node)), np.inf)
+            sums = [np.zeros_like(cost) for _ in values]
+            chunk = max(1, MATRIX_CHUNK_CELLS // (n + points))
+            for first in range(0, points, chunk):
+                rows = np.arange(first, min(first + chunk, points))
+                distances, predecessors = dijkstra(matrix, indices=n + rows, return_predecessors=True)
+                path_sums = self._path_sums(predecessors, np.broadcast_to(targets, (len(rows), len(targets))),
+                                            tree_edges, all_values)
+                # Cheapest way into each point of the other side, over its snap options
+                total = distances[:, to_node] + to_cost
+                best = np.argmin(total, axis=2)[:, :, None]
+                cost[rows] = np.take_along_axis(total, best, axis=2)[:, :, 0]
+                for summed, path_sum, leg in zip(sums, path_sums, to_legs):
+                    summed[rows] = np.take_along_axis(path_sum.reshape(total.shape) + leg, best, axis=2)[:, :, 0]
+            if reverse:
+                cost, sums = cost.T, [summed.T for summed in sums]
+
+        # Both points on one road, destination further along it
+        along = end_pos[None, None] - start_pos[:, :, None, None]
+        same = (start_edge[:, :, None, None] == end_edge[None, None]) & (along >= 0)
+        same_cost, same_sums = cheapest(
+            np.where(same, weights[start_edge][:, :, None, None] * along, np.inf),
+            [value[start_edge][:, :, None, None] * along for value in values])
+        shorter = same_cost < cost
+        cost = np.where(shorter, same_cost, cost)
+        reached = np.isfinite(cost)
+        return cost, [np.where(shorter, same, np.where(reached, total, np.inf))
+                      for same, total in zip(same_sums, sums)]
+
+    def _adjacency_lists(self, weights):
+        """
+        Python-list copies of the CSR arrays (forward and reverse) and of a
+        weight vector. Scalar indexing into lists is far cheaper than into
+        NumPy arrays, which is what the heap-based searches spend their time on.
+        """
+        if self._lists is None:
+            # Reverse CSR: incoming edges of node i are rev_edges[rev_offsets[i]:rev_offsets[i + 1]]
+            rev_edges = np.argsort(self.targets, kind='stable')
+            rev_counts = np.bincount(self.targets, minlength=self.num_nodes)
+            rev_offsets = np.concatenate(([0], np.cumsum(rev_counts)))
+            self._lists = {
+                'offsets': self.offsets.tolist(),
+                'targets': self.targets.tolist(),
+                'rev_offsets': rev_offsets.tolist(),
+                'rev_edges': rev_edges.tolist(),
+                'sources': self.sources.tolist(),
+                'lat': np.radians(self.lat).tolist(),
+                'lng': np.radians(self.lng).tolist(),
+            }
+
+        key = id(weights)
+        with self._cache_lock:
+            cached = self._weight_lists.get(key)
+            if cached is not None and cached[0] is weights:
+                self._weight_lists.move_to_end(key)
+                return self._lists, cached[1], cached[2]
+        # Largest factor that keeps straight-line distance * factor below
+        # the true cost of every edge, i.e. 1 / network maximum speed for
+        # time metrics, scaled by the smallest risk penalty
+        has_length = self.length > 0
+        ratio = weights[has_length] / self.length[has_length]
+        factor = float(ratio.min()) * 0.999 if len(ratio) else 0.0
+        cached = (weights, np.asarray(weights, dtype=np.float64).tolist(), max(factor, 0.0))
+        with self._cache_lock:
+            self._weight_lists[key] = cached
+            self._weight_lists.move_to_end(key)
+            while len(self._weight_lists) > WEIGHT_CACHE_SIZE:
+                self._weight_lists.popitem(last=False)
+        return self._lists, cached[1], cached[2]
+
+    def _astar_search(self, starts, ends, weights, goal):
+        """
+        A* towards the snapped destination. The heuristic is the haversine
+        distance to the goal times the smallest weight-per-meter of any edge,
+        which for travel time is 1 / maximum speed. The risk penalty is >= 1,
+        so the heuristic never overestimates and stays admissible.
+        """
+        lists, w, factor = self._adjacency_lists(weights)
+        offsets, targets, lat, lng = lists['offsets'], lists['targets'], lists['lat'], lists['lng']
+
+        goal_lat, goal_lng = math.radians(goal[0]), math.radians(goal[1])
+        cos_goal = math.cos(goal_lat)
+        scale = 2 * EARTH_RADIUS_M * factor
+        heuristic = {}
+
+        def h(node):
+            value = heuristic.get(node)
+            if value is None:
+                a = (math.sin((lat[node] - goal_lat) / 2) ** 2
+                     + math.cos(lat[node]) * cos_goal * math.sin((lng[node] - goal_lng) / 2) ** 2)
+                value = heuristic[node] = scale * math.asin(math.sqrt(min(a, 1.0)))
+            return value
+
+        exits = {}
+        for end_node, end_cost, end_edge, end_fraction, _ in ends:
+            if end_node not in exits or end_cost < exits[end_node][0]:
+                exits[end_node] = (end_cost, end_edge, end_fraction)
+
+        dist, parent, heap = {}, {}, []
+        for start_node, start_cost, start_edge, start_fraction, _ in starts:
+            if start_cost < dist.get(start_node, math.inf):
+                dist[start_node] = start_cost
+                parent[start_node] = (-1, start_edge, start_fraction)
+                heapq.heappush(heap, (start_cost + h(start_node), start_cost, start_node))
+
+        best_cost, best_node, settled = math.inf, -1, 0
+        while heap:
+            f, d, node = heapq.heappop(heap)
+            if f >= best_cost:
+                break
+            if d > dist[node]:
+                continue
+            settled += 1
+            if node in exits:
+                total = d + exits[node][0]
+                if total < best_cost:
+                    best_cost, best_node = total, node
+            for e in range(offsets[node], offsets[node + 1]):
+                nxt = targets[e]
+                nd = d + w[e]
+                if nd < dist.get(nxt, math.inf):
+                    dist[nxt] = nd
+                    parent[nxt] = (node, e, None)
+                    heapq.heappush(heap, (nd + h(nxt), nd, nxt))
+
+        if best_node < 0:
+            return None
+        return self._assemble(parent, best_node, exits[best_node], best_cost, settled)
+
+    def _bidirectional_search(self, starts, ends, weights):
+        """Dijkstra from both ends at once, stopping when the frontiers' radii cover the best meeting"""
+        lists, w, _ = self._adjacency_lists(weights)
+        offsets, targets = lists['offsets'], lists['targets']
+        rev_offsets, rev_edges, sources = lists['rev_offsets'], lists['rev_edges'], lists['sources']
+
+        dist_f, parent_f, heap_f = {}, {}, []
+        for start_node, start_cost, start_edge, start_fraction, _ in starts:
+            if start_cost < dist_f.get(start_node, math.inf):
+                dist_f[start_node] = start_cost
+                parent_f[start_node] = (-1, start_edge, start_fraction)
+                heapq.heappush(heap_f, (start_cost, start_node))
+
+        # The backward side's parent points towards the destination
+        dist_b, parent_b, heap_b = {}, {}, []
+        for end_node, end_cost, end_edge, end_fraction, _ in ends:
+            if end_cost < dist_b.get(end_node, math.inf):
+                dist_b[end_node] = end_cost
+                parent_b[end_node] = (-1, end_edge, end_fraction)
+                heapq.heappush(heap_b, (end_cost, end_node))
+
+        best_cost, meet, settled = math.inf, -1, 0
+        for node in dist_f.keys() & dist_b.keys():
+            if dist_f[node] + dist_b[node] < best_cost:
+                best_cost, meet = dist_f[node] + dist_b[node], node
+
+        while heap_f and heap_b:
+            if heap_f[0][0] + heap_b[0][0] >= best_cost:
+                break
+            forward = heap_f[0][0] <= heap_b[0][0]
+            if forward:
+                heap, dist, parent, other = heap_f, dist_f, parent_f, dist_b
+            else:
+                heap, dist, parent, other = heap_b, dist_b, parent_b, dist_f
+
+            d, node = heapq.heappop(heap)
+            if d > dist[node]:
+                continue
+            settled += 1
+            if forward:
+                edges = range(offsets[node], offsets[node + 1])
+            else:
+                edges = (rev_edges[i] for i in range(rev_offsets[node], rev_offsets[node + 1]))
+            for e in edges:
+                nxt = targets[e] if forward else sources[e]
+                nd = d + w[e]
+                if nd < dist.get(nxt, math.inf):
+                    dist[nxt] = nd
+                    parent[nxt] = (node, e, None)
+                    heapq.heappush(heap, (nd, nxt))
+                    if nxt in other and nd + other[nxt] < best_cost:
+                        best_cost, meet = nd + other[nxt], nxt
+
+        if meet < 0:
+            return None
+
+        # Forward half ends at the meeting node; walk the backward parents to the exit
+        node, tail = meet, []
+        while parent_b[node][0] >= 0:
+            nxt, edge, _ = parent_b[node]
+            tail.append((nxt, edge))
+            node = nxt
+        _, end_edge, end_fraction = parent_b[node]
+
+        result = self._assemble(parent_f, meet, (0.0, end_edge, end_fraction), best_cost, settled)
+        for nxt, edge in tail:
+            result['nodes'].append(self.node_ids[nxt].item())
+            result['edges'].append(edge)
+        return result
+
+    def _assemble(self, parent, last, exit_leg, cost, settled):
+        """Build a route dict by walking parent links back from the last network node"""
+        nodes, edges = [last], []
+        while parent[nodes[-1]][0] >= 0:
+            prev, edge, _ = parent[nodes[-1]]
+            edges.append(edge)
+            nodes.append(prev)
+        _, start_edge, start_fraction = parent[nodes[-1]]
+        nodes.reverse()
+        edges.reverse()
+        return {
+            'nodes': self.node_ids[nodes].tolist(),
+            'edges': edges,
+            'legs': [(start_edge, start_fraction), (exit_leg[1], exit_leg[2])],
+            'cost': cost,
+            'settled': settled,
+        }
+
+    def route_stats(self, route, threshold=2.0):
+        """
+        Travel time, risk and high-risk points of a route_between result, in one
+        pass over the edge ids the search used. time_profile and risk_profile are
+        the cumulative values on arrival at each node of the route; the partial
+        first and last legs are included in the totals.
+        """
+        edges = np.asarray(route['edges'], dtype=np.int64)
+        legs = route['legs']
+        lead_time = lead_risk = 0.0
+        if route['nodes']:
+            # Start leg comes before the first node; the end leg after the last
+            lead_time = self.time[legs[0][0]] * legs[0][1]
+            lead_risk = self.risk[legs[0][0]] * legs[0][1]
+
+        time_profile = lead_time + np.concatenate(([0.0], np.cumsum(self.time[edges])))
+        risk_profile = lead_risk + np.concatenate(([0.0], np.cumsum(self.risk[edges])))
+        tail_edge, tail_fraction = legs[-1]
+        if route['nodes']:
+            total_time = time_profile[-1] + self.time[tail_edge] * tail_fraction
+            total_risk = risk_profile[-1] + self.risk[tail_edge] * tail_fraction
+        else:
+            total_time = self.time[tail_edge] * tail_fraction
+            total_risk = self.risk[tail_edge] * tail_fraction
+
+        # High-risk edges are marked at the node they leave from
+        risky = edges[self.risk[edges] > threshold]
+        start = self.sources[risky]
+        risk_points = [{'lat': lat, 'lng': lng, 'risk': risk} for lat, lng, risk in zip(
+            self.lat[start].tolist(), self.lng[start].tolist(), self.risk[risky].tolist())]
+
+        return {
+            'time': float(total_time),
+            'risk': float(total_risk),
+            'time_profile': time_profile.tolist() if route['nodes'] else [],
+            'risk_profile': risk_profile.tolist() if route['nodes'] else [],
+            'risk_points': risk_points,
+        }
+
+    def _edge_geometry(self, edges, tolerance=0.0):
+        """
+        Projected shapes of the given edges as flat (offsets, x, y) arrays, the
+        i-th edge owning points offsets[i]:offsets[i + 1], Douglas-Peucker
+        simplified to tolerance meters. Only these edges are simplified, so a
+        request never pays for, or keeps, a copy of the whole network.
+        """
+        lines = self._edge_lines[np.asarray(edges, dtype=np.int64)]
+        if tolerance > 0:
+            lines = shapely.simplify(lines, tolerance, preserve_topology=False)
+        coords, owner = shapely.get_coordinates(lines, return_index=True)
+        offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(owner, minlength=len(lines)))
+        return offsets, coords[:, 0], coords[:, 1]
+
+    def route_geometry(self, route, start_point, end_point, tolerance=0.0):
+        """
+        (lat, lng) pairs along the full shape of a route, given as the 'edges'
+        and 'legs' of a route_between result, cut at its snapped start and end
+        points. With a tolerance (meters) the shape is Douglas-Peucker
+        simplified: edge by edge, then as a whole.
+        """
+        legs = route['legs']
+        edges = np.asarray(route['edges'], dtype=np.int64)
+        # Shapes of the first leg's edge, the whole edges and the last leg's edge, in that order
+        shape_edges = [legs[0][0]] if len(legs) == 1 else np.concatenate(([legs[0][0]], edges, [legs[1][0]]))
+        offsets, x, y = self._edge_geometry(shape_edges, tolerance)
+        start_x, start_y = self._project(start_point[0], start_point[1])
+        end_x, end_y = self._project(end_point[0], end_point[1])
+
+        def located(i, px, py):
+            # Position of a point along shape i, 0 at its source and 1 at its target
+            line = shapely.linestrings(x[offsets[i]:offsets[i + 1]], y[offsets[i]:offsets[i + 1]])
+            return float(shapely.line_locate_point(line, shapely.Point(px, py), normalized=True))
+
+        def inside(i, a, b):
+            # Points of shape i strictly between positions a and b
+            xs, ys = x[offsets[i]:offsets[i + 1]], y[offsets[i]:offsets[i + 1]]
+            along = np.concatenate(([0.0], np.cumsum(np.hypot(np.diff(xs), np.diff(ys)))))
+            if along[-1] <= 0:
+                return xs[:0], ys[:0]
+            keep = (along > a * along[-1]) & (along < b * along[-1])
+            return xs[keep], ys[keep]
+
+        parts_x, parts_y = [[float(start_x)]], [[float(start_y)]]
+        if len(legs) == 1:
+            # Start and end on one edge
+            xs, ys = inside(0, located(0, start_x, start_y), located(0, end_x, end_y))
+            parts_x.append(xs)
+            parts_y.append(ys)
+        else:
+            xs, ys = inside(0, located(0, start_x, start_y), 1.0)
+            node = offsets[1] - 1
+            parts_x += [xs, x[node:node + 1]]
+            parts_y += [ys, y[node:node + 1]]
+
+            # Whole edges, each without its first point (the previous edge's last)
+            whole = np.arange(1, len(edges) + 1)
+            counts = offsets[whole + 1] - offsets[whole] - 1
+            first = np.concatenate(([0], np.cumsum(counts)[:-1])) if len(edges) else counts
+            idx = np.arange(counts.sum()) + np.repeat(offsets[whole] + 1 - first, counts)
+            parts_x.append(x[idx])
+            parts_y.append(y[idx])
+
+            last = len(edges) + 1
+            xs, ys = inside(last, 0.0, located(last, end_x, end_y))
+            parts_x.append(xs)
+            parts_y.append(ys)
+        parts_x.append([float(end_x)])
+        parts_y.append([float(end_y)])
+        xs, ys = np.concatenate(parts_x), np.concatenate(parts_y)
+
+        if tolerance > 0 and len(xs) > 2:
+            line = shapely.simplify(shapely.linestrings(xs, ys), tolerance, preserve_topology=False)
+            coords = shapely.get_coordinates(line)
+            xs, ys = coords[:, 0], coords[:, 1]
+        lat, lng = self._unproject(xs, ys)
+        return list(zip(lat.tolist(), lng.tolist()))
+
+
+def encode_polyline(coords, precision=POLYLINE_PRECISION):
+    """(lat, lng) pairs in Google's encoded polyline format"""
+    values = np.round(np.asarray(coords, dtype=np.float64).reshape(-1, 2) * 10 ** precision).astype(np.int64)
+    deltas = np.diff(values, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+    # Zigzag: the sign moves to the lowest bit, then 5-bit chunks, least significant first
+    shifted = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+    chars = []
+    for value in shifted.tolist():
+        while value >= 0x20:
+            chars.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        chars.append(chr(value + 63))
+    return ''.join(chars)
+
+
+def route_summary(result):
+    """Stats of a calculate_route_improved result, without node lists or profiles"""
+    return {key: result[key] for key in ROUTE_SUMMARY_KEYS}
+
+
+def zoom_tolerance(zoom, lat):
+    """Coarsest of SIMPLIFY_TOLERANCES_M within one screen pixel at a web map zoom level"""
+    meters_per_pixel = 2 * math.pi * EARTH_RADIUS_M * math.cos(math.radians(lat)) / (256 * 2 ** zoom)
+    return max(tolerance for tolerance in SIMPLIFY_TOLERANCES_M if tolerance <= meters_per_pixel)
+
+
+def route_shape(network, result, name, tolerance=0.0):
+    """(lat, lng) shape of the 'fastest' or 'safest' route of a calculate_route_improved result"""
+    route = {'edges': result[f'{name}_edges'], 'legs': result[f'{name}_legs']}
+    return network.route_geometry(route, result['start_point'], result['end_point'], tolerance)
+
+
+def route_polylines(network, result, tolerances=SIMPLIFY_TOLERANCES_M):
+    """
+    Fastest and safest routes of a result as encoded polylines, one per
+    simplification tolerance so a map can switch detail as it zooms
+    """
+    polylines = {'tolerances': list(tolerances)}
+    for name in ('fastest', 'safest'):
+        polylines[name] = [encode_polyline(route_shape(network, result, name, tolerance))
+                           for tolerance in tolerances]
+    return polylines
+
+
+def route_geojson(network, result, tolerance=0.0):
+    """
+    GeoJSON FeatureCollection of a result: both routes as LineStrings
+    (simplified to tolerance meters), their high-risk points, and the start
+    and end points
+    """
+    features = []
+    for name in ('fastest', 'safest'):
+        coords = route_shape(network, result, name, tolerance)
+        features.append({
+            'type': 'Feature',
+            'geometry': {'type': 'LineString', 'coordinates': [[lng, lat] for lat, lng in coords]},
+            'properties': {'kind': 'route', 'route': name, 'time': result[f'{name}_time'],
+                           'risk': result[f'{name}_risk']},
+        })
+        features.extend({
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [point['lng'], point['lat']]},
+            'properties': {'kind': 'risk_point', 'route': name, 'risk': point['risk']},
+        } for point in result[f'{name}_risk_points'])
+    for kind in ('start', 'end'):
+        lat, lng = result[f'{kind}_point']
+        features.append({
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [lng, lat]},
+            'properties': {'kind': kind},
+        })
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def snapshot_path(city, data_dir='data'):
+    return os.path.join(data_dir, f'{city}_network')
+
+
+def load_network(city, data_dir='data', mmap_mode='r'):
+    """
+    Load a city network from its snapshot, memory-mapped read-only by default,
+    falling back to parsing the GraphML
+    """
+    path = snapshot_path(city, data_dir)
+    if os.path.exists(os.path.join(path, 'meta.json')):
+        return RouteNetwork.load(path, mmap_mode=mmap_mode)
+    print(f"No network snapshot at {path}; parsing GraphML (compile one with `python route_engine.py {city}`)")
+    import osmnx as ox
+    return RouteNetwork.from_graph(ox.load_graphml(os.path.join(data_dir, f'{city}_network.graphml')))
+
+
+def load_city_outlines(data_dir='data'):
+    """City name -> outline polygon, from the GeoJSON city list in data_dir"""
+    with open(os.path.join(data_dir, CITIES_FILE)) as f:
+        features = json.load(f)['features']
+    return {feature['properties']['name']: shapely.geometry.shape(feature['geometry'])
+            for feature in features}
+
+
+def register_city(city, outline, data_dir='data', replace=False):
+    """Add a city outline to the GeoJSON city list, keeping existing (possibly hand-drawn) ones"""
+    path = os.path.join(data_dir, CITIES_FILE)
+    collection = {'type': 'FeatureCollection', 'features': []}
+    if os.path.exists(path):
+        with open(path) as f:
+            collection = json.load(f)
+    features = collection['features']
+    existing = [i for i, feature in enumerate(features) if feature['properties']['name'] == city]
+    if existing and not replace:
+        return False
+    feature = {'type': 'Feature', 'properties': {'name': city},
+               'geometry': shapely.geometry.mapping(outline)}
+    if existing:
+        features[existing[0]] = feature
+    else:
+        features.append(feature)
+    with open(path, 'w') as f:
+        json.dump(collection, f, indent=2)
+        f.write('\n')
+    return True
+
+
+def load_city(city, data_dir='data'):
+    """A city's network with any precomputed hierarchies attached"""
+    network = load_network(city, data_dir)
+    network.hierarchy = load_hierarchy(network, hierarchy_path(city, data_dir))
+    network.customizable = load_customizable(network, customizable_path(city, data_dir))
+    return network
+
+
+class NetworkRegistry:
+    """
+    Supported cities, read from the city list in the data directory, and their
+    networks, loaded on first request. locate() finds the city containing a
+    point through a spatial index over the city outlines. Once the estimated
+    size of the resident networks exceeds the memory budget, the least
+    recently used cities are dropped (and simply reloaded if asked for
+    again). Safe to share between threads; each city is loaded at most once
+    at a time.
+    """
+
+    def __init__(self, data_dir='data', memory_budget_mb=NETWORK_MEMORY_BUDGET_MB, outlines=None,
+                 risk_source=None):
+        if outlines is None:
+            outlines = load_city_outlines(data_dir)
+        self.cities = tuple(outlines)
+        self.outlines = [outlines[city] for city in self.cities]
+        self._outline_tree = shapely.STRtree(self.outlines)
+        self._outline_area = shapely.area(self.outlines)
+        self.data_dir = data_dir
+        # Optional risk_layer.RiskSource that networks take their risk scores from
+        self.risk_source = risk_source
+        self.risk_version = 0
+        self._refresh_lock = threading.Lock()
+        self._watcher_lock = threading.Lock()
+        self._watcher_pid = None
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self._networks = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading = {city: threading.Lock() for city in self.cities}
+
+    def locate(self, lat, lng):
+        """
+        Name of the city whose outline contains the point, or None. Where
+        outlines overlap the smallest one wins, being the more specific.
+        """
+        hits = self._outline_tree.query(shapely.Point(lng, lat), predicate='intersects')
+        if not len(hits):
+            return None
+        return self.cities[hits[np.argmin(self._outline_area[hits])]]
+
+    def locate_many(self, lat, lng):
+        """locate() for arrays of points, as a list of city names (None outside all outlines)"""
+        points = shapely.points(np.column_stack([np.atleast_1d(lng), np.atleast_1d(lat)]))
+        point_idx, outline_idx = self._outline_tree.query(points, predicate='intersects')
+        # Hits sorted by point, then area: the first hit of each point is its smallest outline
+        order = np.lexsort((self._outline_area[outline_idx], point_idx))
+        point_idx, outline_idx = point_idx[order], outline_idx[order]
+        first = np.unique(point_idx, return_index=True)[1]
+        found = np.full(len(points), -1)
+        found[point_idx[first]] = outline_idx[first]
+        return [self.cities[i] if i >= 0 else None for i in found.tolist()]
+
+    def get(self, city):
+        """Network for city, loading it if it isn't resident"""
+        if city not in self._loading:
+            raise KeyError(f"Unknown city '{city}', expected one of {self.cities}")
+        network = self._touch(city)
+        if network is not None:
+            return network
+        with self._loading[city]:
+            # Another thread may have loaded it while we waited
+            network = self._touch(city)
+            if network is not None:
+                return network
+            print(f"Loading {city.title()} network...")
+            network = load_city(city, self.data_dir)
+            risk = self.risk_source.edge_risk(city, network) if self.risk_source is not None else None
+            if risk is not None:
+                network = network.with_risk(risk, self.risk_version)
+            else:
+                network.risk_version = self.risk_version
+            with self._lock:
+                self._networks[city] = network
+                self._evict_over_budget(keep=city)
+        return network
+
+    def _touch(self, city):
+        with self._lock:
+            network = self._networks.get(city)
+            if network is not None:
+                self._networks.move_to_end(city)
+            return network
+
+    def _evict_over_budget(self, keep):
+        if self.memory_budget <= 0:
+            return
+        while self.resident_bytes > self.memory_budget and len(self._networks) > 1:
+            city = next(iter(self._networks))
+            if city == keep:
+                break
+            del self._networks[city]
+            print(f"Evicted {city.title()} network to stay within the memory budget")
+
+    @property
+    def resident(self):
+        return list(self._networks)
+
+    @property
+    def resident_bytes(self):
+        return sum(network.nbytes for network in self._networks.values())
+
+    def evict(self, city):
+        with self._lock:
+            self._networks.pop(city, None)
+
+    def refresh_risk(self):
+        """
+        Re-score every resident city from the risk source and swap in the new
+        networks. Requests already running keep the network they started with.
+        Returns the number of edges whose risk changed, per city.
+        """
+        if self.risk_source is None:
+            return {}
+        with self._refresh_lock:
+            version = self.risk_version + 1
+            changed = {}
+            for city in self.resident:
+                with self._loading[city]:
+                    network = self._touch(city)
+                    if network is None:
+                        continue
+                    risk = self.risk_source.edge_risk(city, network)
+                    if risk is None:
+                        risk = network.risk
+                    changed[city] = int(np.count_nonzero(np.abs(clean_nonnegative(risk) - network.risk) > 1e-9))
+                    refreshed = network.with_risk(risk, version)
+                    with self._lock:
+                        if city in self._networks:
+                            self._networks[city] = refreshed
+            # Cities loaded from now on start at the new version too
+            self.risk_version = version
+        print(f"Risk refreshed to version {version}: {changed}")
+        return changed
+
+    def watch_risk(self):
+        """
+        Make sure this process polls the risk source on a background thread,
+        re-scoring resident cities when its files change, so no request waits
+        for the re-scoring. Cheap enough to call on every request: threads
+        don't survive a fork, so each process starts its own on first call.
+        """
+        if self.risk_source is None:
+            return
+        with self._watcher_lock:
+            if self._watcher_pid == os.getpid():
+                return
+            self._watcher_pid = os.getpid()
+            threading.Thread(target=self._watch_risk, name='risk-watcher', daemon=True).start()
+
+    def _watch_risk(self):
+        while True:
+            time.sleep(self.risk_source.poll_seconds)
+            try:
+                if self.risk_source.poll(force=True):
+                    self.refresh_risk()
+            except Exception as e:
+                print(f"Risk refresh failed: {e}")
+
+    def prewarm(self, cities=PREWARM_CITIES):
+        """Load cities up front, e.g. before forking workers so they share them"""
+        if 'all' in cities:
+            cities = self.cities
+        for city in cities:
+            self.get(city)
+
+
+def _search_modes(network, search):
+    """
+    Search used for the fastest and for the safest route. Any search but
+    'hierarchy' is used as asked; 'hierarchy' picks the Contraction
+    Hierarchies the network has and falls back to Dijkstra without them.
+    """
+    if search not in ROUTE_SEARCHES:
+        raise ValueError(f"Unknown search mode '{search}', expected one of {ROUTE_SEARCHES}")
+    if search != 'hierarchy':
+        return search, search
+    # The fastest metric is static, so a precomputed hierarchy answers it directly
+    if network.hierarchy is not None:
+        fastest_search = 'ch'
+    else:
+        fastest_search = 'cch' if network.customizable is not None else 'dijkstra'
+    # Risk-weighted metrics vary per request; a customizable hierarchy adapts to each
+    safest_search = 'cch' if network.customizable is not None else 'dijkstra'
+    return fastest_search, safest_search
+
+
+def _safest_weights(network, risk_weight, safest_search):
+    """Weights for the safest route, with risk_weight rounded to CCH_RISK_STEP for 'cch' searches"""
+    risk_weight = check_risk_weight(risk_weight)
+    if safest_search == 'cch':
+        risk_weight = round(round(risk_weight / CCH_RISK_STEP) * CCH_RISK_STEP, 10)
+    return network.weights(risk_weight)
+
+
+def _route_result(network, fastest, fastest_stats, safest, safest_stats, orig_snap, dest_snap):
+    """Result dict of calculate_route_improved from its two routes and their route_stats"""
+    fastest_time, safest_time = fastest_stats['time'], safest_stats['time']
+    fastest_total_risk, safest_total_risk = fastest_stats['risk'], safest_stats['risk']
+
+    # Calculate risk reduction
+    risk_reduction = 0
+    if fastest_total_risk > 0:
+        risk_reduction = max(0, (fastest_total_risk - safest_total_risk) / fastest_total_risk)
+
+    return {
+        'fastest_route': fastest['nodes'],
+        'safest_route': safest['nodes'],
+        # Edge ids and partial end legs, for the routes' full geometry (see route_shape)
+        'fastest_edges': [int(edge) for edge in fastest['edges']],
+        'safest_edges': [int(edge) for edge in safest['edges']],
+        'fastest_legs': [(int(edge), float(fraction)) for edge, fraction in fastest['legs']],
+        'safest_legs': [(int(edge), float(fraction)) for edge, fraction in safest['legs']],
+        'fastest_time': fastest_time,
+        'safest_time': safest_time,
+        'fastest_risk': fastest_total_risk,
+        'safest_risk': safest_total_risk,
+        'fastest_risk_points': fastest_stats['risk_points'],
+        'safest_risk_points': safest_stats['risk_points'],
+        'fastest_profile': {'time': fastest_stats['time_profile'], 'risk': fastest_stats['risk_profile']},
+        'safest_profile': {'time': safest_stats['time_profile'], 'risk': safest_stats['risk_profile']},
+        'time_difference': safest_time - fastest_time,
+        'risk_reduction': risk_reduction,
+        'start_point': (orig_snap.lat, orig_snap.lng),
+        'end_point': (dest_snap.lat, dest_snap.lng),
+        'risk_version': network.risk_version
+    }
+
+
+def calculate_route_improved(network, origin, destination, risk_weight=0.5, search=None):
+    """
+    Improved route calculation with network connectivity handling.
+    search selects the algorithm (see ROUTE_SEARCHES); defaults to ROUTE_SEARCH.
+    Results are cached on the network (see ROUTE_CACHE_SIZE), so the same
+    dict may be returned to several callers: treat it as read-only.
+    """
+    search = search or DEFAULT_SEARCH
+    fastest_search, safest_search = _search_modes(network, search)
+    # Raises for an invalid risk_weight before any search runs
+    risk_weight = check_risk_weight(risk_weight)
+    safest_weights = _safest_weights(network, risk_weight, safest_search)
+
+    # Snap origin and destination onto the nearest routable edges. Only edges in the
+    # main component are indexed, so any two snapped points are connected.
+    orig_snap = network.snap(origin[0], origin[1])
+    dest_snap = network.snap(destination[0], destination[1])
+
+    # Repeated trips skip both searches. The cache belongs to this network object,
+    # so reloading the network or refreshing its risk data starts a fresh one.
+    cache_key = network.route_key(orig_snap, dest_snap, risk_weight, search)
+    cached = network.route_cache.get(cache_key)
+    if cached is not None:
+        print(f"Route cache hit: edge {orig_snap.edge} -> edge {dest_snap.edge}, risk weight {risk_weight}")
+        return cached
+
+    print(f"Origin edge: {orig_snap.edge} ({orig_snap.distance:.0f}m away), "
+          f"Destination edge: {dest_snap.edge} ({dest_snap.distance:.0f}m away)")
+    print(f"Risk weight: {risk_weight}, search: {search}")
+
+    # Calculate fastest route (baseline) - using length only
+    try:
+        fastest = network.route_between(orig_snap, dest_snap, network.length, fastest_search)
+        if fastest is None:
+            raise nx.NetworkXNoPath("No path between the snapped locations")
+        fastest_stats = network.route_stats(fastest)
+
+        print(f"Fastest route: {len(fastest['nodes'])} nodes, {fastest_stats['time']:.1f}s, "
+              f"risk: {fastest_stats['risk']:.2f}, settled: {fastest['settled']}")
+
+    except Exception as e:
+        print(f"Error calculating fastest route: {e}")
+        raise ValueError(f"Cannot find route between the specified locations: {e}")
+
+    # Calculate safest route using risk-aware weights
+    try:
+        safest = network.route_between(orig_snap, dest_snap, safest_weights, safest_search)
+        if safest is None:
+            raise nx.NetworkXNoPath("No path between the snapped locations")
+        safest_stats = network.route_stats(safest)
+
+        print(f"Safest route: {len(safest['nodes'])} nodes, {safest_stats['time']:.1f}s, "
+              f"risk: {safest_stats['risk']:.2f}, settled: {safest['settled']}")
+
+    except Exception as e:
+        print(f"Error calculating safest route: {e}")
+        # Fallback to fastest route if safest fails
+        safest, safest_stats = fastest, fastest_stats
+
+    result = _route_result(network, fastest, fastest_stats, safest, safest_stats, orig_snap, dest_snap)
+
+    print(f"Risk reduction: {result['risk_reduction']*100:.1f}%")
+    print(f"Time difference: {result['time_difference']/60:.1f} minutes")
+
+    network.route_cache.put(cache_key, result)
+    return result
+
+
+def pareto_routes(network, origin, destination, max_risk_weight=PARETO_MAX_RISK_WEIGHT,
+                  max_routes=PARETO_MAX_ROUTES, search=None):
+    """
+    Trade-off routes between travel time and risk in one call, so a client can
+    move along the frontier without re-geocoding or re-routing.
+
+    The risk-aware cost of a route is its time plus risk_weight times its risk
+    penalty, i.e. linear in risk_weight. Starting from the routes optimal at
+    0 and max_risk_weight, each step searches at the risk_weight where two
+    neighbouring routes cost the same; a cheaper route there is a new frontier
+    point, otherwise the segment is final. This finds every route that is
+    optimal for some risk_weight in the range (the supported Pareto set).
+
+    The frontier starts from the fastest route of calculate_route_improved
+    (shortest distance). Routes are dropped when another one has both less
+    time and less risk, so the fastest route is left out if something beats
+    it on both. Returns the routes ordered from fastest to safest, each with
+    the risk_weight it was found at.
+    """
+    search = search or DEFAULT_SEARCH
+    fastest_search, safest_search = _search_modes(network, search)
+    max_risk_weight = check_risk_weight(max_risk_weight)
+    # Frontier steps search at arbitrary risk weights, each of which would cost
+    # a customizable hierarchy a customisation, so they stay on Dijkstra
+    if safest_search == 'cch':
+        safest_search = 'dijkstra'
+    orig_snap = network.snap(origin[0], origin[1])
+    dest_snap = network.snap(destination[0], destination[1])
+    penalty = network.time * network.risk * 0.5
+
+    def solve(risk_weight, weights=None, search=safest_search):
+        if weights is None and risk_weight == max_risk_weight:
+            weights = network.weights(risk_weight)
+        elif weights is None:
+            # Interior weights are used once: keep them out of the weight and
+            # adjacency-list caches, which the heap-based searches would fill
+            weights = network._risk_metric(risk_weight)
+            search = 'dijkstra'
+        found = network.route_between(orig_snap, dest_snap, weights, search)
+        if found is None:
+            raise nx.NetworkXNoPath("No path between the snapped locations")
+        # Split the cost into its risk_weight-independent and per-unit parts
+        stats = network.route_stats(found)
+        found['time'], found['risk'] = stats['time'], stats['risk']
+        found['penalty'] = float(penalty[found['edges']].sum()) + sum(
+            penalty[edge] * fraction for edge, fraction in found['legs'])
+        found['risk_weight'] = risk_weight
+        return found
+
+    # The same fastest route as calculate_route_improved, by distance
+    fastest = solve(0.0, network.length, fastest_search)
+    safest = solve(float(max_risk_weight))
+    frontier = [fastest]
+    if safest['penalty'] < fastest['penalty'] - 1e-9:
+        frontier.append(safest)
+
+    # Neighbouring frontier routes (by index) that may still have one between them
+    pending = [1] if len(frontier) == 2 else []
+    while pending and len(frontier) < max_routes:
+        i = pending.pop()
+        left, right = frontier[i - 1], frontier[i]
+        risk_weight = (right['time'] - left['time']) / (left['penalty'] - right['penalty'])
+        if not 0.0 < risk_weight < max_risk_weight:
+            continue
+        found = solve(risk_weight)
+        line = left['time'] + risk_weight * left['penalty']
+        if found['time'] + risk_weight * found['penalty'] < line * (1 - 1e-9):
+            frontier.insert(i, found)
+            pending = [j + (j > i) for j in pending] + [i, i + 1]
+
+    # The scan weighs risk by the time x risk penalty, but routes report plain
+    # risk: keep only routes that no other route beats on both time and risk
+    frontier.sort(key=lambda found: (found['time'], found['risk']))
+    kept = []
+    for found in frontier:
+        if not kept or found['risk'] < kept[-1]['risk'] - 1e-9:
+            kept.append(found)
+    frontier = kept
+
+    print(f"Pareto frontier: {len(frontier)} routes for risk_weight 0-{max_risk_weight}")
+    return {
+        'routes': [{
+            'route': found['nodes'],
+            'edges': [int(edge) for edge in found['edges']],
+            'legs': [(int(edge), float(fraction)) for edge, fraction in found['legs']],
+            'time': found['time'],
+            'risk': found['risk'],
+            'risk_weight': float(found['risk_weight']),
+        } for found in frontier],
+        'start_point': (orig_snap.lat, orig_snap.lng),
+        'end_point': (dest_snap.lat, dest_snap.lng),
+        'risk_version': network.risk_version,
+    }
+
+
+def calculate_routes_batch(network, origins, destinations, risk_weight=0.5, search=None):
+    """
+    Fastest and safest routes for many (origin, destination) pairs in one
+    network, without the per-call overhead of calculate_route_improved.
+
+    All points snap in one spatial index query. Pairs leaving from the same
+    snapped point share their searches: one one-to-all Dijkstra tree per
+    metric serves every destination of that origin (with a hierarchy
+    attached, from ROUTE_BATCH_TREE_MIN destinations); other pairs use the
+    same searches as calculate_route_improved. Yields (index, result) in origin
+    order as each is done, result being a route_summary dict or None when the
+    pair has no route.
+    """
+    search = search or DEFAULT_SEARCH
+    fastest_search, safest_search = _search_modes(network, search)
+    safest_weights = _safest_weights(network, risk_weight, safest_search)
+    points = np.asarray(list(origins) + list(destinations), dtype=np.float64).reshape(-1, 2)
+    snaps = network.snap_all(points[:, 0], points[:, 1])
+    count = len(points) // 2
+    orig_snaps, dest_snaps = snaps[:count], snaps[count:]
+
+    groups = OrderedDict()
+    for i, snap in enumerate(orig_snaps):
+        groups.setdefault((snap.edge, snap.fraction), []).append(i)
+
+    for members in groups.values():
+        orig_snap = orig_snaps[members[0]]
+        trees = {}
+        for i in members:
+            dest_snap = dest_snaps[i]
+            routes = []
+            for weights, pair_search in ((network.length, fastest_search), (safest_weights, safest_search)):
+                # Hierarchy queries are so quick that a whole-city tree only pays off for many destinations
+                shared = len(members) >= (ROUTE_BATCH_TREE_MIN if pair_search in ('ch', 'cch') else 2)
+                if not shared:
+                    routes.append(network.route_between(orig_snap, dest_snap, weights, pair_search))
+                    continue
+                starts = network._snap_ends(orig_snap, weights, leaving=True)
+                ends = network._snap_ends(dest_snap, weights, leaving=False)
+                if id(weights) not in trees:
+                    trees[id(weights)] = network._dijkstra_tree(starts, weights)
+                best = network._same_edge_route(starts, ends, weights)
+                found = network._tree_route(trees[id(weights)], starts, ends, weights)
+                if found is not None and (best is None or found['cost'] < best['cost']):
+                    best = found
+                routes.append(best)
+            fastest, safest = routes
+            if fastest is None:
+                yield i, None
+                continue
+            if safest is None:
+                safest = fastest
+            result = _route_result(network, fastest, network.route_stats(fastest),
+                                   safest, network.route_stats(safest), orig_snap, dest_snap)
+            yield i, route_summary(result)
+
+
+def route_batch(registry, pairs, risk_weight=0.5, search=None):
+    """
+    Routes for many ((lat, lng), (lat, lng)) pairs across the cities of a
+    NetworkRegistry. Pairs are grouped by city and each group goes through
+    calculate_routes_batch. Yields one dict per pair as it is done, in no
+    particular order: {'index', 'city', 'result'} or {'index', 'error'}.
+    """
+    points = np.asarray(pairs, dtype=np.float64).reshape(-1, 2, 2)
+    start_cities = registry.locate_many(points[:, 0, 0], points[:, 0, 1])
+    end_cities = registry.locate_many(points[:, 1, 0], points[:, 1, 1])
+
+    by_city = OrderedDict()
+    for i, (start_city, end_city) in enumerate(zip(start_cities, end_cities)):
+        if start_city is None or end_city is None:
+            yield {'index': i, 'error': 'Point is not in a supported city'}
+        elif start_city != end_city:
+            yield {'index': i, 'error': f'Both points must be in the same city, not {start_city.title()} and {end_city.title()}'}
+        else:
+            by_city.setdefault(start_city, []).append(i)
+
+    for city, members in by_city.items():
+        network = registry.get(city)
+        print(f"Batch routing {len(members)} pairs in {city.title()}")
+        for j, result in calculate_routes_batch(network, points[members, 0], points[members, 1],
+                                                risk_weight, search):
+            if result is None:
+                yield {'index': members[j], 'error': 'No route between the points'}
+            else:
+                yield {'index': members[j], 'city': city.title(), 'result': result}
+
+
+def travel_matrix(network, origins, destinations=None, risk_weight=0.5, search=None):
+    """
+    Travel time and accumulated normalized risk between every origin and
+    every destination ((lat, lng) lists; destinations default to origins),
+    along the fastest and the safest route as calculate_route_improved picks
+    them. search picks the searches the same way: with 'hierarchy' the
+    attached hierarchies answer many-to-many, otherwise each origin (or
+    destination) gets a one-to-all Dijkstra search. Returns (origins, destinations) float arrays
+    fastest_time, fastest_risk, safest_time and safest_risk, inf where there
+    is no route.
+    """
+    search = search or DEFAULT_SEARCH
+    fastest_search, safest_search = _search_modes(network, search)
+    origins = np.asarray(origins, dtype=np.float64).reshape(-1, 2)
+    destinations = origins if destinations is None else np.asarray(destinations, dtype=np.float64).reshape(-1, 2)
+    orig_snaps = network.snap_all(origins[:, 0], origins[:, 1])
+    dest_snaps = network.snap_all(destinations[:, 0], destinations[:, 1])
+
+    matrices = {}
+    for name, weights, matrix_search in (
+            ('fastest', network.length, fastest_search),
+            ('safest', _safest_weights(network, risk_weight, safest_search), safest_search)):
+        _, (time_matrix, risk_matrix) = network.one_to_many(orig_snaps, dest_snaps, weights,
+                                                            [network.time, network.risk], matrix_search)
+        matrices[f'{name}_time'] = time_matrix
+        matrices[f'{name}_risk'] = risk_matrix
+    print(f"Travel matrix: {len(origins)} x {len(destinations)}")
+    return matrices
+
+
+if __name__ == '__main__':
+    # Compile GraphML networks into binary snapshots: python route_engine.py [city ...]
+    import osmnx as ox
+
+    for city in sys.argv[1:] or ['leeds', 'birmingham']:
+        print(f"Compiling {city.title()} network...")
+        network = RouteNetwork.from_graph(ox.load_graphml(f'data/{city}_network.graphml'))
+        network.save(snapshot_path(city))
+        print(f"Saved {snapshot_path(city)} ({network.num_nodes} nodes, {network.num_edges} edges)")
+        # New cities are registered with the convex hull of their network as outline
+        outline = shapely.MultiPoint(np.column_stack([network.lng, network.lat])).convex_hull
+        if register_city(city, outline):
+            print(f"Registered {city.title()} in data/{CITIES_FILE}")
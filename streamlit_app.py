@@ -1,16 +1,11 @@
 import streamlit as st
-import networkx as nx
 import folium
 from streamlit_folium import folium_static
-from geopy.distance import geodesic
-from geopy.geocoders import GoogleV3
-from geopy.exc import GeocoderTimedOut, GeocoderQuotaExceeded
-import pandas as pd
-import osmnx as ox
-import time
-import numpy as np
 import os
 from dotenv import load_dotenv
+from geocoding import GEOCODER, geocode_addresses, make_geocoder
+from risk_layer import RiskSource
+from route_engine import SIMPLIFY_TOLERANCES_M, NetworkRegistry, calculate_route_improved, route_shape
 
 # Load environment variables from .env file
 load_dotenv()
@@ -122,35 +117,34 @@ st.markdown("""
 </div>
 """, unsafe_allow_html=True)
 
-# Initialize Google Geocoder
+# Initialize the geocoder (see GEOCODER in geocoding.py)
 @st.cache_resource
 def initialize_geocoder():
     api_key = os.getenv('GOOGLE_MAPS_API_KEY')
     
-    if not api_key:
+    if not api_key and 'google' in GEOCODER:
         st.error("GOOGLE_MAPS_API_KEY not found in environment variables!")
         st.stop()
     
-    return GoogleV3(api_key=api_key, timeout=10)
+    # Local gazetteers first by default; Google's answers are cached in
+    # data/geocode_cache.sqlite across sessions and restarts
+    return make_geocoder(api_key=api_key)
 
 geolocator = initialize_geocoder()
 
 # Load precomputed data at startup
-@st.cache_data
+# One shared instance for all sessions; cache_data would copy the networks per session
+@st.cache_resource
 def load_cached_data():
     try:
         data = {}
         
-        # Load risk grids
-        data['risk_grid'] = pd.read_pickle('data/risk_grid.pkl')
-        
-        # Load networks
-        data['leeds_network'] = ox.load_graphml('data/leeds_network.graphml')
-        data['birmingham_network'] = ox.load_graphml('data/birmingham_network.graphml')
+        # Risk data: the geohash risk grid plus any refreshed edge scores (see RISK_SOURCE)
+        data['risk'] = RiskSource()
         
-        # Load edges with risk scores
-        data['leeds_edges'] = pd.read_pickle('data/leeds_edges.pkl')
-        data['birmingham_edges'] = pd.read_pickle('data/birmingham_edges.pkl')
+        # City networks load on first use (PREWARM_CITIES up front)
+        data['networks'] = NetworkRegistry(risk_source=data['risk'])
+        data['networks'].prewarm()
         
         return data
     except Exception as e:
@@ -162,216 +156,13 @@ def load_cached_data():
 with st.spinner("Loading network data..."):
     cached_data = load_cached_data()
 
-def get_lat_lng(address):
-    """Get latitude and longitude from address using Google Geocoding API"""
-    try:
-        if not any(city in address.lower() for city in ['leeds', 'birmingham']):
-            # Try both cities
-            leeds_address = f"{address}, Leeds, UK"
-            birmingham_address = f"{address}, Birmingham, UK"
-            
-            try:
-                leeds_location = geolocator.geocode(leeds_address)
-                if leeds_location:
-                    lat, lng = leeds_location.latitude, leeds_location.longitude
-                    in_area, city = is_in_supported_area(lat, lng)
-                    if in_area and city == 'leeds':
-                        return lat, lng
-            except:
-                pass
-            
-            try:
-                birmingham_location = geolocator.geocode(birmingham_address)
-                if birmingham_location:
-                    lat, lng = birmingham_location.latitude, birmingham_location.longitude
-                    in_area, city = is_in_supported_area(lat, lng)
-                    if in_area and city == 'birmingham':
-                        return lat, lng
-            except:
-                pass
-        else:
-            location = geolocator.geocode(f"{address}, UK")
-            if location:
-                return location.latitude, location.longitude
-        
-        return None, None
-        
-    except (GeocoderTimedOut, GeocoderQuotaExceeded) as e:
-        st.error(f"Geocoding error for address '{address}': {e}")
-        return None, None
-    except Exception as e:
-        st.error(f"Unexpected geocoding error for address '{address}': {e}")
-        return None, None
-
 def is_in_supported_area(lat, lng):
     """Check if coordinates are in supported areas"""
-    leeds_bbox = (53.6989675, -1.8004214, 53.9458715, -1.2903516)
-    birmingham_bbox = (52.381053, -2.0336486, 52.6087058, -1.7288417)
-    
-    in_leeds = (leeds_bbox[0] <= lat <= leeds_bbox[2] and 
-                leeds_bbox[1] <= lng <= leeds_bbox[3])
-    in_birmingham = (birmingham_bbox[0] <= lat <= birmingham_bbox[2] and 
-                     birmingham_bbox[1] <= lng <= birmingham_bbox[3])
-    
-    return in_leeds or in_birmingham, 'leeds' if in_leeds else 'birmingham'
+    city = cached_data['networks'].locate(lat, lng)
+    return city is not None, city
 
-def safe_numeric_conversion(value, default=0):
-    """Safely convert value to float, handling strings and other types"""
-    if value is None:
-        return default
-    if isinstance(value, (int, float)):
-        return float(value)
-    if isinstance(value, str):
-        try:
-            return float(value)
-        except ValueError:
-            return default
-    if isinstance(value, list) and value:
-        try:
-            return float(value[0])
-        except (ValueError, TypeError):
-            return default
-    return default
-
-def calculate_route_improved(network, origin, destination, risk_weight=0.5):
-    """Improved route calculation with network connectivity handling"""
-    
-    # Find nearest nodes
-    orig_node = ox.distance.nearest_nodes(network, origin[1], origin[0])
-    dest_node = ox.distance.nearest_nodes(network, destination[1], destination[0])
-    
-    # Check if nodes are in the same connected component
-    if not nx.has_path(network, orig_node, dest_node):
-        # Find the largest connected component
-        largest_cc = max(nx.connected_components(network.to_undirected()), key=len)
-        
-        # Find nearest nodes that are in the largest connected component
-        cc_nodes = list(largest_cc)
-        cc_coords = [(network.nodes[node]['y'], network.nodes[node]['x']) for node in cc_nodes]
-        
-        # Find closest nodes in connected component
-        distances = [geodesic((origin[0], origin[1]), coord).meters for coord in cc_coords]
-        min_idx = np.argmin(distances)
-        orig_node = cc_nodes[min_idx]
-        
-        distances = [geodesic((destination[0], destination[1]), coord).meters for coord in cc_coords]
-        min_idx = np.argmin(distances)
-        dest_node = cc_nodes[min_idx]
-    
-    # Verify we now have a valid path
-    if not nx.has_path(network, orig_node, dest_node):
-        raise ValueError("Cannot find any connected path between the locations.")
-    
-    # Calculate fastest route (baseline)
-    fastest_route = nx.shortest_path(network, orig_node, dest_node, weight='length')
-    
-    # Calculate actual travel time for fastest route
-    fastest_time = 0
-    fastest_total_risk = 0
-    
-    for i in range(len(fastest_route) - 1):
-        u, v = fastest_route[i], fastest_route[i + 1]
-        edge_data = network.get_edge_data(u, v)
-        
-        if edge_data:
-            edge = list(edge_data.values())[0]
-            
-            if 'base_travel_time' in edge:
-                base_time = safe_numeric_conversion(edge['base_travel_time'])
-                fastest_time += base_time
-            else:
-                length = safe_numeric_conversion(edge.get('length', 0))
-                speed_ms = 50 * 1000 / 3600  # 50 km/h in m/s
-                fastest_time += length / speed_ms if speed_ms > 0 else 0
-            
-            risk = safe_numeric_conversion(edge.get('normalized_risk', 0))
-            fastest_total_risk += risk
-    
-    # Create custom weight function that balances time and risk
-    def risk_aware_weight(u, v, d):
-        if 'base_travel_time' in d:
-            base_time = safe_numeric_conversion(d['base_travel_time'])
-        else:
-            length = safe_numeric_conversion(d.get('length', 0))
-            max_speed = d.get('maxspeed', 50)
-            max_speed = safe_numeric_conversion(max_speed, 50)
-            speed_ms = max_speed * 1000 / 3600
-            base_time = length / speed_ms if speed_ms > 0 else length / 13.89
-        
-        risk_score = safe_numeric_conversion(d.get('normalized_risk', 0))
-        risk_penalty = 1 + (risk_weight * risk_score * 0.5)
-        total_weight = base_time * risk_penalty
-        
-        return total_weight
-    
-    # Calculate safest route using risk-aware weights
-    try:
-        safest_route = nx.shortest_path(network, orig_node, dest_node, weight=risk_aware_weight)
-    except Exception:
-        safest_route = fastest_route
-    
-    # Calculate actual travel time and risk for safest route
-    safest_time = 0
-    safest_total_risk = 0
-    
-    for i in range(len(safest_route) - 1):
-        u, v = safest_route[i], safest_route[i + 1]
-        edge_data = network.get_edge_data(u, v)
-        
-        if edge_data:
-            edge = list(edge_data.values())[0]
-            
-            if 'base_travel_time' in edge:
-                base_time = safe_numeric_conversion(edge['base_travel_time'])
-                safest_time += base_time
-            else:
-                length = safe_numeric_conversion(edge.get('length', 0))
-                speed_ms = 50 * 1000 / 3600
-                safest_time += length / speed_ms if speed_ms > 0 else 0
-            
-            risk = safe_numeric_conversion(edge.get('normalized_risk', 0))
-            safest_total_risk += risk
-    
-    # Calculate risk reduction
-    risk_reduction = 0
-    if fastest_total_risk > 0:
-        risk_reduction = max(0, (fastest_total_risk - safest_total_risk) / fastest_total_risk)
-    
-    # Calculate high-risk points for visualization
-    def get_high_risk_points(route, threshold=2.0):
-        risk_points = []
-        for i in range(len(route) - 1):
-            u, v = route[i], route[i + 1]
-            edge_data = network.get_edge_data(u, v)
-            
-            if edge_data:
-                edge = list(edge_data.values())[0]
-                risk_val = safe_numeric_conversion(edge.get('normalized_risk', 0))
-                
-                if risk_val > threshold:
-                    node_data = network.nodes[u]
-                    risk_points.append({
-                        'lat': node_data['y'],
-                        'lng': node_data['x'],
-                        'risk': risk_val
-                    })
-        return risk_points
-    
-    fastest_risk_points = get_high_risk_points(fastest_route)
-    safest_risk_points = get_high_risk_points(safest_route)
-    
-    return {
-        'fastest_route': fastest_route,
-        'safest_route': safest_route,
-        'fastest_time': fastest_time,
-        'safest_time': safest_time,
-        'fastest_risk': fastest_total_risk,
-        'safest_risk': safest_total_risk,
-        'fastest_risk_points': fastest_risk_points,
-        'safest_risk_points': safest_risk_points,
-        'time_difference': safest_time - fastest_time,
-        'risk_reduction': risk_reduction
-    }
+def supported_cities():
+    return ', '.join(city.title() for city in cached_data['networks'].cities)
 
 def generate_route_map(network, result, start_lat, start_lng, end_lat, end_lng):
     """Generate Folium map with routes"""
@@ -380,8 +171,11 @@ def generate_route_map(network, result, start_lat, start_lng, end_lat, end_lng):
     
     m = folium.Map(location=[center_lat, center_lng], zoom_start=12)
     
+    # Routes follow the road shapes, simplified to street-level detail
+    detail = SIMPLIFY_TOLERANCES_M[1]
+    
     # Add fastest route in red
-    fastest_coords = [(network.nodes[node]['y'], network.nodes[node]['x']) for node in result['fastest_route']]
+    fastest_coords = route_shape(network, result, 'fastest', detail)
     folium.PolyLine(
         fastest_coords, 
         color='red', 
@@ -391,7 +185,7 @@ def generate_route_map(network, result, start_lat, start_lng, end_lat, end_lng):
     ).add_to(m)
     
     # Add safest route in green
-    safest_coords = [(network.nodes[node]['y'], network.nodes[node]['x']) for node in result['safest_route']]
+    safest_coords = route_shape(network, result, 'safest', detail)
     folium.PolyLine(
         safest_coords, 
         color='green', 
@@ -486,17 +280,14 @@ if submit_button:
     else:
         with st.spinner("Calculating optimal routes..."):
             try:
-                # Geocode addresses
-                start_lat, start_lng = get_lat_lng(start_address)
+                # Geocode addresses (both at once; the geocoder rate-limits itself)
+                (start_lat, start_lng), (end_lat, end_lng) = geocode_addresses(
+                    geolocator, cached_data['networks'], start_address, end_address, report=st.error)
                 
                 if not start_lat or not start_lng:
                     st.error(f"Could not find location for start address: {start_address}")
                     st.stop()
                 
-                time.sleep(0.1)  # Rate limiting
-                
-                end_lat, end_lng = get_lat_lng(end_address)
-                
                 if not end_lat or not end_lng:
                     st.error(f"Could not find location for end address: {end_address}")
                     st.stop()
@@ -506,11 +297,11 @@ if submit_button:
                 end_in_area, end_city = is_in_supported_area(end_lat, end_lng)
                 
                 if not start_in_area:
-                    st.error(f"Start address is not in Leeds or Birmingham (found coordinates: {start_lat:.4f}, {start_lng:.4f})")
+                    st.error(f"Start address is not in a supported city ({supported_cities()}) (found coordinates: {start_lat:.4f}, {start_lng:.4f})")
                     st.stop()
                 
                 if not end_in_area:
-                    st.error(f"End address is not in Leeds or Birmingham (found coordinates: {end_lat:.4f}, {end_lng:.4f})")
+                    st.error(f"End address is not in a supported city ({supported_cities()}) (found coordinates: {end_lat:.4f}, {end_lng:.4f})")
                     st.stop()
                 
                 if start_city != end_city:
@@ -518,10 +309,9 @@ if submit_button:
                     st.stop()
                 
                 # Get appropriate network
-                if start_city == 'leeds':
-                    network = cached_data['leeds_network']
-                else:
-                    network = cached_data['birmingham_network']
+                # New risk scores are swapped in by a background thread when the risk files are replaced
+                cached_data['networks'].watch_risk()
+                network = cached_data['networks'].get(start_city)
                 
                 # Calculate routes
                 result = calculate_route_improved(network, (start_lat, start_lng), (end_lat, end_lng), risk_weight)
@@ -0,0 +1,84 @@
+import math
+import os
+import random
+import sys
+
+import networkx as nx
+import pytest
+import shapely
+from shapely.geometry import LineString
+
+# The modules live flat in the repository root, and the apps read data/ relative to it
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+# Geocode offline whichever module imports geocoding first; tests never call Google
+os.environ.setdefault('GEOCODER', 'fixture')
+
+from route_engine import EARTH_RADIUS_M, RouteNetwork, register_city, snapshot_path  # noqa: E402
+
+# Synthetic cities: name -> south-west corner of its street grid
+TEST_CITIES = {'testford': (53.78, -1.56), 'otherton': (52.45, -1.90)}
+
+
+def great_circle(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+def street_grid(rows=14, cols=14, lat0=53.78, lng0=-1.56, seed=1):
+    """Jittered street grid in the shape of an OSMnx graph, with one-way,
+    parallel and curved streets, missing blocks and a detached fragment"""
+    rnd = random.Random(seed)
+    graph = nx.MultiDiGraph(crs='epsg:4326')
+    for r in range(rows):
+        for c in range(cols):
+            graph.add_node(r * cols + c, y=lat0 + r * 0.002 + rnd.uniform(-3e-4, 3e-4),
+                           x=lng0 + c * 0.003 + rnd.uniform(-3e-4, 3e-4))
+
+    def add(u, v):
+        a, b = graph.nodes[u], graph.nodes[v]
+        data = {'length': great_circle(a['y'], a['x'], b['y'], b['x']),
+                'normalized_risk': str(round(max(0.0, rnd.gauss(1.0, 1.2)), 3))}
+        if rnd.random() < 0.7:
+            data['base_travel_time'] = str(data['length'] / rnd.choice([8.9, 13.4, 17.9]))
+        else:
+            data['maxspeed'] = rnd.choice(['20 mph', '30 mph', ['30 mph', '40 mph'], '50', 'national'])
+        if rnd.random() < 0.2:
+            bend = ((a['x'] + b['x']) / 2 + rnd.uniform(-4e-4, 4e-4), (a['y'] + b['y']) / 2 + rnd.uniform(-4e-4, 4e-4))
+            data['geometry'] = LineString([(a['x'], a['y']), bend, (b['x'], b['y'])])
+        graph.add_edge(u, v, **data)
+
+    for r in range(rows):
+        for c in range(cols):
+            for rr, cc in ((r, c + 1), (r + 1, c)):
+                if rr >= rows or cc >= cols or rnd.random() < 0.05:
+                    continue
+                u, v = r * cols + c, rr * cols + cc
+                add(u, v)
+                if rnd.random() < 0.9:
+                    add(v, u)
+                if rnd.random() < 0.03:
+                    add(u, v)
+
+    fragment = rows * cols
+    for i in range(3):
+        graph.add_node(fragment + i, y=lat0 - 0.01 + i * 0.001, x=lng0 - 0.01)
+    for i in range(2):
+        add(fragment + i, fragment + i + 1)
+        add(fragment + i + 1, fragment + i)
+    return graph
+
+
+@pytest.fixture(scope='session')
+def city_data(tmp_path_factory):
+    """Data directory with a snapshot and an outline for each of TEST_CITIES"""
+    data_dir = str(tmp_path_factory.mktemp('data'))
+    for seed, (city, (lat0, lng0)) in enumerate(TEST_CITIES.items(), 1):
+        network = RouteNetwork.from_graph(street_grid(lat0=lat0, lng0=lng0, seed=seed))
+        network.save(snapshot_path(city, data_dir))
+        outline = shapely.MultiPoint(list(zip(network.lng, network.lat))).convex_hull
+        register_city(city, outline, data_dir)
+    return data_dir
@@ -0,0 +1,136 @@
+import json
+
+import pytest
+
+import app
+from conftest import TEST_CITIES
+from geocoding import FixtureGeocoder
+from route_engine import NetworkRegistry, load_city_outlines
+
+BAD_RISK_WEIGHTS = [-5, -0.01, 'abc', None, 1e308, [0.5]]
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+@pytest.fixture
+def networks(city_data, monkeypatch):
+    """The app's registry, swapped for one over the synthetic TEST_CITIES"""
+    registry = NetworkRegistry(data_dir=city_data)
+    monkeypatch.setitem(app.cached_data, 'networks', registry)
+    return registry
+
+
+def city_points(city, count):
+    lat0, lng0 = TEST_CITIES[city]
+    return [[lat0 + 0.004 + 0.003 * i, lng0 + 0.005 + 0.004 * i] for i in range(count)]
+
+
+@pytest.mark.parametrize('body, expected', [
+    ({}, 0.5),
+    ({'risk_weight': 0}, 0.0),
+    ({'risk_weight': '0.3'}, 0.3),
+    ({'risk_weight': 2}, 2.0),
+])
+def test_parse_risk_weight_accepts_numbers(body, expected):
+    assert app.parse_risk_weight(body) == expected
+
+
+@pytest.mark.parametrize('risk_weight', BAD_RISK_WEIGHTS)
+def test_parse_risk_weight_rejects_invalid(risk_weight):
+    assert app.parse_risk_weight({'risk_weight': risk_weight}) is None
+
+
+@pytest.mark.parametrize('risk_weight', BAD_RISK_WEIGHTS)
+def test_get_route_rejects_invalid_risk_weight(client, risk_weight):
+    response = client.post('/get_route', json={'start': 'Leeds station', 'end': 'Leeds market',
+                                               'risk_weight': risk_weight})
+    assert response.status_code == 400
+    assert 'risk_weight' in response.get_json()['error']
+
+
+@pytest.fixture
+def geolocator(city_data, monkeypatch):
+    """Fixture geocoder placing addresses inside the TEST_CITIES outlines"""
+    geocoder = FixtureGeocoder(load_city_outlines(city_data))
+    monkeypatch.setattr(app, 'geolocator', geocoder)
+    return geocoder
+
+
+def test_get_route_returns_polylines(client, networks, geolocator):
+    response = client.post('/get_route', json={'start': 'Market Street, Testford', 'end': 'Station Road, Testford',
+                                               'format': 'polyline'})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['city'] == 'Testford'
+    assert 'fastest_nodes' not in body['result'] and body['result']['safest_time'] > 0
+    polylines = body['polylines']
+    assert len(polylines['fastest']) == len(polylines['safest']) == len(polylines['tolerances'])
+    # Coarser tolerances never need more characters
+    lengths = [len(text) for text in polylines['safest']]
+    assert lengths == sorted(lengths, reverse=True)
+
+
+def test_get_route_returns_geojson(client, networks, geolocator):
+    response = client.post('/get_route', json={'start': 'Market Street, Testford', 'end': 'Station Road, Testford',
+                                               'format': 'geojson', 'zoom': 14})
+    assert response.status_code == 200
+    features = response.get_json()['geojson']['features']
+    kinds = [feature['properties']['kind'] for feature in features]
+    assert kinds.count('route') == 2 and kinds.count('start') == kinds.count('end') == 1
+    start, = (feature for feature in features if feature['properties']['kind'] == 'start')
+    assert networks.locate(*reversed(start['geometry']['coordinates'])) == 'testford'
+
+
+@pytest.mark.parametrize('body', [{'format': 'svg'}, {'format': 'geojson', 'zoom': 'far'}])
+def test_get_route_rejects_unknown_formats_and_zooms(client, networks, geolocator, body):
+    response = client.post('/get_route', json={'start': 'Market Street, Testford', 'end': 'Station Road, Testford',
+                                               **body})
+    assert response.status_code == 400
+
+
+def test_routes_batch_streams_every_pair(client, networks):
+    points = city_points('testford', 4)
+    pairs = [[points[0], points[1]], [points[0], points[3]], [points[2], city_points('otherton', 1)[0]]]
+    response = client.post('/routes/batch', json={'pairs': pairs, 'risk_weight': 0.5})
+    assert response.status_code == 200
+    items = {item['index']: item for item in map(json.loads, response.get_data(as_text=True).splitlines())}
+    assert sorted(items) == [0, 1, 2]
+    assert items[0]['city'] == items[1]['city'] == 'Testford'
+    assert items[0]['result']['safest_time'] > 0
+    assert 'same city' in items[2]['error']
+
+
+@pytest.mark.parametrize('risk_weight', BAD_RISK_WEIGHTS)
+def test_routes_batch_rejects_invalid_risk_weight(client, networks, risk_weight):
+    pairs = [city_points('testford', 2)]
+    response = client.post('/routes/batch', json={'pairs': pairs, 'risk_weight': risk_weight})
+    assert response.status_code == 400
+    assert 'risk_weight' in response.get_json()['error']
+
+
+def test_routes_matrix_returns_a_row_per_origin(client, networks):
+    points = city_points('testford', 5)
+    response = client.post('/routes/matrix', json={'origins': points[:3], 'destinations': points[3:]})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['city'] == 'Testford'
+    for name in ('fastest_time', 'safest_time', 'fastest_risk', 'safest_risk'):
+        assert [len(row) for row in body[name]] == [2, 2, 2]
+    assert body['fastest_time'][0][0] > 0
+
+
+def test_routes_matrix_needs_one_city(client, networks):
+    points = city_points('testford', 2) + city_points('otherton', 1)
+    response = client.post('/routes/matrix', json={'origins': points})
+    assert response.status_code == 400
+    assert 'same city' in response.get_json()['error']
+
+
+@pytest.mark.parametrize('risk_weight', BAD_RISK_WEIGHTS)
+def test_routes_matrix_rejects_invalid_risk_weight(client, networks, risk_weight):
+    response = client.post('/routes/matrix', json={'origins': city_points('testford', 2), 'risk_weight': risk_weight})
+    assert response.status_code == 400
+    assert 'risk_weight' in response.get_json()['error']
@@ -0,0 +1,69 @@
+import pytest
+
+from gazetteer import Gazetteer, LocalGeocoder, gazetteer_path, normalize_name
+from geocoding import Location
+
+TESTFORD = [
+    ('Headingley Stadium', 53.817, -1.582),
+    ('Park Lane', 53.800, -1.560),
+    ('2 Park Lane', 53.801, -1.561),
+    ('14 Park Lane', 53.802, -1.562),
+    ('LS1 4DY', 53.796, -1.545),
+    ("St John's Market", 53.797, -1.541),
+]
+OTHERTON = [('Park Lane', 52.480, -1.900)]
+
+
+@pytest.fixture(scope='module')
+def gazetteer():
+    return Gazetteer.from_entries(TESTFORD)
+
+
+def test_names_are_normalized():
+    assert normalize_name("  St. John's  Rd, ") == 'street johns road'
+
+
+def test_exact_and_prefix_matches(gazetteer):
+    assert gazetteer.search('park lane') == (Location(53.800, -1.560), 1.0)
+    location, score = gazetteer.search('headingley stad')
+    assert location == Location(53.817, -1.582)
+    assert score == pytest.approx(len('headingley stad') / len('headingley stadium'))
+
+
+def test_fuzzy_matches_need_a_close_enough_name(gazetteer):
+    location, score = gazetteer.search('headingly stadium')
+    assert location == Location(53.817, -1.582)
+    assert 0.6 <= score < 1
+    assert gazetteer.search('kirkstall abbey') == (None, 0.0)
+
+
+def test_house_numbers_must_match(gazetteer):
+    assert gazetteer.search('2 park lane')[0] == Location(53.801, -1.561)
+    assert gazetteer.search('14 park la')[0] == Location(53.802, -1.562)
+    assert gazetteer.search('14 parc lane')[0] == Location(53.802, -1.562)
+    # The closest names, "2 park lane" and "14 park lane", have other numbers
+    assert gazetteer.search('12 park lane') == (None, 0.0)
+    assert gazetteer.search('2') == (None, 0.0)
+
+
+def test_save_and_load(gazetteer, tmp_path):
+    path = gazetteer_path('testford', str(tmp_path))
+    gazetteer.save(path)
+    loaded = Gazetteer.load(path)
+    assert len(loaded) == len(gazetteer)
+    for name, lat, lng in TESTFORD:
+        assert loaded.search(normalize_name(name)) == gazetteer.search(normalize_name(name))
+
+
+def test_local_geocoder_splits_queries_by_city(gazetteer):
+    geocoder = LocalGeocoder({'testford': gazetteer, 'otherton': Gazetteer.from_entries(OTHERTON)},
+                             cities=['testford', 'otherton', 'elsewhere'])
+    assert geocoder.geocode('Park Ln, Otherton, UK') == Location(52.480, -1.900)
+    assert geocoder.geocode('Park Lane, Testford') == Location(53.800, -1.560)
+    assert geocoder.geocode("St John's Market") == Location(53.797, -1.541)
+    # A trailing postcode is tried on its own
+    assert geocoder.geocode('Unknown Works LS1 4DY, Testford') == Location(53.796, -1.545)
+    # Cities without a gazetteer, and places that aren't found, are left to the next provider
+    assert geocoder.geocode('Park Lane, Elsewhere') is None
+    assert geocoder.geocode('Kirkstall Abbey, Testford') is None
+    assert geocoder.geocode('Testford') is None
@@ -0,0 +1,130 @@
+import time
+
+import pytest
+
+import geocoding
+from conftest import TEST_CITIES
+from gazetteer import LocalGeocoder
+from geocoding import (MISS, FallbackGeocoder, FixtureGeocoder, GeocodeCache, Geocoder, Location, TokenBucket,
+                       geocode_addresses, make_geocoder)
+from route_engine import NetworkRegistry, load_city_outlines
+
+
+class FailingGeocoder(Geocoder):
+    def geocode(self, query):
+        raise RuntimeError('service down')
+
+
+@pytest.fixture(scope='module')
+def registry(city_data):
+    return NetworkRegistry(data_dir=city_data)
+
+
+@pytest.fixture(scope='module')
+def fixture_geocoder(city_data):
+    return FixtureGeocoder(load_city_outlines(city_data))
+
+
+def test_geocode_addresses_places_each_address_in_its_city(registry, fixture_geocoder):
+    found = geocode_addresses(fixture_geocoder, registry, '1 High Street, Otherton', 'Testford station')
+    assert [registry.locate(*point) for point in found] == ['otherton', 'testford']
+
+
+def test_geocode_addresses_tries_every_city_for_an_address_without_one(registry, fixture_geocoder):
+    # The fixture geocoder places the address in whichever city it is asked about
+    (lat, lng), = geocode_addresses(fixture_geocoder, registry, '1 High Street')
+    assert registry.locate(lat, lng) == registry.cities[0]
+
+
+def test_geocode_addresses_reports_failed_lookups(registry):
+    reports = []
+    found = geocode_addresses(FailingGeocoder(), registry, '1 High Street', report=reports.append)
+    assert found == [(None, None)]
+    assert len(reports) == len(TEST_CITIES)
+    assert all('service down' in report for report in reports)
+
+
+def test_token_bucket_allows_a_burst_then_holds_the_rate():
+    bucket = TokenBucket(rate=100, burst=3)
+    started = time.monotonic()
+    for _ in range(3):
+        bucket.acquire()
+    assert time.monotonic() - started < 0.01
+    for _ in range(5):
+        bucket.acquire()
+    assert time.monotonic() - started >= 0.045
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(geocoding.time, 'time', lambda: now[0])
+    return now
+
+
+def test_geocode_cache_expires_found_and_not_found_answers(tmp_path, clock):
+    cache = GeocodeCache(str(tmp_path / 'cache.sqlite'), ttl=100, negative_ttl=10)
+    assert cache.get('1 High Street, Testford') is MISS
+    cache.put('1 High Street, Testford', Location(53.8, -1.55))
+    cache.put('Nowhere Lane', None)
+    assert cache.get('  1 high street ,testford ') == Location(53.8, -1.55)
+    assert cache.get('nowhere lane') is None
+    clock[0] += 50
+    assert cache.get('1 High Street, Testford') == Location(53.8, -1.55)
+    assert cache.get('Nowhere Lane') is MISS
+    clock[0] += 51
+    assert cache.get('1 High Street, Testford') is MISS
+
+
+def test_geocode_cache_keeps_recent_entries_in_memory_and_all_on_disk(tmp_path, clock):
+    path = str(tmp_path / 'cache.sqlite')
+    cache = GeocodeCache(path, max_entries=2)
+    for i in range(3):
+        cache.put(f'{i} High Street', Location(53.8, float(i)))
+    cache.get('1 High Street')
+    cache.put('3 High Street', Location(53.8, 3.0))
+    assert list(cache._memory) == ['1 high street', '3 high street']
+    # Entries dropped from memory are still read from disk, also by a new process
+    assert cache.get('0 High Street') == Location(53.8, 0.0)
+    assert GeocodeCache(path).get('2 High Street') == Location(53.8, 2.0)
+    clock[0] += geocoding.GEOCODE_TTL + 1
+    assert GeocodeCache(path).get('2 High Street') is MISS
+
+
+def test_geocoder_is_abstract():
+    with pytest.raises(TypeError):
+        Geocoder()
+
+
+def test_fixture_geocoder_places_cities_named_as_words(fixture_geocoder, registry):
+    found = fixture_geocoder.geocode('Market Street, Testford')
+    assert registry.locate(*found) == 'testford'
+    # Deterministic, and independent of case and spacing
+    assert fixture_geocoder.geocode('market street ,  TESTFORD') == found
+    assert fixture_geocoder.geocode('Station Road, Testford') != found
+    assert fixture_geocoder.geocode('Testfordshire Road') is None
+    assert fixture_geocoder.geocode('1 High Street') is None
+
+
+def test_fixture_geocoder_prefers_listed_queries(city_data):
+    geocoder = FixtureGeocoder(load_city_outlines(city_data), {'Town Hall, Testford': [53.79, -1.55]})
+    assert geocoder.geocode('town hall, testford') == Location(53.79, -1.55)
+    assert geocoder.submit('Town Hall, Testford').result() == Location(53.79, -1.55)
+
+
+def test_fallback_geocoder_returns_the_first_place_found(fixture_geocoder):
+    listed = FixtureGeocoder({}, {'Town Hall': [53.79, -1.55]})
+    geocoder = FallbackGeocoder([listed, fixture_geocoder])
+    assert geocoder.geocode('Town Hall') == Location(53.79, -1.55)
+    assert geocoder.geocode('Market Street, Testford') == fixture_geocoder.geocode('Market Street, Testford')
+    assert geocoder.geocode('Nowhere') is None
+
+
+def test_make_geocoder_reads_the_provider_list(city_data):
+    assert isinstance(make_geocoder('fixture', data_dir=city_data), FixtureGeocoder)
+    geocoder = make_geocoder('local, fixture', data_dir=city_data)
+    assert [type(provider) for provider in geocoder.geocoders] == [LocalGeocoder, FixtureGeocoder]
+    with pytest.raises(ValueError):
+        make_geocoder('google', api_key=None, data_dir=city_data)
+    with pytest.raises(ValueError):
+        make_geocoder('carrier-pigeon', data_dir=city_data)
@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+
+from risk_layer import RiskSource
+from route_engine import NetworkRegistry, load_city_outlines, register_city
+
+
+def test_networks_load_on_first_request(city_data):
+    registry = NetworkRegistry(data_dir=city_data)
+    assert registry.resident == []
+    network = registry.get('testford')
+    assert registry.resident == ['testford']
+    assert registry.get('testford') is network
+    with pytest.raises(KeyError):
+        registry.get('nowhere')
+
+
+def test_least_recently_used_city_is_evicted_over_budget(city_data):
+    network_mb = NetworkRegistry(data_dir=city_data).get('testford').nbytes / 1024 / 1024
+    # Room for one city but not two
+    registry = NetworkRegistry(data_dir=city_data, memory_budget_mb=network_mb * 1.5)
+    registry.get('testford')
+    registry.get('otherton')
+    assert registry.resident == ['otherton']
+    # Evicted cities are simply reloaded
+    registry.get('testford')
+    assert registry.resident == ['testford']
+
+
+def test_a_city_over_budget_on_its_own_stays_resident(city_data):
+    registry = NetworkRegistry(data_dir=city_data, memory_budget_mb=1e-6)
+    registry.get('testford')
+    assert registry.resident == ['testford']
+
+
+def test_prewarm_all_loads_every_city(city_data):
+    registry = NetworkRegistry(data_dir=city_data, memory_budget_mb=0)
+    registry.prewarm(('all',))
+    assert sorted(registry.resident) == sorted(registry.cities)
+    registry.evict('otherton')
+    assert registry.resident == ['testford']
+
+
+def test_points_are_located_in_the_smallest_containing_outline(tmp_path):
+    big = shapely.box(-2.0, 53.0, -1.0, 54.0)
+    small = shapely.box(-1.6, 53.7, -1.4, 53.9)
+    register_city('county', big, str(tmp_path))
+    register_city('town', small, str(tmp_path))
+    registry = NetworkRegistry(data_dir=str(tmp_path))
+    points = [(53.8, -1.5), (53.2, -1.8), (52.0, -1.5)]
+    expected = ['town', 'county', None]
+    assert [registry.locate(lat, lng) for lat, lng in points] == expected
+    lat, lng = np.array(points).T
+    assert registry.locate_many(lat, lng) == expected
+
+
+def test_register_city_keeps_existing_outlines_unless_replaced(tmp_path):
+    first, second = shapely.box(0, 0, 1, 1), shapely.box(0, 0, 2, 2)
+    assert register_city('town', first, str(tmp_path))
+    assert not register_city('town', second, str(tmp_path))
+    assert load_city_outlines(str(tmp_path))['town'].equals(first)
+    assert register_city('town', second, str(tmp_path), replace=True)
+    outlines = load_city_outlines(str(tmp_path))
+    assert list(outlines) == ['town']
+    assert outlines['town'].equals(second)
+
+
+def test_refresh_risk_swaps_in_rescored_networks(city_data, tmp_path):
+    pd.DataFrame({'geohash': [], 'crash_risk': []}).to_pickle(tmp_path / 'risk_grid.pkl')
+    registry = NetworkRegistry(data_dir=city_data, risk_source=RiskSource(data_dir=str(tmp_path), mode='graph'))
+    old = registry.get('testford')
+    edges = [0, 1, 2]
+    new_risk = old.risk[edges] + 1.0
+    pd.DataFrame({'u': old.node_ids[old.sources[edges]], 'v': old.node_ids[old.targets[edges]],
+                  'key': old.edge_keys[edges], 'normalized_risk': new_risk}).to_pickle(tmp_path / 'testford_edges.pkl')
+    assert registry.risk_source.poll(force=True)
+
+    assert registry.refresh_risk() == {'testford': len(edges)}
+    network = registry.get('testford')
+    assert network is not old
+    assert network.risk_version == old.risk_version + 1 == registry.risk_version
+    assert network.risk[edges].tolist() == pytest.approx(new_risk.tolist())
+    # Requests holding the old network keep its scores
+    assert old.risk[edges].tolist() == pytest.approx((new_risk - 1.0).tolist())
+    # Cities loaded later start from the new scores and version
+    assert registry.get('otherton').risk_version == registry.risk_version
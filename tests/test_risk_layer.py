@@ -0,0 +1,115 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import street_grid
+from risk_layer import (GEOHASH_ALPHABET, GEOHASH_BITS, NORMALIZED_RISK_MAX, RiskGrid, RiskSource, geohash_cells,
+                        point_cells)
+from route_engine import RouteNetwork
+
+# Size of a geohash-8 cell in degrees
+CELL_LNG = 360.0 / (1 << GEOHASH_BITS)
+CELL_LAT = 180.0 / (1 << GEOHASH_BITS)
+
+
+def cell_corner(lat, lng):
+    """South-west corner of the cell containing a point"""
+    return np.floor((lat + 90.0) / CELL_LAT) * CELL_LAT - 90.0, np.floor((lng + 180.0) / CELL_LNG) * CELL_LNG - 180.0
+
+
+def cell_geohash(cell):
+    """Geohash-8 string of an integer cell key"""
+    x, y = cell >> GEOHASH_BITS, cell & ((1 << GEOHASH_BITS) - 1)
+    bits = 0
+    for b in range(GEOHASH_BITS - 1, -1, -1):
+        bits = bits << 2 | (x >> b & 1) << 1 | (y >> b & 1)
+    return ''.join(GEOHASH_ALPHABET[bits >> shift & 31] for shift in range(35, -1, -5))
+
+
+def test_geohash_cells_match_point_cells():
+    # u4pruydqqvj is the geohash of 57.64911, 10.40744
+    assert geohash_cells(['u4pruydq'])[0] == point_cells(57.64911, 10.40744)
+    assert cell_geohash(int(point_cells(57.64911, 10.40744))) == 'u4pruydq'
+
+
+def test_lookup_reads_recorded_cells_and_zero_elsewhere():
+    grid = RiskGrid.from_frame(pd.DataFrame({'geohash': ['u4pruydq', 'gcwrdz2v'], 'crash_risk': [3.0, 7.0]}))
+    assert len(grid) == 2
+    lat, lng = cell_corner(57.64911, 10.40744)
+    points = [(lat + CELL_LAT / 2, lng + CELL_LNG / 2), (lat + CELL_LAT / 2, lng - CELL_LNG / 2), (0.0, 0.0)]
+    assert grid.lookup(*np.array(points).T).tolist() == [3.0, 0.0, 0.0]
+    assert RiskGrid([], []).lookup([57.6], [10.4]).tolist() == [0.0]
+
+
+def test_normalize_maps_onto_the_routing_scale():
+    grid = RiskGrid(np.arange(100), np.arange(1, 101, dtype=float))
+    normalized = grid.normalize([0.0, grid.scale / 2, grid.scale, grid.scale * 10])
+    assert normalized.tolist() == pytest.approx([0.0, NORMALIZED_RISK_MAX / 2, NORMALIZED_RISK_MAX, NORMALIZED_RISK_MAX])
+
+
+def test_segment_risk_is_the_length_weighted_mean():
+    lat, lng = cell_corner(53.8, -1.55)
+    mid = lat + CELL_LAT / 2
+    grid = RiskGrid([point_cells(mid, lng + CELL_LNG / 2)], [4.0])
+    # Across the risky cell and the next one; inside the risky cell; a single point
+    line_lat = [mid, mid, mid, mid, mid]
+    line_lng = [lng, lng + 2 * CELL_LNG, lng + 0.2 * CELL_LNG, lng + 0.8 * CELL_LNG, lng + CELL_LNG / 2]
+    risk = grid.segment_risk(line_lat, line_lng, [0, 2, 4, 5], step_m=1.0)
+    assert risk.tolist() == pytest.approx([2.0, 4.0, 4.0], abs=0.1)
+
+
+def test_edge_risk_scores_every_edge():
+    network = RouteNetwork.from_graph(street_grid(rows=6, cols=6))
+    cells = np.unique(point_cells(network.geom_lat, network.geom_lng))
+    grid = RiskGrid(cells, np.ones(len(cells)))
+    risk = grid.edge_risk(network)
+    assert risk.shape == (network.num_edges,)
+    assert ((risk >= 0) & (risk <= NORMALIZED_RISK_MAX)).all()
+    assert risk.max() > 0
+    assert RiskGrid([], []).edge_risk(network).tolist() == [0.0] * network.num_edges
+
+
+@pytest.fixture
+def risk_dir(tmp_path):
+    pd.DataFrame({'geohash': ['u4pruydq'], 'crash_risk': [3.0]}).to_pickle(tmp_path / 'risk_grid.pkl')
+    return tmp_path
+
+
+def edges_frame(network, edges, risk):
+    return pd.DataFrame({'u': network.node_ids[network.sources[edges]], 'v': network.node_ids[network.targets[edges]],
+                         'key': network.edge_keys[edges], 'normalized_risk': risk})
+
+
+def test_risk_source_picks_up_replaced_edge_files(risk_dir):
+    network = RouteNetwork.from_graph(street_grid(rows=6, cols=6))
+    source = RiskSource(data_dir=str(risk_dir), mode='graph')
+    assert not source.poll(force=True)
+    assert source.edge_risk('testford', network) is None
+
+    edges_frame(network, [0, 5], [4.5, 0.0]).to_pickle(risk_dir / 'testford_edges.pkl')
+    # Not checked again before poll_seconds have passed
+    assert not source.poll()
+    assert source.poll(force=True)
+    risk = source.edge_risk('testford', network)
+    assert risk[[0, 5]].tolist() == [4.5, 0.0]
+    untouched = np.setdiff1d(np.arange(network.num_edges), [0, 5])
+    assert (risk[untouched] == network.risk[untouched]).all()
+    assert source.edge_risk('otherton', network) is None
+    assert not source.poll(force=True)
+
+
+def test_grid_mode_scores_from_the_reloaded_grid(risk_dir):
+    network = RouteNetwork.from_graph(street_grid(rows=6, cols=6))
+    source = RiskSource(data_dir=str(risk_dir), mode='grid')
+    assert source.edge_risk('testford', network).tolist() == [0.0] * network.num_edges
+
+    cells = np.unique(point_cells(network.geom_lat, network.geom_lng))
+    frame = pd.DataFrame({'geohash': [cell_geohash(cell) for cell in cells.tolist()], 'crash_risk': 1.0})
+    frame.to_pickle(risk_dir / 'risk_grid.pkl')
+    # Make sure the replacement shows even on filesystems with coarse timestamps
+    os.utime(risk_dir / 'risk_grid.pkl', ns=(0, 0))
+    assert source.poll(force=True)
+    assert len(source.grid) == len(cells)
+    assert source.edge_risk('testford', network).max() > 0
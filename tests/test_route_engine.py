@@ -0,0 +1,252 @@
+import math
+
+import numpy as np
+import pytest
+
+import route_engine
+from conftest import street_grid
+from contraction import build_customizable, build_hierarchy
+from route_engine import (SIMPLIFY_TOLERANCES_M, RouteCache, RouteNetwork, _safest_weights, calculate_route_improved,
+                          calculate_routes_batch, encode_polyline, pareto_routes, route_polylines, route_shape,
+                          route_summary, snapshot_path, travel_matrix)
+
+STAT_KEYS = ('fastest_time', 'safest_time', 'fastest_risk', 'safest_risk')
+
+
+@pytest.fixture(scope='module')
+def network():
+    network = RouteNetwork.from_graph(street_grid())
+    network.hierarchy = build_hierarchy(network, network.length, verbose=False)
+    network.customizable = build_customizable(network, verbose=False)
+    return network
+
+
+def random_points(network, count, seed):
+    rng = np.random.default_rng(seed)
+    return [(float(rng.uniform(network.lat.min(), network.lat.max())),
+             float(rng.uniform(network.lng.min(), network.lng.max()))) for _ in range(count)]
+
+
+def single_route(network, origin, destination, search):
+    try:
+        return calculate_route_improved(network, origin, destination, 0.5, search=search)
+    except ValueError:
+        return None
+
+
+def test_search_modes_return_equal_costs(network):
+    points = random_points(network, 60, seed=0)
+    metrics = [('length', network.length, ('dijkstra', 'astar', 'bidirectional', 'ch', 'cch')),
+               ('safest', _safest_weights(network, 0.5, 'dijkstra'), ('dijkstra', 'astar', 'bidirectional', 'cch'))]
+    for origin, destination in zip(points[::2], points[1::2]):
+        orig_snap = network.snap(*origin)
+        dest_snap = network.snap(*destination)
+        for name, weights, searches in metrics:
+            costs = {}
+            for search in searches:
+                found = network.route_between(orig_snap, dest_snap, weights, search)
+                costs[search] = None if found is None else found['cost']
+            reference = costs['dijkstra']
+            for search, cost in costs.items():
+                if reference is None:
+                    assert cost is None, (name, search)
+                else:
+                    assert cost == pytest.approx(reference, rel=1e-9), (name, search)
+
+
+@pytest.mark.parametrize('search', ['dijkstra', 'hierarchy'])
+def test_batch_matches_single_routes(network, search):
+    points = random_points(network, 40, seed=1)
+    # A shared origin with enough destinations for the one-to-all tree, and single pairs
+    origins = [points[0]] * 20 + points[20:30]
+    destinations = points[1:21] + points[30:40]
+    batch = dict(calculate_routes_batch(network, origins, destinations, 0.5, search=search))
+    assert sorted(batch) == list(range(len(origins)))
+    for i, (origin, destination) in enumerate(zip(origins, destinations)):
+        single = single_route(network, origin, destination, search)
+        if single is None:
+            assert batch[i] is None
+            continue
+        for key in STAT_KEYS:
+            assert batch[i][key] == pytest.approx(single[key], rel=1e-9, abs=1e-9), (i, key)
+
+
+@pytest.mark.parametrize('search', ['dijkstra', 'hierarchy'])
+@pytest.mark.parametrize('shape', [(6, 4), (4, 6)])
+def test_matrix_matches_single_routes(network, search, shape):
+    points = random_points(network, sum(shape), seed=2)
+    origins, destinations = points[:shape[0]], points[shape[0]:]
+    matrices = travel_matrix(network, origins, destinations, 0.5, search=search)
+    for i, origin in enumerate(origins):
+        for j, destination in enumerate(destinations):
+            single = single_route(network, origin, destination, search)
+            for key in STAT_KEYS:
+                expected = math.inf if single is None else single[key]
+                assert matrices[key][i, j] == pytest.approx(expected, rel=1e-9, abs=1e-9), (i, j, key)
+
+
+def test_pareto_routes_are_not_dominated(network):
+    points = random_points(network, 20, seed=3)
+    for origin, destination in zip(points[::2], points[1::2]):
+        if single_route(network, origin, destination, 'dijkstra') is None:
+            continue
+        routes = pareto_routes(network, origin, destination)['routes']
+        assert routes
+        for faster, slower in zip(routes, routes[1:]):
+            assert faster['time'] <= slower['time']
+            assert faster['risk'] > slower['risk']
+
+
+@pytest.mark.parametrize('risk_weight', [-0.5, -5, math.inf, math.nan, 'abc'])
+def test_invalid_risk_weight_is_rejected_before_searching(network, risk_weight):
+    origin, destination = random_points(network, 2, seed=4)
+    with pytest.raises(ValueError):
+        network.weights(risk_weight)
+    for search in ('dijkstra', 'astar', 'hierarchy'):
+        with pytest.raises(ValueError):
+            calculate_route_improved(network, origin, destination, risk_weight, search=search)
+        with pytest.raises(ValueError):
+            list(calculate_routes_batch(network, [origin], [destination], risk_weight, search=search))
+        with pytest.raises(ValueError):
+            travel_matrix(network, [origin], [destination], risk_weight, search=search)
+    with pytest.raises(ValueError):
+        pareto_routes(network, origin, destination, max_risk_weight=risk_weight)
+
+
+def test_matrix_uses_hierarchies_only_when_asked(network, monkeypatch):
+    def many_to_many(*args, **kwargs):
+        raise AssertionError("hierarchy used")
+
+    monkeypatch.setattr(network.hierarchy, 'many_to_many', many_to_many)
+    points = random_points(network, 4, seed=5)
+    travel_matrix(network, points[:2], points[2:], 0.5, search='dijkstra')
+    with pytest.raises(AssertionError):
+        travel_matrix(network, points[:2], points[2:], 0.5, search='hierarchy')
+
+
+def test_route_shapes_run_between_the_snapped_points(network):
+    points = random_points(network, 20, seed=6)
+    # The last pair starts and ends on one edge
+    pairs = list(zip(points[::2], points[1::2])) + [(points[0], (points[0][0] + 1e-5, points[0][1]))]
+    for origin, destination in pairs:
+        result = single_route(network, origin, destination, 'dijkstra')
+        if result is None:
+            continue
+        sizes = []
+        for tolerance in SIMPLIFY_TOLERANCES_M:
+            coords = route_shape(network, result, 'safest', tolerance)
+            assert coords[0] == pytest.approx(result['start_point'])
+            assert coords[-1] == pytest.approx(result['end_point'])
+            sizes.append(len(coords))
+        assert sizes == sorted(sizes, reverse=True)
+
+
+@pytest.mark.parametrize('search', ['astar', 'bidirectional'])
+def test_pareto_interior_weights_stay_out_of_the_caches(network, search):
+    points = random_points(network, 20, seed=7)
+    before = set(network._weight_lists)
+    interior = 0
+    for origin, destination in zip(points[::2], points[1::2]):
+        if single_route(network, origin, destination, 'dijkstra') is None:
+            continue
+        expected = pareto_routes(network, origin, destination, search='dijkstra')['routes']
+        routes = pareto_routes(network, origin, destination, search=search)['routes']
+        assert [route['time'] for route in routes] == pytest.approx([route['time'] for route in expected])
+        interior += sum(0 < route['risk_weight'] < 1 for route in routes)
+    assert interior
+    # Only the fastest and the max_risk_weight metric are worth keeping
+    assert len(set(network._weight_lists) - before) <= 2
+
+
+def test_snapshot_round_trip(network, tmp_path):
+    path = snapshot_path('testford', str(tmp_path))
+    network.save(path)
+    loaded = RouteNetwork.load(path, mmap_mode='r')
+    assert loaded.fingerprint() == network.fingerprint()
+    assert not loaded.length.flags.writeable
+    for origin, destination in zip(*[iter(random_points(network, 10, seed=8))] * 2):
+        expected = single_route(network, origin, destination, 'dijkstra')
+        found = single_route(loaded, origin, destination, 'dijkstra')
+        assert (found is None) == (expected is None)
+        if expected is not None:
+            assert route_summary(found) == pytest.approx(route_summary(expected))
+
+
+def test_snapshot_without_meta_is_not_loaded(network, tmp_path):
+    path = snapshot_path('testford', str(tmp_path))
+    network.save(path)
+    (tmp_path / 'testford_network' / 'meta.json').unlink()
+    with pytest.raises(FileNotFoundError):
+        RouteNetwork.load(path)
+
+
+def test_route_cache_evicts_least_recently_used_and_expired_entries(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(route_engine.time, 'monotonic', lambda: now[0])
+    cache = RouteCache(max_entries=2, ttl=10)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == (1, None, 3)
+    now[0] += 11
+    assert cache.get('a') is None
+    assert len(cache) == 1
+    disabled = RouteCache(max_entries=0)
+    disabled.put('a', 1)
+    assert disabled.get('a') is None
+
+
+def test_repeated_routes_come_from_the_cache(network):
+    network = network.with_risk(network.risk)
+    origin, destination = next((pair for pair in zip(*[iter(random_points(network, 20, seed=9))] * 2)
+                                if single_route(network, *pair, 'dijkstra') is not None))
+    first = calculate_route_improved(network, origin, destination, 0.5)
+    nearby = (origin[0] + 1e-6, origin[1])
+    assert calculate_route_improved(network, nearby, destination, 0.501) is first
+    assert calculate_route_improved(network, origin, destination, 0.6) is not first
+    assert calculate_route_improved(network, origin, destination, 0.5, search='astar') is not first
+    # A network with refreshed risk starts with an empty cache
+    assert calculate_route_improved(network.with_risk(network.risk), origin, destination, 0.5) is not first
+
+
+def decode_polyline(text, precision=5):
+    """Reference decoder for Google's encoded polyline format"""
+    values, value, shift = [], 0, 0
+    for char in text:
+        chunk = ord(char) - 63
+        value |= (chunk & 0x1f) << shift
+        shift += 5
+        if chunk < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value, shift = 0, 0
+    coords = np.cumsum(np.array(values).reshape(-1, 2), axis=0) / 10 ** precision
+    return [tuple(pair) for pair in coords.tolist()]
+
+
+def test_encode_polyline_matches_the_reference_example():
+    # The worked example of Google's format documentation
+    assert encode_polyline([(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]) == '_p~iF~ps|U_ulLnnqC_mqNvxq`@'
+    assert encode_polyline([]) == ''
+
+
+@pytest.mark.parametrize('precision', [5, 6])
+def test_encode_polyline_round_trip(precision):
+    rng = np.random.default_rng(10)
+    coords = np.column_stack([rng.uniform(-90, 90, 200), rng.uniform(-180, 180, 200)])
+    # Repeated points and tiny steps encode zero and one-unit deltas
+    coords = np.concatenate([coords, coords[-1:], coords[-1:] + 10 ** -precision])
+    decoded = decode_polyline(encode_polyline(coords, precision), precision)
+    assert decoded == pytest.approx([tuple(pair) for pair in np.round(coords, precision).tolist()], abs=1e-9)
+
+
+def test_route_polylines_decode_to_the_route_shapes(network):
+    result = next(found for found in (single_route(network, *pair, 'dijkstra')
+                                      for pair in zip(*[iter(random_points(network, 20, seed=11))] * 2))
+                  if found is not None)
+    polylines = route_polylines(network, result)
+    assert polylines['tolerances'] == list(SIMPLIFY_TOLERANCES_M)
+    for name in ('fastest', 'safest'):
+        for tolerance, text in zip(SIMPLIFY_TOLERANCES_M, polylines[name]):
+            expected = np.round(route_shape(network, result, name, tolerance), 5).tolist()
+            assert decode_polyline(text) == pytest.approx([tuple(pair) for pair in expected], abs=1e-9)